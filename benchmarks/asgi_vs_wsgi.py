@@ -0,0 +1,212 @@
+"""
+Redirect throughput of the sync views under WSGI against the async views
+under ASGI, with the same number of workers.
+
+A WSGI worker is a thread handling one request at a time. An ASGI worker is
+a thread running an event loop with ``--concurrency`` requests in flight.
+Requests are dispatched in-process to ``config.wsgi``/``config.asgi``, so
+the numbers leave out the HTTP server but include the middleware, Redis and
+the database configured in the settings.
+
+Usage::
+
+    python -m benchmarks.asgi_vs_wsgi --workers 4 --concurrency 50
+
+Each mode runs in its own process, since the views are picked when the
+URLconf is loaded (``URL_SHORTENER_ASYNC_VIEWS``). Prints a JSON report.
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return {
+        f'p{p}': latencies[min(len(latencies) - 1,
+                               len(latencies) * p // 100)] * 1000
+        for p in (50, 95, 99)
+    }
+
+
+def report(latencies, elapsed):
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        **{f'{k}_ms': v
+           for k, v in percentiles(latencies).items()},
+    }
+
+
+def run_wsgi(paths, workers):
+    from config.wsgi import application
+
+    latencies = []
+    lock = threading.Lock()
+
+    def start_response(status, headers):
+        pass
+
+    def worker():
+        while True:
+            with lock:
+                path = next(paths, None)
+            if path is None:
+                return
+            environ = {
+                'REQUEST_METHOD': 'GET',
+                'PATH_INFO': path,
+                'SERVER_NAME': 'localhost',
+                'SERVER_PORT': '80',
+                'wsgi.url_scheme': 'http',
+                'wsgi.input': io.BytesIO(),
+            }
+            start = time.perf_counter()
+            response = application(environ, start_response)
+            b''.join(response)
+            response.close()
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return report(latencies, time.perf_counter() - start)
+
+
+def run_asgi(paths, workers, concurrency):
+    from config.asgi import application
+
+    latencies = []
+    lock = threading.Lock()
+
+    async def request(path):
+        scope = {
+            'type': 'http',
+            'asgi': {
+                'version': '3.0'
+            },
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'query_string': b'',
+            'headers': [(b'host', b'localhost')],
+            'server': ('localhost', 80),
+            'client': ('127.0.0.1', 0),
+        }
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            pass
+
+        start = time.perf_counter()
+        await application(scope, receive, send)
+        return time.perf_counter() - start
+
+    async def loop_worker():
+
+        async def task():
+            while True:
+                with lock:
+                    path = next(paths, None)
+                if path is None:
+                    return
+                latency = await request(path)
+                with lock:
+                    latencies.append(latency)
+
+        await asyncio.gather(*(task() for _ in range(concurrency)))
+
+    threads = [
+        threading.Thread(target=asyncio.run, args=(loop_worker(), ))
+        for _ in range(workers)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return report(latencies, time.perf_counter() - start)
+
+
+def run_mode(args):
+    import django
+    django.setup()
+    from url_shortener.models import Url
+
+    objs = Url.objects.insert_new([
+        Url(url=f'https://benchmark.local/{time.time_ns()}/{i}')
+        for i in range(args.codes)
+    ])
+    try:
+        paths = itertools.islice(
+            itertools.cycle([f'/url/{obj.short_url}/' for obj in objs]),
+            args.requests)
+        if args.mode == 'wsgi':
+            result = run_wsgi(paths, args.workers)
+        else:
+            result = run_asgi(paths, args.workers, args.concurrency)
+    finally:
+        Url.objects.filter(pk__in=[obj.pk for obj in objs]).delete()
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=50,
+                        help='Requests in flight per ASGI worker.')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--codes',
+                        type=int,
+                        default=100,
+                        help='Number of short URLs the requests cycle over.')
+    parser.add_argument('--mode', choices=('wsgi', 'asgi'))
+    args = parser.parse_args()
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+    if args.mode:
+        return run_mode(args)
+
+    results = {}
+    for mode in ('wsgi', 'asgi'):
+        env = dict(os.environ,
+                   URL_SHORTENER_ASYNC_VIEWS='1' if mode == 'asgi' else '0')
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.asgi_vs_wsgi', '--mode', mode] +
+            sys.argv[1:],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True).stdout
+        results[mode] = json.loads(output.splitlines()[-1])
+    print(
+        json.dumps(
+            {
+                'workers': args.workers,
+                'asgi_concurrency': args.concurrency,
+                **results
+            },
+            indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""
+Throughput and latency of the API endpoints under concurrent requests.
+
+Requests are dispatched in-process through the Django test client, one
+client per worker thread, with the full middleware stack. The database and
+Redis are local stand-ins picked by ``benchmarks/settings.py`` (SQLite and
+a local or fake Redis by default), so runs are reproducible without the
+production services.
+
+Usage::
+
+    python -m benchmarks.endpoints --concurrency 8 --requests 2000
+
+Prints a JSON report with the throughput and the latency percentiles of
+each scenario. The ``concurrent_redirects`` scenario sends all its requests
+to one short URL and checks that ``on_clicks`` counts every one of them
+once the clicks are flushed; the command exits with status 1 if clicks were
+lost.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from .asgi_vs_wsgi import report
+
+SCENARIOS = ('create', 'redirect_hit', 'redirect_miss', 'redirect_unknown',
+             'info', 'list', 'delete', 'concurrent_redirects')
+BASE_URL = 'https://benchmark.local/'
+
+
+def setup():
+    """Start from an empty database and Redis."""
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.db import connection
+    from django_redis import get_redis_connection
+
+    from url_shortener.models import Url
+
+    if connection.vendor == 'sqlite':
+        connection.close()
+        if os.path.exists(connection.settings_dict['NAME']):
+            os.remove(connection.settings_dict['NAME'])
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    # Leftovers of a previous run on a persistent database
+    Url.objects.filter(url__startswith=BASE_URL).delete()
+    get_redis_connection('default').flushdb()
+
+
+def drive(requests, concurrency, expected_status):
+    """
+    Send ``requests`` from ``concurrency`` threads.
+
+    ``requests`` is an iterator of functions taking a test client and
+    returning a response. Returns the report of the run, with the number of
+    responses whose status was not ``expected_status``.
+    """
+    from django.db import connection
+    from django.test import Client
+
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker():
+        nonlocal errors
+        client = Client()
+        while True:
+            with lock:
+                request = next(requests, None)
+            if request is None:
+                break
+            start = time.perf_counter()
+            response = request(client)
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                errors += response.status_code != expected_status
+        connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {**report(latencies, time.perf_counter() - start), 'errors': errors}
+
+
+def shorten(count, prefix):
+    from url_shortener.models import Url
+
+    return Url.objects.insert_new(
+        [Url(url=f'{BASE_URL}{prefix}/{i}') for i in range(count)])
+
+
+def cycle(paths, count):
+    return itertools.islice(itertools.cycle(paths), count)
+
+
+def flush_clicks(short_url):
+    """Flush the clicks, also waiting for a flush already in progress."""
+    from url_shortener import clicks
+
+    while clicks.pending(short_url):
+        if not clicks.flush():
+            time.sleep(0.05)
+
+
+def run_scenario(name, args):
+    from url_shortener import local_cache, redirects
+    from url_shortener.models import Url
+
+    if name == 'create':
+        requests = (lambda client, i=i: client.post(
+            '/url_shortener/', {'url': f'{BASE_URL}create/{i}'},
+            content_type='application/json') for i in range(args.requests))
+        return drive(requests, args.concurrency, 201)
+
+    if name == 'redirect_hit':
+        objs = shorten(args.codes, 'redirect_hit')
+        for obj in objs:
+            redirects.resolve(obj.short_url)
+        requests = (
+            lambda client, path=path: client.get(path)
+            for path in cycle([f'/url/{obj.short_url}/'
+                               for obj in objs], args.requests))
+        return drive(requests, args.concurrency, 301)
+
+    if name == 'redirect_miss':
+        # Every short URL is requested once, and none is cached yet
+        objs = shorten(args.requests, 'redirect_miss')
+        local_cache.targets.clear()
+        requests = (
+            lambda client, obj=obj: client.get(f'/url/{obj.short_url}/')
+            for obj in objs)
+        return drive(requests, args.concurrency, 301)
+
+    if name == 'redirect_unknown':
+        # Short URLs never issued, as sent by scanners
+        requests = (lambda client, i=i: client.get(f'/url/x{i:05d}/')
+                    for i in range(args.requests))
+        return drive(requests, args.concurrency, 404)
+
+    if name == 'info':
+        objs = shorten(args.codes, 'info')
+        requests = (
+            lambda client, path=path: client.get(path)
+            for path in cycle([f'/info/{obj.short_url}/'
+                               for obj in objs], args.requests))
+        return drive(requests, args.concurrency, 200)
+
+    if name == 'list':
+        paths = [
+            '/urls/', '/urls/?page_size=10', '/urls/?stream=1',
+            '/urls/top/?n=10'
+        ]
+        requests = (lambda client, path=path: client.get(path)
+                    for path in cycle(paths, args.requests))
+        return drive(requests, args.concurrency, 200)
+
+    if name == 'delete':
+        objs = shorten(args.requests, 'delete')
+        requests = (
+            lambda client, obj=obj: client.delete(f'/info/{obj.short_url}/')
+            for obj in objs)
+        return drive(requests, args.concurrency, 204)
+
+    if name == 'concurrent_redirects':
+        obj, = shorten(1, 'concurrent_redirects')
+        path = f'/url/{obj.short_url}/'
+        requests = (lambda client: client.get(path)
+                    for _ in range(args.requests))
+        result = drive(requests, args.concurrency, 301)
+        flush_clicks(obj.short_url)
+        on_clicks = Url.objects.get(pk=obj.pk).on_clicks
+        return {
+            **result,
+            'on_clicks': on_clicks,
+            'lost_clicks': result['requests'] - result['errors'] - on_clicks,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests',
+                        type=int,
+                        default=2000,
+                        help='Requests per scenario.')
+    parser.add_argument('--codes',
+                        type=int,
+                        default=100,
+                        help='Number of short URLs the cached lookups '
+                        'cycle over.')
+    parser.add_argument('--scenarios',
+                        default=','.join(SCENARIOS),
+                        help='Comma separated scenarios to run, among: ' +
+                        ', '.join(SCENARIOS))
+    args = parser.parse_args()
+    scenarios = args.scenarios.split(',')
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+    setup()
+    from django.conf import settings
+    from django.db import connection
+
+    results = {name: run_scenario(name, args) for name in scenarios}
+    print(
+        json.dumps(
+            {
+                'database': connection.vendor,
+                'redis': os.environ.get('BENCHMARK_REDIS', 'local'),
+                'fast_redirect': settings.URL_SHORTENER_FAST_REDIRECT,
+                'concurrency': args.concurrency,
+                'scenarios': results,
+            },
+            indent=2))
+    if results.get('concurrent_redirects', {}).get('lost_clicks'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Settings of the endpoint benchmarks (``benchmarks/endpoints.py``).
+
+The project settings, with stand-ins chosen in the environment:
+
+* ``BENCHMARK_DATABASE``: ``sqlite`` (default) for a throwaway SQLite file,
+  or ``postgres`` for the database of the project settings.
+* ``BENCHMARK_REDIS``: ``local`` (default) for the Redis database
+  ``BENCHMARK_REDIS_URL``, which is flushed by every run, or ``fake`` for an
+  in-process fakeredis server (``pip install fakeredis[lua]``).
+"""
+import os
+import tempfile
+
+from config.settings import *  # noqa: F401,F403
+from config.settings import CACHES
+
+# No query log, which would grow with every request
+DEBUG = False
+ALLOWED_HOSTS = ['testserver', 'localhost']
+
+if os.environ.get('BENCHMARK_DATABASE', 'sqlite') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE':
+            'django.db.backends.sqlite3',
+            'NAME':
+            os.path.join(tempfile.gettempdir(),
+                         'url_shortener_benchmark.sqlite3'),
+            'OPTIONS': {
+                # Concurrent writers wait for the database lock
+                'timeout': 30,
+            },
+        }
+    }
+    URL_SHORTENER_READ_REPLICAS = []
+    URL_SHORTENER_SHARDS = ['default']
+    # The migrations create a PL/pgSQL trigger; the tables are made from the
+    # models instead (migrate --run-syncdb)
+    MIGRATION_MODULES = {'url_shortener': None}
+
+CACHES = {
+    'default': {
+        **CACHES['default'],
+        'LOCATION':
+        os.environ.get('BENCHMARK_REDIS_URL', 'redis://redis:6379/15'),
+    }
+}
+if os.environ.get('BENCHMARK_REDIS') == 'fake':
+    from fakeredis import FakeConnection
+
+    CACHES['default']['OPTIONS'] = {
+        **CACHES['default']['OPTIONS'],
+        'CONNECTION_POOL_KWARGS': {
+            'connection_class': FakeConnection,
+        },
+    }
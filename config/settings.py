@@ -47,6 +47,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'url_shortener.middleware.metrics_middleware',
+    'url_shortener.middleware.profiling_middleware',
+    'url_shortener.middleware.fast_redirect_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,6 +57,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'url_shortener.middleware.DatabaseBreakerMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -87,9 +91,41 @@ DATABASES = {
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD'),
         'HOST': 'db',
         'PORT': 5432,
+        'OPTIONS': {
+            # Give up on a database that is down or slow instead of holding
+            # the worker (see url_shortener/breaker.py); migrate and the
+            # maintenance commands lift the statement timeout.
+            'connect_timeout':
+            int(os.environ.get('POSTGRES_CONNECT_TIMEOUT', 2)),
+            'options':
+            '-c statement_timeout=%d' %
+            int(os.environ.get('POSTGRES_STATEMENT_TIMEOUT', 5000)),
+        },
     }
 }
 
+# Read replicas, one alias per host of POSTGRES_REPLICA_HOSTS (comma
+# separated). Leave it unset to run the tests, which set up their own
+# replica alias where they need one.
+for i, host in enumerate(
+        filter(None,
+               os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(',')), 1):
+    DATABASES[f'replica{i}'] = {
+        **DATABASES['default'], 'HOST': host.strip(),
+        'TEST': {
+            'MIRROR': 'default'
+        }
+    }
+
+# Extra shards of the URLs, one alias per host of POSTGRES_SHARD_HOSTS
+# (comma separated), see URL_SHORTENER_SHARDS.
+for i, host in enumerate(
+        filter(None,
+               os.environ.get('POSTGRES_SHARD_HOSTS', '').split(',')), 1):
+    DATABASES[f'shard{i}'] = {**DATABASES['default'], 'HOST': host.strip()}
+
+DATABASE_ROUTERS = ['url_shortener.db_router.ReplicaRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -150,10 +186,136 @@ CACHES = {
         'BACKEND': 'django_redis.cache.RedisCache',
         'LOCATION': 'redis://redis:6379/1',
         'OPTIONS': {
-            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CLIENT_CLASS': 'url_shortener.metrics.RedisCacheClient',
+            'REDIS_CLIENT_CLASS': 'url_shortener.profiling.RedisClient',
         }
     }
 }
 
+# Redis database of the tests, flushed before each test (see
+# url_shortener/tests.py)
+TEST_REDIS_URL = os.environ.get('REDIS_TEST_URL', 'redis://redis:6379/14')
+
 SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
 SESSION_CACHE_ALIAS = 'default'
+
+# URL shortener
+
+# Seconds between flushes of the buffered redirect clicks to the database
+# (0 disables the in-process flusher; use `manage.py flush_clicks` instead).
+URL_SHORTENER_CLICK_FLUSH_INTERVAL = 5
+
+# Size (entries) and time to live (seconds) of the per-worker cache of
+# resolved short URLs consulted before Redis (size 0 disables it).
+URL_SHORTENER_LOCAL_CACHE_SIZE = 10000
+URL_SHORTENER_LOCAL_CACHE_TTL = 60
+
+# Maximum number of URLs accepted by one bulk shorten request.
+URL_SHORTENER_BULK_MAX_SIZE = 1000
+
+# Short code generator and the key of its id permutation. Changing the key
+# after codes have been issued can make new codes collide with old ones.
+URL_SHORTENER_CODE_GENERATOR = 'url_shortener.codes.FeistelCodeGenerator'
+URL_SHORTENER_CODE_KEY = os.environ.get('URL_SHORTENER_CODE_KEY', SECRET_KEY)
+URL_SHORTENER_CODE_LENGTH = 6
+
+# Default and maximum number of URLs per page of the list of URLs, and the
+# number of rows fetched at once when a page is streamed.
+URL_SHORTENER_LIST_PAGE_SIZE = 100
+URL_SHORTENER_LIST_MAX_PAGE_SIZE = 1000
+URL_SHORTENER_LIST_STREAM_CHUNK_SIZE = 500
+
+# Number of rows read at once by the streaming export.
+URL_SHORTENER_EXPORT_CHUNK_SIZE = 2000
+
+# Serve redirects and info lookups with async views (run the project with an
+# ASGI server, see config/asgi.py).
+URL_SHORTENER_ASYNC_VIEWS = os.environ.get('URL_SHORTENER_ASYNC_VIEWS') == '1'
+
+# Answer redirects in the first middleware, skipping sessions, CSRF,
+# authentication and DRF (see url_shortener/middleware.py).
+URL_SHORTENER_FAST_REDIRECT = os.environ.get('URL_SHORTENER_FAST_REDIRECT',
+                                             '0') == '1'
+
+# Record request latencies, cache hit ratios and database time, exposed at
+# /metrics in the Prometheus text format.
+URL_SHORTENER_METRICS = True
+
+# Reject unknown short URLs with a per-worker Bloom filter of the issued ones
+# (false positive rate below), and cache the misses for a few seconds.
+URL_SHORTENER_BLOOM_FILTER = True
+URL_SHORTENER_BLOOM_FALSE_POSITIVE_RATE = 0.001
+URL_SHORTENER_NEGATIVE_CACHE_TTL = 30
+
+# Number of most clicked URLs kept in the leaderboard (the maximum `n` of
+# /urls/top/).
+URL_SHORTENER_TOP_SIZE = 1000
+
+# Days the clicks per hour are kept before `manage.py compact_click_stats`
+# folds them into clicks per day.
+URL_SHORTENER_HOURLY_CLICKS_RETENTION_DAYS = 30
+
+# Number of hottest URLs cached by the first worker started after a deploy
+# (0 to disable, see `manage.py warm_cache`), and the maximum number of URLs
+# cached per second.
+URL_SHORTENER_WARM_CACHE_ON_STARTUP = int(
+    os.environ.get('URL_SHORTENER_WARM_CACHE_ON_STARTUP', 0))
+URL_SHORTENER_WARM_CACHE_RATE = 5000
+
+# The last seconds of a cached entry's lifetime during which it is still
+# served while a single request reloads it, and the longest a request waits
+# for another one loading a missing entry before loading it itself.
+URL_SHORTENER_CACHE_STALE_TTL = 60
+URL_SHORTENER_CACHE_LOCK_WAIT = 0.5
+
+# Database aliases the redirect, info and list lookups read from, round
+# robin, and the seconds a replica that failed is skipped.
+URL_SHORTENER_READ_REPLICAS = [
+    alias for alias in DATABASES if alias.startswith('replica')
+]
+URL_SHORTENER_REPLICA_RETRY_AFTER = 30
+
+# Database aliases the URLs are sharded across by short URL (the first one
+# gives the ids), and the shards before the last change until
+# `manage.py rebalance_shards` has moved the URLs to their new shard.
+URL_SHORTENER_SHARDS = [
+    alias for alias in DATABASES if not alias.startswith('replica')
+]
+URL_SHORTENER_PREVIOUS_SHARDS = [
+    alias
+    for alias in os.environ.get('URL_SHORTENER_PREVIOUS_SHARDS', '').split(',')
+    if alias
+]
+
+# Cached URLs of at least this many bytes are stored compressed.
+URL_SHORTENER_CACHE_COMPRESS_MIN_LENGTH = 200
+
+# Ids of new URLs reserved at once by each process, and handed out from
+# memory (see `url_shortener/id_pool.py`; 0 reserves them per create).
+URL_SHORTENER_ID_BLOCK_SIZE = 1000
+
+# Seconds browsers and CDNs may keep the 301 redirects of permanent links and
+# the 302 redirects of the other links, and the info and list responses
+# (0 makes them revalidate every time; see `url_shortener/http_cache.py`).
+URL_SHORTENER_REDIRECT_MAX_AGE = 3600
+URL_SHORTENER_TEMPORARY_REDIRECT_MAX_AGE = 0
+URL_SHORTENER_INFO_MAX_AGE = 0
+URL_SHORTENER_LIST_MAX_AGE = 0
+
+# Database connection errors or timeouts in a row that open the circuit
+# breaker, and the seconds it stays open (see `url_shortener/breaker.py`).
+URL_SHORTENER_BREAKER_FAILURES = 5
+URL_SHORTENER_BREAKER_RESET_AFTER = 10
+
+# File the creates made while the database is unavailable are queued in,
+# and the seconds between the tries to insert them (see
+# `url_shortener/create_queue.py`). Leave it empty to answer them with 503s.
+URL_SHORTENER_CREATE_QUEUE = os.environ.get('URL_SHORTENER_CREATE_QUEUE', '')
+URL_SHORTENER_CREATE_QUEUE_INTERVAL = 5
+
+# Profile the SQL queries and cache calls of the requests sent with an
+# X-Profile header and of this fraction of the others, and write the
+# profiles to this rotating log if set (see `url_shortener/profiling.py`).
+URL_SHORTENER_PROFILE = os.environ.get('URL_SHORTENER_PROFILE') == '1'
+URL_SHORTENER_PROFILE_SAMPLE_RATE = 0
+URL_SHORTENER_PROFILE_LOG = os.environ.get('URL_SHORTENER_PROFILE_LOG', '')
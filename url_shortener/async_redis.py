@@ -0,0 +1,34 @@
+"""
+Asyncio Redis client for the async views.
+
+It talks to the Redis server of the default cache and reads and writes
+entries in the format of ``django_redis``, so both kinds of views share the
+cache.
+"""
+import asyncio
+import weakref
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import profiling
+
+# asyncio clients are bound to the event loop they were created in
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        location = settings.CACHES['default']['LOCATION']
+        if isinstance(location, (list, tuple)):
+            location = location[0]
+        client = _clients[loop] = profiling.AsyncRedisClient.from_url(location)
+    return client
+
+
+async def cache_set(key, value, timeout=None):
+    await get_client().set(cache.make_key(key),
+                           cache.client.encode(value),
+                           ex=timeout or cache.default_timeout)
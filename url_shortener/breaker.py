@@ -0,0 +1,126 @@
+"""
+Circuit breaker around the database.
+
+The views run their queries in `CircuitBreaker.guard`. After
+``URL_SHORTENER_BREAKER_FAILURES`` connection errors or timeouts in a row
+the breaker opens: for ``URL_SHORTENER_BREAKER_RESET_AFTER`` seconds the
+guarded blocks raise `Unavailable` at once, without waiting on the database.
+After that the breaker lets requests through again; the first one that
+succeeds closes it, and the first one that fails opens it for another
+period. The state is kept per process.
+
+While the database is unavailable the views degrade instead of failing:
+redirects and info lookups are answered from the caches, and creates are
+queued (see `create_queue`). Everything else gets a 503 (see
+`middleware.DatabaseBreakerMiddleware`). The connect and statement timeouts
+of the database settings keep a slow database from holding the workers
+until the breaker opens; the maintenance commands lift the statement timeout
+of their own connections with `no_statement_timeout`.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, connections
+
+logger = logging.getLogger(__name__)
+
+# Errors of a database that is down or too slow, rather than of a query
+ERRORS = (OperationalError, InterfaceError)
+
+
+class Unavailable(Exception):
+    """The database is unavailable."""
+
+
+class CircuitBreaker:
+
+    def __init__(self, name):
+        self.name = name
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """Whether calls are refused at once."""
+        opened_at = self._opened_at
+        return (opened_at is not None and time.monotonic() <
+                opened_at + settings.URL_SHORTENER_BREAKER_RESET_AFTER)
+
+    def is_closed(self):
+        return self._opened_at is None
+
+    def retry_after(self):
+        """Seconds before calls are let through again."""
+        if not self.is_open():
+            return 0
+        return max(
+            1,
+            round(self._opened_at +
+                  settings.URL_SHORTENER_BREAKER_RESET_AFTER -
+                  time.monotonic()))
+
+    def success(self):
+        if self._failures or self._opened_at is not None:
+            with self._lock:
+                if self._opened_at is not None:
+                    logger.info('The %s is available again', self.name)
+                self._failures = 0
+                self._opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self._opened_at is not None or
+                    self._failures >= settings.URL_SHORTENER_BREAKER_FAILURES):
+                if self._opened_at is None:
+                    logger.warning('The %s is unavailable', self.name)
+                self._opened_at = time.monotonic()
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    @contextlib.contextmanager
+    def guard(self):
+        """
+        Run the block unless the breaker is open, and record its outcome.
+
+        Raises `Unavailable` if the breaker is open, or if the block fails
+        with one of `ERRORS`.
+        """
+        if self.is_open():
+            raise Unavailable(f'The {self.name} is unavailable')
+        try:
+            yield
+        except ERRORS as e:
+            self.failure()
+            raise Unavailable(f'The {self.name} is unavailable') from e
+        self.success()
+
+
+database = CircuitBreaker('database')
+
+
+@contextlib.contextmanager
+def no_statement_timeout(aliases=None):
+    """
+    Lift the statement timeout of the connections to ``aliases`` (the shards
+    by default) in the block, for commands that run long statements.
+    """
+    aliases = [
+        alias for alias in aliases or settings.URL_SHORTENER_SHARDS
+        if connections[alias].vendor == 'postgresql'
+    ]
+    for alias in aliases:
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SET statement_timeout = 0')
+    try:
+        yield
+    finally:
+        for alias in aliases:
+            with connections[alias].cursor() as cursor:
+                cursor.execute('RESET statement_timeout')
@@ -0,0 +1,136 @@
+"""
+Clicks per URL and per hour or day.
+
+Redirects count their clicks per hour next to the click counters (see
+`clicks`), and each flush adds them to the hourly ``ClickBucket`` rows with
+one upsert per batch. ``compact`` later folds the hourly buckets older than
+``URL_SHORTENER_HOURLY_CLICKS_RETENTION_DAYS`` into daily ones.
+"""
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from django.db import connections, router, transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDay
+
+from . import sharding
+from .models import ClickBucket, Url
+
+BATCH_SIZE = 500
+# Range of the stats when no bounds are given
+DEFAULT_RANGES = {
+    ClickBucket.HOUR: timedelta(days=1),
+    ClickBucket.DAY: timedelta(days=30),
+}
+
+
+def hour_field(short_url, timestamp):
+    """Field of the hourly counter of ``short_url`` at ``timestamp``."""
+    return f'{short_url}:{int(timestamp) // 3600 * 3600}'
+
+
+def add_hourly(counts, using=None):
+    """
+    Add ``counts``, a map of `hour_field` to clicks, to the buckets of the
+    URLs stored on ``using``.
+    """
+    hours = Counter()
+    for field, count in counts.items():
+        short_url, _, start = field.rpartition(':')
+        hours[short_url, int(start)] += count
+    ids = dict(
+        Url.objects.using(using).filter(
+            short_url__in={short_url
+                           for short_url, _ in hours}).values_list(
+                               'short_url', 'id'))
+    # Clicks of URLs deleted since (or on another shard) are dropped
+    add([(ids[short_url], ClickBucket.HOUR,
+          datetime.fromtimestamp(start, timezone.utc), count)
+         for (short_url, start), count in hours.items() if short_url in ids],
+        using)
+
+
+def add(rows, using=None):
+    """
+    Add ``rows`` of ``(url_id, granularity, start, count)`` to the buckets.
+
+    Each batch is a single ``INSERT ... ON CONFLICT DO UPDATE`` adding the
+    counts to the existing buckets.
+    """
+    totals = Counter()
+    for url_id, granularity, start, count in rows:
+        totals[url_id, granularity, start] += count
+    rows = [key + (count, ) for key, count in totals.items()]
+    connection = connections[using or router.db_for_write(ClickBucket)]
+    qn = connection.ops.quote_name
+    table = qn(ClickBucket._meta.db_table)
+    start_field = ClickBucket._meta.get_field('start')
+    key = f'{qn("url_id")}, {qn("granularity")}, {qn("start")}'
+    for i in range(0, len(rows), BATCH_SIZE):
+        batch = rows[i:i + BATCH_SIZE]
+        sql = (f'INSERT INTO {table} ({key}, {qn("count")}) '
+               f'VALUES {", ".join(["(%s, %s, %s, %s)"] * len(batch))} '
+               f'ON CONFLICT ({key}) DO UPDATE SET {qn("count")} = '
+               f'{table}.{qn("count")} + EXCLUDED.{qn("count")}')
+        params = [
+            value for url_id, granularity, start, count in batch
+            for value in (url_id, granularity,
+                          start_field.get_db_prep_save(start, connection),
+                          count)
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+
+def compact(before, batch_size=5000):
+    """
+    Fold the hourly buckets of the days before ``before`` into daily ones.
+
+    Buckets are moved ``batch_size`` at a time, each batch in its own
+    transaction with its rows locked, so clicks flushed meanwhile are not
+    lost. Returns the number of hourly buckets removed.
+    """
+    before = before.astimezone(timezone.utc).replace(hour=0,
+                                                     minute=0,
+                                                     second=0,
+                                                     microsecond=0)
+    removed = 0
+    for shard in sharding.all_shards():
+        using = shard or router.db_for_write(ClickBucket)
+        hourly = ClickBucket.objects.using(using).filter(
+            granularity=ClickBucket.HOUR, start__lt=before)
+        while True:
+            with transaction.atomic(using=using):
+                rows = list(
+                    hourly.select_for_update().order_by('start').values_list(
+                        'id', 'url_id', 'start', 'count')[:batch_size])
+                if not rows:
+                    break
+                add([(url_id, ClickBucket.DAY, start.astimezone(
+                    timezone.utc).replace(hour=0), count)
+                     for _, url_id, start, count in rows], using)
+                ClickBucket.objects.using(using).filter(
+                    id__in=[row[0] for row in rows]).delete()
+                removed += len(rows)
+    return removed
+
+
+def buckets(url, granularity, start, end):
+    """
+    Return ``(bucket start, clicks)`` of ``url`` from ``start`` to ``end``.
+
+    Days include the clicks of their hourly buckets not compacted yet. Hours
+    older than the retention are only available as days.
+    """
+    queryset = ClickBucket.objects.using(url._state.db).filter(
+        url=url, start__gte=start, start__lt=end)
+    if granularity == ClickBucket.HOUR:
+        return list(
+            queryset.filter(
+                granularity=ClickBucket.HOUR).order_by('start').values_list(
+                    'start', 'count'))
+    return list(
+        queryset.annotate(
+            day=TruncDay('start', tzinfo=timezone.utc)).values('day').annotate(
+                clicks=Sum('count')).order_by('day').values_list(
+                    'day', 'clicks'))
@@ -0,0 +1,247 @@
+"""
+Write-behind buffer for redirect clicks.
+
+A redirect only increments a counter in a Redis hash (``HINCRBY``), and the
+counter of the current hour in a second hash (see `click_stats`). The
+pending counters are applied to ``Url.on_clicks`` and to the click buckets
+in bulk by ``flush``, which is run periodically by a per-process flusher
+thread and by the ``flush_clicks`` management command.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connections, router, transaction
+from django_redis import get_redis_connection
+
+from . import (async_redis, breaker, click_stats, entries, leaderboard,
+               metrics, sharding)
+from .models import Url
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = 'url_shortener:clicks'
+FLUSHING_KEY = 'url_shortener:clicks:flushing'
+HOURLY_PENDING_KEY = 'url_shortener:clicks:hourly'
+HOURLY_FLUSHING_KEY = 'url_shortener:clicks:hourly:flushing'
+LOCK_KEY = 'url_shortener:clicks:lock'
+FLUSHED_AT_KEY = 'url_shortener:clicks:flushed_at'
+BATCH_SIZE = 500
+
+
+def _redis():
+    return get_redis_connection('default')
+
+
+def record(short_url):
+    """Count one click and return the number of clicks pending for it."""
+    pipe = _redis().pipeline(transaction=False)
+    pipe.hincrby(PENDING_KEY, short_url, 1)
+    pipe.hincrby(HOURLY_PENDING_KEY,
+                 click_stats.hour_field(short_url, time.time()), 1)
+    count = pipe.execute()[0]
+    flusher.start()
+    return count
+
+
+async def arecord(short_url):
+    pipe = async_redis.get_client().pipeline(transaction=False)
+    pipe.hincrby(PENDING_KEY, short_url, 1)
+    pipe.hincrby(HOURLY_PENDING_KEY,
+                 click_stats.hour_field(short_url, time.time()), 1)
+    count = (await pipe.execute())[0]
+    flusher.start()
+    return count
+
+
+def pending(short_url):
+    """Return the number of clicks not yet applied to the database."""
+    pipe = _redis().pipeline(transaction=False)
+    pipe.hget(PENDING_KEY, short_url)
+    pipe.hget(FLUSHING_KEY, short_url)
+    return sum(int(value) for value in pipe.execute() if value)
+
+
+async def apending(short_url):
+    pipe = async_redis.get_client().pipeline(transaction=False)
+    pipe.hget(PENDING_KEY, short_url)
+    pipe.hget(FLUSHING_KEY, short_url)
+    return sum(int(value) for value in await pipe.execute() if value)
+
+
+def flush():
+    """
+    Apply the pending clicks to the database.
+
+    The pending hashes are renamed before they are read, so clicks recorded
+    during the flush go to fresh hashes. The clicks of each shard are removed
+    from the renamed hashes as soon as they are committed; if applying fails,
+    the others are kept and retried by the next flush, as they are while the
+    database is unavailable (see `breaker`). Updating the leaderboard and the
+    cached counts afterwards is best effort. Returns the number of URLs
+    updated.
+    """
+    client = _redis()
+    lock = client.lock(LOCK_KEY, timeout=300)
+    if not lock.acquire(blocking=False):
+        return 0
+    start = time.perf_counter()
+    try:
+        if not client.exists(FLUSHING_KEY, HOURLY_FLUSHING_KEY):
+            pipe = client.pipeline()
+            pipe.rename(PENDING_KEY, FLUSHING_KEY)
+            pipe.rename(HOURLY_PENDING_KEY, HOURLY_FLUSHING_KEY)
+            # Fails for the hashes that do not exist, nothing to flush there
+            pipe.execute(raise_on_error=False)
+        pipe = client.pipeline(transaction=False)
+        pipe.hgetall(FLUSHING_KEY)
+        pipe.hgetall(HOURLY_FLUSHING_KEY)
+        counts, hourly = [{
+            field.decode(): int(count)
+            for field, count in values.items()
+        } for values in pipe.execute()]
+        rows = []
+        if counts or hourly:
+
+            def applied(short_urls, fields):
+                pipe = client.pipeline()
+                if short_urls:
+                    pipe.hdel(FLUSHING_KEY, *short_urls)
+                if fields:
+                    pipe.hdel(HOURLY_FLUSHING_KEY, *fields)
+                pipe.execute()
+
+            with breaker.database.guard():
+                rows = apply(counts, hourly, applied)
+        pipe = client.pipeline()
+        pipe.delete(FLUSHING_KEY, HOURLY_FLUSHING_KEY)
+        pipe.set(FLUSHED_AT_KEY, time.time())
+        pipe.execute()
+        if counts:
+            try:
+                leaderboard.update(rows)
+                # Cached metadata holds the flushed count; reload it on next
+                # use
+                entries.delete_meta(list(counts))
+            except Exception:
+                logger.exception('Updating the leaderboard and cached '
+                                 'counts after a flush failed')
+            metrics.click_flush_duration.observe(time.perf_counter() - start)
+            metrics.clicks_flushed.inc(amount=sum(counts.values()))
+        return len(counts)
+    finally:
+        lock.release()
+
+
+def apply(counts, hourly=None, applied=None):
+    """
+    Add ``counts`` (a ``short_url -> clicks`` map) to ``Url.on_clicks`` and
+    ``hourly`` to the hourly click buckets, in one transaction per shard.
+
+    ``applied`` is called with the short URLs and hourly fields of each shard
+    once they are committed. Returns the ``(short_url, url, on_clicks)`` of
+    the URLs updated.
+    """
+    hourly = hourly or {}
+    short_urls = set(counts)
+    short_urls.update(field.rpartition(':')[0] for field in hourly)
+    rows = []
+    for shard, group in sharding.by_short_url(short_urls).items():
+        group = set(group)
+        items = [(short_url, count) for short_url, count in counts.items()
+                 if short_url in group]
+        shard_hourly = {
+            field: count
+            for field, count in hourly.items()
+            if field.rpartition(':')[0] in group
+        }
+        rows += _apply_on(shard, items, shard_hourly)
+        if applied:
+            applied([short_url for short_url, _ in items], list(shard_hourly))
+    return rows
+
+
+def _apply_on(shard, items, hourly):
+    connection = connections[shard or router.db_for_write(Url)]
+    qn = connection.ops.quote_name
+    table = qn(Url._meta.db_table)
+    rows = []
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            for i in range(0, len(items), BATCH_SIZE):
+                batch = items[i:i + BATCH_SIZE]
+                # A single statement returning the new totals
+                sql = (f'UPDATE {table} SET {qn("on_clicks")} = '
+                       f'{qn("on_clicks")} + CASE {qn("short_url")} '
+                       f'{" ".join(["WHEN %s THEN %s"] * len(batch))} '
+                       f'ELSE 0 END WHERE {qn("short_url")} IN '
+                       f'({", ".join(["%s"] * len(batch))}) '
+                       f'RETURNING {qn("short_url")}, {qn("url")}, '
+                       f'{qn("on_clicks")}')
+                cursor.execute(sql,
+                               [value for item in batch for value in item] +
+                               [short_url for short_url, _ in batch])
+                rows += cursor.fetchall()
+        if hourly:
+            click_stats.add_hourly(hourly, shard)
+    return rows
+
+
+class Flusher:
+    """Background thread flushing the click buffer every few seconds."""
+
+    def __init__(self):
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            interval = settings.URL_SHORTENER_CLICK_FLUSH_INTERVAL
+            if interval:
+                threading.Thread(target=self._run,
+                                 args=(interval, ),
+                                 name='click-flusher',
+                                 daemon=True).start()
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                flush()
+            except breaker.Unavailable:
+                # The clicks are kept in Redis until the database is back
+                pass
+            except Exception:
+                logger.exception('Flushing clicks failed')
+            finally:
+                close_old_connections()
+
+
+flusher = Flusher()
+
+
+def _collect_pending_urls():
+    pipe = _redis().pipeline(transaction=False)
+    pipe.hlen(PENDING_KEY)
+    pipe.hlen(FLUSHING_KEY)
+    return {(): sum(pipe.execute())}
+
+
+def _collect_flush_lag():
+    flushed_at = _redis().get(FLUSHED_AT_KEY)
+    return {(): time.time() - float(flushed_at) if flushed_at else 0}
+
+
+metrics.Collected('url_shortener_click_pending_urls',
+                  'Short URLs with clicks not applied to the database yet.',
+                  'gauge', _collect_pending_urls)
+metrics.Collected(
+    'url_shortener_click_flush_lag_seconds',
+    'Seconds since the last flush of the clicks, by any worker.', 'gauge',
+    _collect_flush_lag)
@@ -0,0 +1,106 @@
+"""
+Short code generation.
+
+The generator configured by ``URL_SHORTENER_CODE_GENERATOR`` turns the id of a
+new ``Url`` into its short code before the row is inserted. The default
+generator is collision free: it permutes the id with a keyed Feistel network
+and writes the result in base 62, so consecutive ids get unrelated codes.
+"""
+import hashlib
+import string
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+ALPHABET = string.ascii_letters + string.digits
+
+
+def base62_encode(number, length):
+    chars = []
+    for _ in range(length):
+        number, digit = divmod(number, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    if number:
+        raise ValueError('Number too large to encode')
+    return ''.join(reversed(chars))
+
+
+def base62_decode(code):
+    number = 0
+    for char in code:
+        digit = ALPHABET.find(char)
+        if digit < 0:
+            raise ValueError(f'Invalid character {char!r}')
+        number = number * len(ALPHABET) + digit
+    return number
+
+
+class FeistelCodeGenerator:
+    """
+    Bijective mapping between ids and fixed length base 62 codes.
+
+    The id is permuted with a balanced Feistel network over the smallest even
+    number of bits covering ``62 ** length`` values; results outside that
+    range are permuted again (cycle walking), which keeps the mapping a
+    bijection on ``range(62 ** length)``.
+    """
+    rounds = 4
+
+    def __init__(self, key=None, length=None):
+        key = key if key is not None else settings.URL_SHORTENER_CODE_KEY
+        if isinstance(key, str):
+            key = key.encode()
+        self.length = length or settings.URL_SHORTENER_CODE_LENGTH
+        self.space = len(ALPHABET)**self.length
+        self.half_bits = ((self.space - 1).bit_length() + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+        self.round_keys = [
+            hashlib.blake2b(key, digest_size=32,
+                            person=b'round%d' % i).digest()
+            for i in range(self.rounds)
+        ]
+
+    def _f(self, value, i):
+        digest = hashlib.blake2b(value.to_bytes(8, 'big'),
+                                 key=self.round_keys[i],
+                                 digest_size=8).digest()
+        return int.from_bytes(digest, 'big') & self.mask
+
+    def permute(self, number):
+        while True:
+            left, right = number >> self.half_bits, number & self.mask
+            for i in range(self.rounds):
+                left, right = right, left ^ self._f(right, i)
+            number = (left << self.half_bits) | right
+            if number < self.space:
+                return number
+
+    def unpermute(self, number):
+        while True:
+            left, right = number >> self.half_bits, number & self.mask
+            for i in reversed(range(self.rounds)):
+                left, right = right ^ self._f(left, i), left
+            number = (left << self.half_bits) | right
+            if number < self.space:
+                return number
+
+    def generate(self, id):
+        if not 0 <= id < self.space:
+            raise ValueError(f'Id {id} is out of the code space')
+        return base62_encode(self.permute(id), self.length)
+
+    def decode(self, code):
+        """Return the id ``code`` was generated from."""
+        if len(code) != self.length:
+            raise ValueError('Invalid code length')
+        return self.unpermute(base62_decode(code))
+
+
+@lru_cache(maxsize=None)
+def get_generator():
+    return import_string(settings.URL_SHORTENER_CODE_GENERATOR)()
+
+
+def generate(id):
+    return get_generator().generate(id)
@@ -0,0 +1,118 @@
+"""
+Durable queue of the creates accepted while the database is unavailable.
+
+With ``URL_SHORTENER_CREATE_QUEUE`` set to a file path, a create that
+cannot reach the database (see `breaker`) is validated, appended to that
+file as a JSON line and synced to disk, and answered with a 202 without a
+short URL: the short URL needs an id from the database, and the URL may
+already have been shortened. The worker that queued it then tries every
+``URL_SHORTENER_CREATE_QUEUE_INTERVAL`` seconds to `replay` the queue, and
+``manage.py replay_creates`` does the same by hand.
+
+A replay validates the queued creates again (a link that expired meanwhile
+is dropped), inserts them like the bulk create, and empties the file. The
+file is locked while it is appended to or replayed, so the workers of a
+host can share it. A replay that fails leaves the file as it was; the URLs
+it inserted are then skipped as already shortened by the next one.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import breaker, entries, listing, serializers
+from .models import Url
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+def enabled():
+    return bool(settings.URL_SHORTENER_CREATE_QUEUE)
+
+
+def put(data):
+    """Queue a create of the validated ``data`` of a `UrlSerializer`."""
+    line = json.dumps(data, cls=JSONEncoder) + '\n'
+    with open(settings.URL_SHORTENER_CREATE_QUEUE, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    replayer.start()
+
+
+def replay():
+    """Insert the queued creates, and return the number of URLs created."""
+    try:
+        f = open(settings.URL_SHORTENER_CREATE_QUEUE, 'r+')
+    except FileNotFoundError:
+        return 0
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        objs = []
+        for line in f:
+            serializer = serializers.UrlSerializer(data=json.loads(line))
+            if serializer.is_valid():
+                objs.append(Url(**serializer.validated_data))
+            else:
+                logger.warning('Dropped a queued create: %s',
+                               serializer.errors)
+        created = []
+        for i in range(0, len(objs), BATCH_SIZE):
+            with breaker.database.guard():
+                created += Url.objects.insert_new(objs[i:i + BATCH_SIZE])
+        if created:
+            entries.set_many(created)
+            listing.invalidate_first_pages()
+        f.truncate(0)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(created)
+
+
+class Replayer:
+    """Background thread replaying the queue once the database is back."""
+
+    def __init__(self):
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            threading.Thread(
+                target=self._run,
+                args=(settings.URL_SHORTENER_CREATE_QUEUE_INTERVAL, ),
+                name='create-queue',
+                daemon=True).start()
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            if breaker.database.is_open():
+                continue
+            try:
+                created = replay()
+                if created:
+                    logger.info('Created %d queued URLs', created)
+            except breaker.Unavailable:
+                pass
+            except Exception:
+                logger.exception('Replaying the queued creates failed')
+            finally:
+                close_old_connections()
+
+
+replayer = Replayer()
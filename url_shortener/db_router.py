@@ -0,0 +1,141 @@
+"""
+Routing of the read-only lookups to read replicas.
+
+The redirect, info and list lookups run their queries in `replica_reads`,
+which picks one of ``URL_SHORTENER_READ_REPLICAS`` round robin. Every other
+query, including the reads that must see the writes of the request, goes to
+the primary. A replica that cannot be connected to is skipped for
+``URL_SHORTENER_REPLICA_RETRY_AFTER`` seconds, and the primary is used when
+no replica is available. The lookups run with `read` are also run again on
+the primary when their replica fails during the queries, and the replica is
+skipped the same way; its errors are not counted by `breaker`.
+
+Replicas lag behind the primary: a lookup that does not find a row on a
+replica has to look it up again on the primary before reporting it missing.
+"""
+import contextlib
+import contextvars
+import itertools
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from . import breaker, models, sharding
+
+logger = logging.getLogger(__name__)
+
+_replica = contextvars.ContextVar('replica', default=None)
+_turns = itertools.count()
+# Replicas that failed, with the time they are tried again
+_down = {}
+
+
+def pick():
+    """Return the alias of an available replica, or of the primary."""
+    replicas = settings.URL_SHORTENER_READ_REPLICAS
+    turn = next(_turns)
+    for i in range(len(replicas)):
+        alias = replicas[(turn + i) % len(replicas)]
+        if _down.get(alias, 0) > time.monotonic():
+            continue
+        try:
+            connections[alias].ensure_connection()
+        except DatabaseError:
+            _mark_down(alias)
+            continue
+        return alias
+    return DEFAULT_DB_ALIAS
+
+
+def _mark_down(alias):
+    logger.warning('Read replica %s is unavailable', alias)
+    _down[alias] = (time.monotonic() +
+                    settings.URL_SHORTENER_REPLICA_RETRY_AFTER)
+    with contextlib.suppress(DatabaseError):
+        connections[alias].close()
+
+
+@contextlib.contextmanager
+def replica_reads():
+    """Send the reads run in the block to a replica, and yield its alias."""
+    # Sharded URLs are read from their shard
+    alias = DEFAULT_DB_ALIAS if sharding.enabled() else pick()
+    token = _replica.set(alias)
+    try:
+        yield alias
+    finally:
+        _replica.reset(token)
+
+
+@contextlib.asynccontextmanager
+async def areplica_reads():
+    alias = DEFAULT_DB_ALIAS
+    if settings.URL_SHORTENER_READ_REPLICAS and not sharding.enabled():
+        alias = await sync_to_async(pick)()
+    token = _replica.set(alias)
+    try:
+        yield alias
+    finally:
+        _replica.reset(token)
+
+
+def read(func):
+    """
+    Run ``func`` with its reads sent to a replica, and return its result and
+    the alias it read from. If the replica fails, ``func`` is run again on
+    the primary.
+    """
+    with replica_reads() as alias:
+        try:
+            return func(), alias
+        except breaker.ERRORS:
+            if alias == DEFAULT_DB_ALIAS:
+                raise
+            _mark_down(alias)
+    return func(), DEFAULT_DB_ALIAS
+
+
+async def aread(func):
+    async with areplica_reads() as alias:
+        try:
+            return await func(), alias
+        except breaker.ERRORS:
+            if alias == DEFAULT_DB_ALIAS:
+                raise
+            await sync_to_async(_mark_down)(alias)
+    return await func(), DEFAULT_DB_ALIAS
+
+
+class ReplicaRouter:
+    """
+    Route the reads of `replica_reads` blocks to their replica, and the
+    writes of URLs to their shard (see `sharding`).
+    """
+
+    def db_for_read(self, model, **hints):
+        return _replica.get()
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is None:
+            return DEFAULT_DB_ALIAS
+        # New URLs go to the shard of their digest; the URLs created before
+        # sharding and moved by rebalance stay where they were loaded from
+        if (sharding.enabled() and isinstance(instance, models.Url)
+                and instance._state.adding and instance.url_hash is not None):
+            return sharding.shard_for_digest(instance.url_hash)
+        if instance._state.db in settings.URL_SHORTENER_READ_REPLICAS:
+            return DEFAULT_DB_ALIAS
+        return instance._state.db
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema from the primary
+        if db in settings.URL_SHORTENER_READ_REPLICAS:
+            return False
+        return None
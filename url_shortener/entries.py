@@ -0,0 +1,231 @@
+"""
+Compact cache entries of the short URLs.
+
+A short URL is cached under two keys. Its own key holds the URL it points to
+as plain bytes, which is all a redirect reads; URLs of at least
+``URL_SHORTENER_CACHE_COMPRESS_MIN_LENGTH`` bytes are stored compressed with
+zlib, after a NUL byte no URL starts with, when that is shorter. The URL of
+a link that expires comes after a ``\x01`` byte and its expiry, and the URL
+of a link redirected with a 302 (see `http_cache`) after a ``\x02`` byte. The
+``<short_url>:meta`` key holds ``on_clicks`` and ``created`` packed in 16
+bytes. Click flushes only drop the ``:meta`` keys, so redirects keep being
+served from the cache.
+
+Both keys expire with the link, or after the default timeout of the cache if
+that comes first.
+
+Negative entries (see `known_codes`) are still written by ``django_redis``,
+and so are the pickled ``{'url', 'on_clicks', 'created'}`` dicts written by
+older versions: both are read here too. ``manage.py migrate_cache_entries``
+rewrites the old dicts in the new format.
+"""
+import struct
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from . import async_redis, known_codes
+
+META_SUFFIX = ':meta'
+COMPRESSED = b'\x00'
+EXPIRING = b'\x01'
+TEMPORARY = b'\x02'
+# First byte of the values pickled by django_redis
+PICKLED = b'\x80'
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+# on_clicks, and created in microseconds since the epoch
+_meta = struct.Struct('>qq')
+_expiry = struct.Struct('>q')
+
+Target = namedtuple('Target', 'url expires_at permanent')
+
+
+def meta_key(short_url):
+    return short_url + META_SUFFIX
+
+
+def _micros(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def _datetime(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def encode_target(url, expires_at=None, permanent=True):
+    value = url.encode()
+    if len(value) >= settings.URL_SHORTENER_CACHE_COMPRESS_MIN_LENGTH:
+        compressed = COMPRESSED + zlib.compress(value)
+        if len(compressed) < len(value):
+            value = compressed
+    if expires_at is not None:
+        value = EXPIRING + _expiry.pack(_micros(expires_at)) + value
+    if not permanent:
+        value = TEMPORARY + value
+    return value
+
+
+def decode_target(value):
+    """Return the `Target` of a cached short URL, or `known_codes.MISSING`."""
+    permanent = not value.startswith(TEMPORARY)
+    if not permanent:
+        value = value[1:]
+    expires_at = None
+    if value.startswith(EXPIRING):
+        expires_at = _datetime(_expiry.unpack_from(value, 1)[0])
+        value = value[1 + _expiry.size:]
+    if value.startswith(COMPRESSED):
+        return Target(
+            zlib.decompress(value[1:]).decode(), expires_at, permanent)
+    if value.startswith(PICKLED):
+        value = cache.client.decode(value)
+        if value == known_codes.MISSING:
+            return value
+        return Target(value['url'], None, True)
+    return Target(value.decode(), expires_at, permanent)
+
+
+def encode_meta(on_clicks, created):
+    return _meta.pack(on_clicks, _micros(created))
+
+
+def decode_meta(value):
+    on_clicks, created = _meta.unpack(value)
+    return {'on_clicks': on_clicks, 'created': _datetime(created)}
+
+
+def timeout(expires_at):
+    """Milliseconds an entry of a link expiring at ``expires_at`` is kept."""
+    if cache.default_timeout is None:
+        default = None
+    else:
+        default = int(cache.default_timeout * 1000)
+    if expires_at is None:
+        return default
+    remaining = (expires_at - timezone.now()) // timedelta(milliseconds=1)
+    return max(1, remaining if default is None else min(remaining, default))
+
+
+def write(pipe,
+          short_url,
+          url,
+          on_clicks,
+          created,
+          expires_at=None,
+          permanent=True,
+          nx=False):
+    """Queue the writes of the entry of ``short_url`` on ``pipe``."""
+    px = timeout(expires_at)
+    pipe.set(cache.make_key(short_url),
+             encode_target(url, expires_at, permanent),
+             px=px,
+             nx=nx)
+    pipe.set(cache.make_key(meta_key(short_url)),
+             encode_meta(on_clicks, created),
+             px=px,
+             nx=nx)
+
+
+def _write_obj(pipe, obj):
+    write(pipe, obj.short_url, obj.url, obj.on_clicks, obj.created,
+          obj.expires_at, obj.permanent)
+
+
+def set_many(objs):
+    """Cache the entries of the `Url` ``objs``."""
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for obj in objs:
+        _write_obj(pipe, obj)
+    pipe.execute()
+
+
+async def aset(obj):
+    pipe = async_redis.get_client().pipeline(transaction=False)
+    _write_obj(pipe, obj)
+    await pipe.execute()
+
+
+def get(short_url):
+    """
+    Return the cached ``url``, ``expires_at``, ``permanent``, ``on_clicks``
+    and ``created`` of ``short_url``, `known_codes.MISSING`, or ``None`` if
+    not cached.
+    """
+    target, meta = get_redis_connection('default').mget(
+        cache.make_key(short_url), cache.make_key(meta_key(short_url)))
+    if target is None:
+        return None
+    if target.startswith(PICKLED):
+        return cache.client.decode(target)
+    if meta is None:
+        return None
+    return {**decode_target(target)._asdict(), **decode_meta(meta)}
+
+
+def delete(short_urls):
+    """Drop the entries of ``short_urls``."""
+    keys = [
+        cache.make_key(key) for short_url in short_urls
+        for key in (short_url, meta_key(short_url))
+    ]
+    if keys:
+        get_redis_connection('default').delete(*keys)
+
+
+def delete_meta(short_urls):
+    """Drop the ``on_clicks`` and ``created`` of ``short_urls``."""
+    keys = [cache.make_key(meta_key(short_url)) for short_url in short_urls]
+    if keys:
+        get_redis_connection('default').delete(*keys)
+
+
+def migrate(batch_size=1000):
+    """
+    Rewrite the entries cached by older versions in the new format, keeping
+    their expiry, and return the number of entries rewritten.
+    """
+    client = get_redis_connection('default')
+    migrated = 0
+    keys = []
+    for key in client.scan_iter(cache.make_key('*'), count=batch_size):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            migrated += _migrate(client, keys)
+            keys = []
+    if keys:
+        migrated += _migrate(client, keys)
+    return migrated
+
+
+def _migrate(client, keys):
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.get(key)
+        pipe.pttl(key)
+    # Keys that are not strings fail
+    values = pipe.execute(raise_on_error=False)
+    pipe = client.pipeline(transaction=False)
+    migrated = 0
+    for key, value, ttl in zip(keys, values[::2], values[1::2]):
+        if not isinstance(value, bytes) or not value.startswith(PICKLED):
+            continue
+        entry = cache.client.decode(value)
+        if not isinstance(
+                entry, dict) or set(entry) != {'url', 'on_clicks', 'created'}:
+            continue
+        # The key without the prefix and version of make_key
+        short_url = key.decode().split(':', 2)[2]
+        write(pipe, short_url, entry['url'], entry['on_clicks'],
+              entry['created'])
+        if ttl > 0:
+            pipe.pexpire(key, ttl)
+            pipe.pexpire(cache.make_key(meta_key(short_url)), ttl)
+        migrated += 1
+    pipe.execute()
+    return migrated
@@ -0,0 +1,57 @@
+"""
+Purge of the expired links.
+
+Expired links are not found by the redirect and info lookups, and their
+cache entries expire with them (see `entries`). `purge` deletes their rows,
+with their click buckets, ``batch_size`` at a time through the partial index
+on ``expires_at``, so that the table and the leaderboard only hold the live
+links.
+"""
+import time
+
+from django.utils import timezone
+
+from . import entries, leaderboard, listing, sharding
+from .models import Url
+
+
+def purge(batch_size=1000, pause=0, progress=None):
+    """
+    Delete the links expired by now and return the number deleted.
+
+    Batches are ``pause`` seconds apart, and ``progress`` is called with the
+    number of links deleted after each one.
+    """
+    now = timezone.now()
+    purged = 0
+    for shard in sharding.all_shards():
+        expired = Url.objects.using(shard).filter(
+            expires_at__lte=now).order_by('expires_at')
+        while True:
+            batch = list(expired.values_list('pk', 'short_url')[:batch_size])
+            if not batch:
+                break
+            Url.objects.using(shard).filter(
+                pk__in=[pk for pk, _ in batch]).delete()
+            forget([short_url for _, short_url in batch if short_url],
+                   all_pages=False)
+            purged += len(batch)
+            if progress:
+                progress(purged)
+            if pause:
+                time.sleep(pause)
+    if purged:
+        # Expired links can be on any page
+        listing.invalidate_all_pages()
+    return purged
+
+
+def forget(short_urls, all_pages=True):
+    """
+    Drop the deleted links ``short_urls`` from the caches and the
+    leaderboard, and the cached list pages unless ``all_pages`` is false.
+    """
+    entries.delete(short_urls)
+    leaderboard.remove(*short_urls)
+    if all_pages:
+        listing.invalidate_all_pages()
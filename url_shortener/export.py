@@ -0,0 +1,83 @@
+"""
+Streaming export of the URLs as NDJSON or CSV.
+
+Rows are read with a server-side cursor (one per shard, merged in id order)
+and rendered one at a time, so the memory used does not depend on the number
+of URLs exported.
+"""
+import csv
+import json
+from datetime import datetime, time
+from operator import itemgetter
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import sharding
+from .models import Url
+
+FIELDS = ('url', 'short_url', 'on_clicks', 'created')
+
+
+def parse_bound(value):
+    """Parse a ``created`` bound given as a date or a datetime."""
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(f'Invalid date: {value}')
+        parsed = datetime.combine(date, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def rows(created_from=None, created_to=None, min_clicks=None, chunk_size=None):
+    """
+    Iterate over the URLs as tuples of ``FIELDS``, in id order.
+
+    ``created_from`` is inclusive and ``created_to`` exclusive, so
+    consecutive ranges export every URL once.
+    """
+    queryset = Url.objects.order_by('id')
+    if created_from is not None:
+        queryset = queryset.filter(created__gte=created_from)
+    if created_to is not None:
+        queryset = queryset.filter(created__lt=created_to)
+    if min_clicks is not None:
+        queryset = queryset.filter(on_clicks__gte=min_clicks)
+    rows = sharding.merge(queryset.values_list(*FIELDS, 'id'),
+                          itemgetter(len(FIELDS)),
+                          chunk_size=chunk_size
+                          or settings.URL_SHORTENER_EXPORT_CHUNK_SIZE)
+    return (row[:len(FIELDS)] for row in rows)
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(FIELDS, row)), cls=JSONEncoder) + '\n'
+
+
+class _Echo:
+    """File-like object returning what is written, for ``csv.writer``."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(FIELDS)
+    for url, short_url, on_clicks, created in rows:
+        yield writer.writerow((url, short_url, on_clicks, created.isoformat()))
+
+
+# format -> (line renderer, content type)
+FORMATS = {
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+    'csv': (csv_lines, 'text/csv'),
+}
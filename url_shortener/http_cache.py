@@ -0,0 +1,75 @@
+"""
+HTTP caching headers, so that browsers and CDNs absorb repeated reads.
+
+Redirects of permanent links are 301s kept ``URL_SHORTENER_REDIRECT_MAX_AGE``
+seconds; the clicks they absorb are not counted. Links created with
+``permanent`` false get 302s kept ``URL_SHORTENER_TEMPORARY_REDIRECT_MAX_AGE``
+seconds (not kept with 0), so that most of their clicks still reach us. The
+redirects of an expiring link are never kept past its expiry.
+
+The info and list responses carry an ``ETag`` (and the list pages a
+``Last-Modified``), and a request whose validators match gets a 304 without
+a body. Shared caches keep them ``URL_SHORTENER_INFO_MAX_AGE`` and
+``URL_SHORTENER_LIST_MAX_AGE`` seconds, and revalidate them after that.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.http import HttpResponsePermanentRedirect, HttpResponseRedirect
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def cache_control(max_age):
+    if max_age > 0:
+        return f'public, max-age={max_age}'
+    return 'no-cache'
+
+
+def redirect(target):
+    """Return the redirect response to the `entries.Target` ``target``."""
+    if target.permanent:
+        response = HttpResponsePermanentRedirect(target.url)
+        max_age = settings.URL_SHORTENER_REDIRECT_MAX_AGE
+    else:
+        response = HttpResponseRedirect(target.url)
+        max_age = settings.URL_SHORTENER_TEMPORARY_REDIRECT_MAX_AGE
+    if target.expires_at is not None:
+        max_age = min(
+            max_age, int((target.expires_at - timezone.now()).total_seconds()))
+    response['Cache-Control'] = cache_control(max_age)
+    return response
+
+
+def etag(data):
+    """Strong ``ETag`` of the JSON ``data``."""
+    content = json.dumps(data, cls=JSONEncoder, sort_keys=True).encode()
+    return quote_etag(hashlib.blake2b(content, digest_size=16).hexdigest())
+
+
+def not_modified(request, etag, last_modified=None):
+    """
+    Return a 304 response if the validators of ``request`` match, or
+    ``None``.
+    """
+    return get_conditional_response(request,
+                                    etag=etag,
+                                    last_modified=last_modified)
+
+
+def add_validators(response, etag, last_modified=None, max_age=0):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = cache_control(max_age)
+    return response
+
+
+def stale(response):
+    """Mark ``response``, served from the caches only, as stale."""
+    response['Warning'] = '110 - "Response is Stale"'
+    response['Cache-Control'] = 'no-cache'
+    return response
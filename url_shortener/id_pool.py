@@ -0,0 +1,89 @@
+"""
+Ids of new URLs reserved from the primary key sequence in blocks.
+
+A new URL gets its id, and so its short URL (see `codes`), before it is
+inserted. Instead of a ``nextval`` round trip per create, each process
+reserves ``URL_SHORTENER_ID_BLOCK_SIZE`` ids at once and hands them out from
+memory; when less than a fifth of a block is left, a background thread
+reserves the next block, so creates rarely wait for it. The ids come from
+the sequence and short URLs are a bijection of the ids, so two processes
+never hand out the same short URL. The ids left in a pool when its process
+exits are never used.
+"""
+import collections
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+def reserve(alias, table, count):
+    """Reserve ``count`` ids from the sequence of ``table`` on ``alias``."""
+    with connections[alias].cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+            "FROM generate_series(1, %s)", [table, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+class IdPool:
+    """Ids reserved from the sequence of ``table`` on ``alias``."""
+
+    def __init__(self, alias, table):
+        self.alias = alias
+        self.table = table
+        self._ids = collections.deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+
+    def __len__(self):
+        return len(self._ids)
+
+    def take(self, count):
+        """Return ``count`` ids, less than a block."""
+        block_size = settings.URL_SHORTENER_ID_BLOCK_SIZE
+        with self._lock:
+            if len(self._ids) < count:
+                self._ids.extend(reserve(self.alias, self.table, block_size))
+            ids = [self._ids.popleft() for _ in range(count)]
+            refill = (len(self._ids) < block_size // 5 and not self._refilling)
+            self._refilling = self._refilling or refill
+        if refill:
+            threading.Thread(target=self._refill, name='id-pool',
+                             daemon=True).start()
+        return ids
+
+    def _refill(self):
+        try:
+            ids = reserve(self.alias, self.table,
+                          settings.URL_SHORTENER_ID_BLOCK_SIZE)
+            with self._lock:
+                self._ids.extend(ids)
+        except Exception:
+            logger.exception('Reserving ids failed')
+        finally:
+            self._refilling = False
+            connections[self.alias].close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def take(alias, table, count):
+    """Return ``count`` unused ids of ``table`` on ``alias``."""
+    if count >= settings.URL_SHORTENER_ID_BLOCK_SIZE:
+        return reserve(alias, table, count)
+    with _pools_lock:
+        pool = _pools.get((alias, table))
+        if pool is None:
+            pool = _pools[alias, table] = IdPool(alias, table)
+    return pool.take(count)
+
+
+# A forked worker must not hand out the ids of its parent
+os.register_at_fork(after_in_child=_pools.clear)
@@ -0,0 +1,188 @@
+"""
+Bulk import of URLs from CSV or NDJSON.
+
+The input is read and loaded in chunks, so the memory used does not depend
+on its size. On PostgreSQL each chunk gets its ids from the sequence and its
+short URLs from the code generator, is loaded with ``COPY`` into a
+temporary staging table and moved to the URL table with a single
+``INSERT ... SELECT ... ON CONFLICT DO NOTHING``, which skips the URLs
+already shortened; as with the creates, a URL whose link has expired is
+shortened again. Other databases go through `UrlManager.insert_new`.
+Each chunk is committed on its own, so an interrupted import can be run
+again. With several shards, each chunk is split by shard.
+"""
+import csv
+import io
+import json
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import connections, router, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import (codes, entries, expiry, known_codes, leaderboard, listing,
+               sharding)
+from .models import Url, url_digest
+
+STAGING_TABLE = 'url_shortener_url_import'
+
+
+def read_csv(file):
+    """Iterate over the rows of a CSV file with a ``url`` column."""
+    return csv.DictReader(file)
+
+
+def read_ndjson(file):
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+READERS = {'csv': read_csv, 'ndjson': read_ndjson}
+
+
+class Importer:
+    """
+    Import URLs given as dicts with a ``url`` and optionally ``on_clicks``
+    and ``created`` (as exported by ``export_urls``).
+    """
+
+    def __init__(self, chunk_size=10000, warm_cache=False, using=None):
+        self.chunk_size = chunk_size
+        self.warm_cache = warm_cache
+        self.using = using or router.db_for_write(Url)
+        self.validator = URLValidator()
+        self.max_length = Url._meta.get_field('url').max_length
+        self.read = self.imported = self.invalid = 0
+        self.started = None
+
+    @property
+    def duplicates(self):
+        return self.read - self.imported - self.invalid
+
+    @property
+    def rate(self):
+        return self.read / max(time.perf_counter() - self.started, 1e-9)
+
+    def build(self, record):
+        """Return an unsaved `Url` for ``record``, or ``None`` if invalid."""
+        url = record.get('url') or ''
+        try:
+            self.validator(url)
+        except ValidationError:
+            return None
+        if len(url) > self.max_length:
+            return None
+        created = record.get('created')
+        if created:
+            created = parse_datetime(created)
+            if created is None:
+                return None
+        try:
+            on_clicks = int(record.get('on_clicks') or 0)
+        except (TypeError, ValueError):
+            return None
+        return Url(url=url,
+                   url_hash=url_digest(url),
+                   on_clicks=on_clicks,
+                   created=created or timezone.now())
+
+    def run(self, records, progress=None):
+        """
+        Import ``records`` and return the number of URLs imported.
+
+        ``progress`` is called with the importer after each chunk.
+        """
+        self.started = time.perf_counter()
+        chunk = []
+        for record in records:
+            self.read += 1
+            obj = self.build(record)
+            if obj is None:
+                self.invalid += 1
+                continue
+            chunk.append(obj)
+            if len(chunk) >= self.chunk_size:
+                self.import_chunk(chunk)
+                chunk = []
+                if progress:
+                    progress(self)
+        if chunk:
+            self.import_chunk(chunk)
+            if progress:
+                progress(self)
+        if self.imported:
+            # Imported URLs can fall on any page and any rank
+            listing.invalidate_all_pages()
+            leaderboard.rebuild()
+        return self.imported
+
+    def import_chunk(self, objs):
+        objs = list({obj.url_hash: obj for obj in objs}.values())
+        groups = sharding.by_digest(objs) if sharding.enabled() else {
+            self.using: objs
+        }
+        created = []
+        for using, group in groups.items():
+            if connections[using].vendor == 'postgresql':
+                created += self.copy(group, using)
+            else:
+                created += Url.objects.db_manager(using).insert_new(group)
+        if self.warm_cache and created:
+            entries.set_many(created)
+        self.imported += len(created)
+
+    def copy(self, objs, using):
+        """Insert the new ``objs`` through the staging table of ``using``."""
+        manager = Url.objects.db_manager(using)
+        ids = manager.allocate_ids(len(objs), [obj.url_hash for obj in objs])
+        for obj, id in zip(objs, ids):
+            obj.pk = id
+            obj.short_url = codes.generate(id)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        table = qn(Url._meta.db_table)
+        columns = ', '.join(
+            qn(column) for column in ('id', 'url', 'url_hash', 'short_url',
+                                      'on_clicks', 'created', 'permanent'))
+        data = io.StringIO()
+        writer = csv.writer(data)
+        for obj in objs:
+            writer.writerow(
+                (obj.pk, obj.url, '\\x' + obj.url_hash.hex(), obj.short_url,
+                 obj.on_clicks, obj.created.isoformat(), obj.permanent))
+        data.seek(0)
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'CREATE TEMPORARY TABLE IF NOT EXISTS {STAGING_TABLE} '
+                    f'(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS')
+                cursor.copy_expert(
+                    f'COPY {STAGING_TABLE} ({columns}) '
+                    f'FROM STDIN WITH (FORMAT csv)', data)
+                # Frees the URLs of expired links, to shorten them again
+                replaced = manager._delete_expired(
+                    [obj.url_hash for obj in objs])
+                # Skips the URLs already shortened, and the short URLs
+                # issued by the old database trigger
+                cursor.execute(f'INSERT INTO {table} ({columns}) '
+                               f'SELECT {columns} FROM {STAGING_TABLE} '
+                               f'ON CONFLICT DO NOTHING RETURNING {qn("id")}')
+                inserted = {id for id, in cursor.fetchall()}
+                cursor.execute(
+                    f'SELECT {qn("id")} FROM {STAGING_TABLE} s '
+                    f'WHERE NOT EXISTS (SELECT 1 FROM {table} u '
+                    f'WHERE u.{qn("url_hash")} = s.{qn("url_hash")})')
+                clashes = {id for id, in cursor.fetchall()}
+        created = [obj for obj in objs if obj.pk in inserted]
+        known_codes.added([obj.short_url for obj in created])
+        if replaced:
+            expiry.forget(list(replaced.values()))
+        if clashes:
+            retry = [obj for obj in objs if obj.pk in clashes]
+            for obj in retry:
+                obj.pk = obj.short_url = None
+            created += manager.insert_new(retry)
+        return created
@@ -0,0 +1,196 @@
+"""
+Fast rejection of short URLs that do not exist.
+
+Each worker keeps a Bloom filter of the issued short URLs, built in a
+background thread from the ``short_url`` column. New short URLs are added to
+the filter of the worker creating them right away and published on a Redis
+channel for the other workers, which may answer 404 for a new short URL
+until the message reaches them (usually well under a millisecond). Until
+its filter is built, a worker lets every short URL through.
+
+Short URLs that pass the filter but do not exist are cached in Redis as
+``MISSING`` for ``URL_SHORTENER_NEGATIVE_CACHE_TTL`` seconds.
+"""
+import functools
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django_redis import get_redis_connection
+
+from . import async_redis, metrics, sharding
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'url_shortener:new_codes'
+# Cached value of a short URL that does not exist
+MISSING = 'missing'
+# A filter is built for at least this many short URLs
+MIN_CAPACITY = 100000
+
+
+class BloomFilter:
+    """Bloom filter of strings, sized for ``capacity`` items."""
+
+    def __init__(self, capacity, false_positive_rate):
+        self.capacity = capacity
+        self.size = math.ceil(-capacity * math.log(false_positive_rate) /
+                              math.log(2)**2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class KnownCodes:
+    """Bloom filter of the issued short URLs, kept up to date from Redis."""
+
+    def __init__(self):
+        self.filter = None
+        self._started = False
+        self._lock = threading.Lock()
+        # Codes added while the filter is rebuilt
+        self._added = None
+
+    def start(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            threading.Thread(target=self._run, name='known-codes',
+                             daemon=True).start()
+
+    def might_exist(self, short_url):
+        self.start()
+        bloom = self.filter
+        return bloom is None or short_url in bloom
+
+    def add(self, short_urls):
+        with self._lock:
+            if self.filter is not None:
+                for short_url in short_urls:
+                    self.filter.add(short_url)
+            if self._added is not None:
+                self._added.extend(short_urls)
+
+    def rebuild(self):
+        from .models import Url
+
+        with self._lock:
+            self._added = []
+        try:
+            querysets = [
+                Url.objects.using(shard).exclude(short_url=None)
+                for shard in sharding.all_shards()
+            ]
+            bloom = BloomFilter(
+                max(2 * sum(queryset.count() for queryset in querysets),
+                    MIN_CAPACITY),
+                settings.URL_SHORTENER_BLOOM_FALSE_POSITIVE_RATE)
+            for queryset in querysets:
+                for short_url in queryset.values_list(
+                        'short_url', flat=True).iterator(chunk_size=10000):
+                    bloom.add(short_url)
+            with self._lock:
+                for short_url in self._added:
+                    bloom.add(short_url)
+                self.filter = bloom
+        finally:
+            self._added = None
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = get_redis_connection('default').pubsub(
+                    ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                # Codes may have been published while disconnected
+                self.rebuild()
+                close_old_connections()
+                while True:
+                    message = pubsub.get_message(timeout=1)
+                    if message:
+                        self.add(message['data'].decode().split())
+                    if self.filter.count > self.filter.capacity:
+                        self.rebuild()
+                        close_old_connections()
+            except Exception:
+                logger.exception('Known short URLs listener failed')
+                time.sleep(1)
+
+
+known = KnownCodes()
+
+
+@functools.lru_cache
+def max_length():
+    from .models import Url
+
+    return Url._meta.get_field('short_url').max_length
+
+
+def might_exist(short_url):
+    """
+    Return ``False`` if ``short_url`` certainly does not exist.
+
+    A ``True`` can be a false positive, at the configured rate.
+    """
+    if len(short_url) > max_length():
+        metrics.unknown_short_urls.inc('malformed')
+        return False
+    if settings.URL_SHORTENER_BLOOM_FILTER and not known.might_exist(
+            short_url):
+        metrics.unknown_short_urls.inc('filter')
+        return False
+    return True
+
+
+def added(short_urls):
+    """Record newly issued ``short_urls`` in the filter of every worker."""
+    if not short_urls:
+        return
+    known.add(short_urls)
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    # Drop negative entries of short URLs requested before they existed
+    pipe.delete(*[cache.make_key(short_url) for short_url in short_urls])
+    pipe.publish(CHANNEL, ' '.join(short_urls))
+    pipe.execute()
+
+
+def cache_missing(short_url):
+    metrics.unknown_short_urls.inc('database')
+    cache.set(short_url, MISSING, settings.URL_SHORTENER_NEGATIVE_CACHE_TTL)
+
+
+async def acache_missing(short_url):
+    metrics.unknown_short_urls.inc('database')
+    await async_redis.cache_set(short_url, MISSING,
+                                settings.URL_SHORTENER_NEGATIVE_CACHE_TTL)
+
+
+def is_missing(cached):
+    if cached == MISSING:
+        metrics.unknown_short_urls.inc('cache')
+        return True
+    return False
@@ -0,0 +1,111 @@
+"""
+Most clicked URLs, kept in a Redis sorted set.
+
+The set holds the ``URL_SHORTENER_TOP_SIZE`` most clicked short URLs with
+their ``on_clicks`` as score, and a hash holds their URLs. Both are updated
+with the new totals each time clicks are flushed, so reading the top N is
+``O(log n + N)`` and does not touch the database. The counts are the ones
+in the database: clicks still buffered are not included.
+
+A URL outside the set has fewer clicks than every URL in it, and enters it
+as soon as its clicks are flushed. Deleting a URL from a full set leaves a
+hole at the bottom; the set is then rebuilt from the database (through the
+``on_clicks`` index, merging the top URLs of every shard) when a read needs
+more URLs than it holds.
+"""
+import itertools
+from operator import itemgetter
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from . import sharding
+from .models import Url
+
+TOP_KEY = 'url_shortener:top'
+URLS_KEY = 'url_shortener:top:urls'
+# Set when the sorted set holds the top URLs exactly
+COMPLETE_KEY = 'url_shortener:top:complete'
+
+
+def _redis():
+    return get_redis_connection('default')
+
+
+def update(rows):
+    """Record the new ``(short_url, url, on_clicks)`` ``rows``."""
+    rows = [row for row in rows if row[2] > 0]
+    if not rows:
+        return
+    size = settings.URL_SHORTENER_TOP_SIZE
+    client = _redis()
+    pipe = client.pipeline()
+    pipe.zadd(TOP_KEY,
+              {short_url: on_clicks
+               for short_url, _, on_clicks in rows})
+    pipe.hset(URLS_KEY, mapping={short_url: url for short_url, url, _ in rows})
+    pipe.zrange(TOP_KEY, 0, -size - 1)
+    dropped = pipe.execute()[-1]
+    if dropped:
+        pipe = client.pipeline()
+        pipe.zrem(TOP_KEY, *dropped)
+        pipe.hdel(URLS_KEY, *dropped)
+        pipe.execute()
+
+
+def remove(*short_urls):
+    if not short_urls:
+        return
+    client = _redis()
+    pipe = client.pipeline()
+    pipe.zrem(TOP_KEY, *short_urls)
+    pipe.hdel(URLS_KEY, *short_urls)
+    if pipe.execute()[0]:
+        # The URL that comes next is not in the set
+        client.delete(COMPLETE_KEY)
+
+
+def rebuild():
+    """Load the most clicked URLs from the database."""
+    size = settings.URL_SHORTENER_TOP_SIZE
+    queryset = Url.objects.filter(on_clicks__gt=0).order_by(
+        '-on_clicks', '-id').values_list('short_url', 'url', 'on_clicks',
+                                         'id')[:size]
+    rows = list(
+        itertools.islice(
+            sharding.merge(queryset, key=itemgetter(2, 3), reverse=True),
+            size))
+    pipe = _redis().pipeline()
+    pipe.delete(TOP_KEY, URLS_KEY)
+    if rows:
+        pipe.zadd(
+            TOP_KEY,
+            {short_url: on_clicks
+             for short_url, _, on_clicks, _ in rows})
+        pipe.hset(URLS_KEY,
+                  mapping={short_url: url
+                           for short_url, url, _, _ in rows})
+    pipe.set(COMPLETE_KEY, 1)
+    pipe.execute()
+
+
+def top(n):
+    """Return the ``n`` most clicked URLs, most clicked first."""
+    client = _redis()
+    for _ in range(2):
+        pipe = client.pipeline(transaction=False)
+        pipe.exists(COMPLETE_KEY)
+        pipe.zrevrange(TOP_KEY, 0, n - 1, withscores=True)
+        complete, entries = pipe.execute()
+        if complete or len(entries) >= n:
+            break
+        rebuild()
+    if not entries:
+        return []
+    short_urls = [short_url for short_url, _ in entries]
+    urls = client.hmget(URLS_KEY, short_urls)
+    return [{
+        'url': url.decode(),
+        'short_url': short_url.decode(),
+        'on_clicks': int(on_clicks)
+    } for (short_url, on_clicks), url in zip(entries, urls) if url is not None]
@@ -0,0 +1,224 @@
+"""
+Keyset pagination of the URL list and caching of its pages.
+
+Pages are ordered by ``(created, id)``, newest first. A cursor is the
+position of the last URL of the previous page, so fetching any page is an
+index range scan whatever its depth. With several shards, each one is
+scanned for a page and the pages are merged.
+
+Each page is cached under its own key. The keys of cached pages are recorded
+in Redis with the position of their oldest URL, so that a create only drops
+the first pages and a delete only drops the pages the URL was on.
+"""
+import base64
+import binascii
+import itertools
+import json
+from datetime import datetime
+from operator import attrgetter, itemgetter
+from urllib.parse import parse_qs, urlsplit
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
+from django_redis import get_redis_connection
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
+
+from . import sharding
+
+PAGES_KEY = 'url_shortener:list_pages'
+FIRST_PAGES_KEY = 'url_shortener:list_first_pages'
+
+
+def encode_cursor(created, id):
+    position = json.dumps([created.isoformat(), id])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return the ``(created, id)`` position encoded in ``cursor``."""
+    try:
+        created, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created), int(id)
+    except (binascii.Error, TypeError, ValueError):
+        raise NotFound('Invalid cursor')
+
+
+def after(queryset, position):
+    """Filter ``queryset`` to the URLs after ``position``, newest first."""
+    queryset = queryset.order_by('-created', '-id')
+    if position is None:
+        return queryset
+    created, id = position
+    return queryset.filter(created__lte=created).exclude(created=created,
+                                                         id__gte=id)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pages of ``page_size`` URLs, newest first.
+
+    The response body stays a plain list; the link to the next page is sent
+    in the ``Link`` header.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return settings.URL_SHORTENER_LIST_PAGE_SIZE
+        return min(max(page_size, 1),
+                   settings.URL_SHORTENER_LIST_MAX_PAGE_SIZE)
+
+    def get_position(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        return decode_cursor(cursor) if cursor else None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = after(queryset, self.get_position(request))
+        page = list(
+            itertools.islice(
+                sharding.merge(queryset[:page_size + 1],
+                               attrgetter('created', 'id'),
+                               reverse=True), page_size + 1))
+        self.next_position = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_position = (page[-1].created, page[-1].id)
+        self.oldest = page[-1] if page else None
+        return page
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param,
+                                   encode_cursor(*self.next_position))
+
+    def get_headers(self):
+        next_link = self.get_next_link()
+        return {'Link': f'<{next_link}>; rel="next"'} if next_link else {}
+
+    def get_paginated_response(self, data):
+        return Response(data, headers=self.get_headers())
+
+    def get_streaming_response(self, queryset, request, fields):
+        """
+        Stream a page as a JSON list, rendering rows as they are fetched.
+
+        Only the position of the next page is read up front (from the index);
+        the rows of the page are read with a server-side cursor.
+        """
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = after(queryset, self.get_position(request))
+        positions = queryset.values_list('created', 'id')
+        if sharding.enabled():
+            # The next position is among the first positions of each shard
+            positions = list(
+                itertools.islice(
+                    sharding.merge(positions[:page_size + 1],
+                                   itemgetter(0, 1),
+                                   reverse=True), page_size + 1))
+        boundary = list(positions[page_size - 1:page_size + 1])
+        self.next_position = boundary[0] if len(boundary) > 1 else None
+        rows = itertools.islice(
+            sharding.merge(
+                queryset.values(*fields, 'id')[:page_size],
+                itemgetter('created', 'id'),
+                reverse=True,
+                chunk_size=settings.URL_SHORTENER_LIST_STREAM_CHUNK_SIZE),
+            page_size)
+
+        def content():
+            yield '['
+            for i, row in enumerate(rows):
+                if 'id' not in fields:
+                    del row['id']
+                yield (',' if i else '') + json.dumps(row, cls=JSONEncoder)
+            yield ']'
+
+        response = StreamingHttpResponse(content(),
+                                         content_type='application/json')
+        for header, value in self.get_headers().items():
+            response[header] = value
+        return response
+
+
+def cache_page(key, page, oldest, first):
+    """
+    Cache a ``page`` (its ``data``, ``headers`` and validators) and record its
+    key for invalidation.
+
+    ``oldest`` is the last URL of the page and ``first`` tells whether it is
+    a first page (without cursor).
+    """
+    cache.set(key, page)
+    # The records live at least as long as the pages they point to
+    timeout = cache.default_timeout
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    if oldest is not None:
+        pipe.zadd(PAGES_KEY, {key: oldest.created.timestamp()})
+        if timeout:
+            pipe.expire(PAGES_KEY, timeout)
+    if first:
+        pipe.sadd(FIRST_PAGES_KEY, key)
+        if timeout:
+            pipe.expire(FIRST_PAGES_KEY, timeout)
+    pipe.execute()
+
+
+def _drop(keys):
+    if keys:
+        cache.delete_many(keys)
+        get_redis_connection('default').zrem(PAGES_KEY, *keys)
+
+
+def invalidate_first_pages():
+    """Drop the cached first pages, the only ones a new URL goes to."""
+    client = get_redis_connection('default')
+    pipe = client.pipeline()
+    pipe.smembers(FIRST_PAGES_KEY)
+    pipe.delete(FIRST_PAGES_KEY)
+    keys = [key.decode() for key in pipe.execute()[0]]
+    _drop(keys)
+
+
+def invalidate_pages_with(created, id):
+    """Drop the cached pages the URL at position ``(created, id)`` was on."""
+    client = get_redis_connection('default')
+    position = (created, id)
+    keys = []
+    # Pages whose oldest URL is not newer than the URL ...
+    for key in client.zrangebyscore(PAGES_KEY, '-inf', created.timestamp()):
+        key = key.decode()
+        cursor = parse_qs(urlsplit(key).query).get(
+            KeysetPagination.cursor_query_param)
+        # ... and which start before it
+        if not cursor or decode_cursor(cursor[0]) > position:
+            keys.append(key)
+    _drop(keys)
+    if keys:
+        client.srem(FIRST_PAGES_KEY, *keys)
+
+
+def invalidate_all_pages():
+    client = get_redis_connection('default')
+    pipe = client.pipeline()
+    pipe.zrange(PAGES_KEY, 0, -1)
+    pipe.smembers(FIRST_PAGES_KEY)
+    pipe.delete(PAGES_KEY, FIRST_PAGES_KEY)
+    pages, first_pages = pipe.execute()[:2]
+    keys = {key.decode()
+            for key in pages} | {key.decode()
+                                 for key in first_pages}
+    if keys:
+        cache.delete_many(list(keys))
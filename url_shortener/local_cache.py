@@ -0,0 +1,143 @@
+"""
+Per-worker LRU/TTL cache of the resolved short URLs (`entries.Target`) in
+front of Redis.
+
+Deletes are broadcast on a Redis pub/sub channel so that every worker drops
+the entry; the TTL bounds how stale an entry can get if a message is missed.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'url_shortener:invalidate'
+
+
+class LocalCache:
+    """Thread-safe LRU cache with a fixed time to live per entry."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Cache ``value``, for less than the TTL with a shorter ``ttl``."""
+        if not self.max_size:
+            return
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class InvalidationListener:
+    """Background thread applying invalidations published by other workers."""
+
+    def __init__(self, local_cache):
+        self.local_cache = local_cache
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            threading.Thread(target=self._run,
+                             name='local-cache-invalidation',
+                             daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = get_redis_connection('default').pubsub(
+                    ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Messages may have been missed while disconnected
+                self.local_cache.clear()
+                for message in pubsub.listen():
+                    self.local_cache.delete(message['data'].decode())
+            except Exception:
+                logger.exception('Local cache invalidation listener failed')
+                time.sleep(1)
+
+
+targets = LocalCache(settings.URL_SHORTENER_LOCAL_CACHE_SIZE,
+                     settings.URL_SHORTENER_LOCAL_CACHE_TTL)
+listener = InvalidationListener(targets)
+
+metrics.Collected(
+    'url_shortener_local_cache_lookups_total',
+    'Lookups in the local cache of this worker, by result.', 'counter',
+    lambda: {
+        ('hit', ): targets.hits,
+        ('miss', ): targets.misses
+    }, ('result', ))
+metrics.Collected('url_shortener_local_cache_evictions_total',
+                  'Entries evicted from the local cache of this worker.',
+                  'counter', lambda: {(): targets.evictions})
+metrics.Collected('url_shortener_local_cache_size',
+                  'Entries in the local cache of this worker.', 'gauge',
+                  lambda: {(): targets.stats()['size']})
+
+
+def get(short_url):
+    listener.start()
+    return targets.get(short_url)
+
+
+def set(short_url, target, ttl=None):
+    targets.set(short_url, target, ttl)
+
+
+def invalidate(short_url):
+    """Drop ``short_url`` from the local cache of every worker."""
+    targets.delete(short_url)
+    get_redis_connection('default').publish(INVALIDATION_CHANNEL, short_url)
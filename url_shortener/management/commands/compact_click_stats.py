@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from url_shortener import breaker, click_stats
+
+
+class Command(BaseCommand):
+    help = ('Fold the hourly click buckets older than the retention into '
+            'daily buckets.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=settings.URL_SHORTENER_HOURLY_CLICKS_RETENTION_DAYS,
+            help='Keep the hourly buckets of the last DAYS days.')
+
+    def handle(self, *args, **options):
+        with breaker.no_statement_timeout():
+            removed = click_stats.compact(timezone.now() -
+                                          timedelta(days=options['days']))
+        self.stdout.write(f'Compacted {removed} hourly buckets.')
@@ -0,0 +1,46 @@
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+
+from url_shortener import breaker, export
+
+
+class Command(BaseCommand):
+    help = 'Export the shortened URLs as NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format',
+                            choices=sorted(export.FORMATS),
+                            default='ndjson')
+        parser.add_argument('--output',
+                            help='File to write to (default: stdout).')
+        parser.add_argument('--created-from',
+                            help='Only URLs created at or after this date.')
+        parser.add_argument('--created-to',
+                            help='Only URLs created before this date.')
+        parser.add_argument('--min-clicks',
+                            type=int,
+                            help='Only URLs clicked at least this often.')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            help='Rows read from the database at once.')
+
+    def handle(self, *args, **options):
+        try:
+            created_from = export.parse_bound(options['created_from'])
+            created_to = export.parse_bound(options['created_to'])
+        except ValueError as e:
+            raise CommandError(e)
+        rows = export.rows(created_from, created_to, options['min_clicks'],
+                           options['chunk_size'])
+        render = export.FORMATS[options['format']][0]
+        with ExitStack() as stack:
+            stack.enter_context(breaker.no_statement_timeout())
+            if options['output']:
+                output = stack.enter_context(
+                    open(options['output'], 'w', newline=''))
+            else:
+                output = self.stdout
+                output.ending = ''
+            for line in render(rows):
+                output.write(line)
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from url_shortener import clicks
+
+
+class Command(BaseCommand):
+    help = 'Apply the buffered redirect clicks to the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            help='Keep running and flush every INTERVAL seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            updated = clicks.flush()
+            self.stdout.write(f'Flushed clicks for {updated} URLs.')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
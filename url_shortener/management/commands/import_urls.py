@@ -0,0 +1,53 @@
+import sys
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+
+from url_shortener import breaker, importer
+
+
+class Command(BaseCommand):
+    help = ('Import URLs from a CSV or NDJSON file (as written by '
+            'export_urls), skipping the URLs already shortened.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='File to read (- for stdin).')
+        parser.add_argument(
+            '--format',
+            choices=sorted(importer.READERS),
+            help='Input format (default: from the file extension, or ndjson).')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=10000,
+                            help='Rows loaded per statement and transaction.')
+        parser.add_argument('--warm-cache',
+                            action='store_true',
+                            help='Cache the imported URLs.')
+
+    def handle(self, *args, **options):
+        path = options['file']
+        fmt = options['format'] or ('csv'
+                                    if path.endswith('.csv') else 'ndjson')
+        url_importer = importer.Importer(options['chunk_size'],
+                                         options['warm_cache'])
+
+        def progress(url_importer):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{url_importer.read} rows read, '
+                                  f'{url_importer.rate:.0f} rows/s')
+
+        with ExitStack() as stack:
+            stack.enter_context(breaker.no_statement_timeout())
+            if path == '-':
+                file = sys.stdin
+            else:
+                file = stack.enter_context(open(path, newline=''))
+            try:
+                url_importer.run(importer.READERS[fmt](file), progress)
+            except (KeyError, ValueError) as e:
+                raise CommandError(f'Invalid input: {e}')
+        self.stdout.write(
+            f'Read {url_importer.read} rows: {url_importer.imported} '
+            f'imported, {url_importer.duplicates} already shortened, '
+            f'{url_importer.invalid} invalid '
+            f'({url_importer.rate:.0f} rows/s).')
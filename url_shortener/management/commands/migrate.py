@@ -0,0 +1,11 @@
+from django.core.management.commands import migrate
+
+from url_shortener import breaker
+
+
+class Command(migrate.Command):
+    """Django's ``migrate``, without the statement timeout of requests."""
+
+    def handle(self, *args, **options):
+        with breaker.no_statement_timeout([options['database']]):
+            super().handle(*args, **options)
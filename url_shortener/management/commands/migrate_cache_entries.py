@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from url_shortener import entries
+
+
+class Command(BaseCommand):
+    help = ('Rewrite the short URLs cached by older versions as pickled '
+            'dicts in the compact format, keeping their expiry.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=1000,
+                            help='Keys read per Redis pipeline.')
+
+    def handle(self, *args, **options):
+        migrated = entries.migrate(options['batch_size'])
+        self.stdout.write(f'Migrated {migrated} cache entries.')
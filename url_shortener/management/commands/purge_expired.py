@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from url_shortener import breaker, expiry
+
+
+class Command(BaseCommand):
+    help = 'Delete the expired links, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=1000,
+                            help='Links deleted per statement.')
+        parser.add_argument('--pause',
+                            type=float,
+                            default=0,
+                            help='Seconds to wait between batches.')
+
+    def handle(self, *args, **options):
+
+        def progress(purged):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{purged} links deleted')
+
+        with breaker.no_statement_timeout():
+            purged = expiry.purge(options['batch_size'], options['pause'],
+                                  progress)
+        self.stdout.write(f'Deleted {purged} expired links.')
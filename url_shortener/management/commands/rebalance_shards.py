@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from url_shortener import breaker, sharding
+
+
+class Command(BaseCommand):
+    help = ('Move the URLs to their shard after a change of '
+            'URL_SHORTENER_SHARDS, with the previous shards in '
+            'URL_SHORTENER_PREVIOUS_SHARDS.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=1000,
+                            help='URLs read from a shard at a time.')
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            help='Only count the URLs to move.')
+
+    def handle(self, *args, **options):
+
+        def progress(moved):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{moved} URLs moved')
+
+        try:
+            with breaker.no_statement_timeout():
+                moved = sharding.rebalance(options['batch_size'],
+                                           options['dry_run'], progress)
+        except sharding.Conflict as e:
+            raise CommandError(
+                f'{e}; keep URL_SHORTENER_PREVIOUS_SHARDS until they are '
+                'moved.')
+        if options['dry_run']:
+            self.stdout.write(f'{moved} URLs to move.')
+        else:
+            self.stdout.write(f'Moved {moved} URLs.')
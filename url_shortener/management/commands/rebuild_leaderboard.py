@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from url_shortener import leaderboard
+
+
+class Command(BaseCommand):
+    help = ('Reload the most clicked URLs from the database, after their '
+            'clicks were changed outside of the click buffer.')
+
+    def handle(self, *args, **options):
+        leaderboard.rebuild()
+        self.stdout.write('Rebuilt the leaderboard.')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from url_shortener import create_queue
+
+
+class Command(BaseCommand):
+    help = ('Create the URLs queued while the database was unavailable '
+            '(see URL_SHORTENER_CREATE_QUEUE).')
+
+    def handle(self, *args, **options):
+        if not create_queue.enabled():
+            raise CommandError('URL_SHORTENER_CREATE_QUEUE is not set.')
+        created = create_queue.replay()
+        self.stdout.write(f'Created {created} queued URLs.')
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from url_shortener import warmup
+
+
+class Command(BaseCommand):
+    help = ('Load the hottest URLs into the cache, after a deploy or a '
+            'Redis flush.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count',
+                            type=int,
+                            default=10000,
+                            help='Number of URLs to cache.')
+        parser.add_argument(
+            '--by',
+            choices=(warmup.CLICKS, warmup.RECENT),
+            default=warmup.CLICKS,
+            help='Rank the URLs by total clicks, or by clicks over the last '
+            'HOURS hours.')
+        parser.add_argument('--hours', type=int, default=24)
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=1000,
+                            help='URLs written per Redis pipeline.')
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=settings.URL_SHORTENER_WARM_CACHE_RATE,
+            help='Maximum URLs cached per second (0 for no limit).')
+
+    def handle(self, *args, **options):
+
+        def progress(read):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{read} URLs read')
+
+        written = warmup.warm(options['count'], options['by'],
+                              options['hours'], options['batch_size'],
+                              options['rate'], progress)
+        self.stdout.write(f'Cached {written} URLs.')
@@ -0,0 +1,206 @@
+"""
+In-process metrics, exposed in the Prometheus text format at ``/metrics``.
+
+Recording a value is a dictionary update under a lock, cheap enough to do on
+every redirect. Values are kept per process: with several workers, each one
+has to be scraped (or the workers' values added up) to get the totals.
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+from django_redis.client import DefaultClient
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        """Iterate over ``(name, labels, value)``; labels are ``(k, v)`` pairs."""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = defaultdict(float)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name, tuple(zip(self.labels, labels)), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [[0] * (len(self.buckets) + 1),
+                                                 0]
+            values[0][i] += 1
+            values[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total)
+                      for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            labels = tuple(zip(self.labels, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf', ), counts):
+                cumulative += count
+                yield (f'{self.name}_bucket', labels + (('le', bound), ),
+                       cumulative)
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Collected(Metric):
+    """Values read when the metrics are scraped, by calling ``collect``."""
+
+    def __init__(self, name, help, type, collect, labels=()):
+        super().__init__(name, help, labels)
+        self.type = type
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect().items():
+            yield self.name, tuple(zip(self.labels, labels)), value
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n',
+                                                   r'\n').replace('"', r'\"')
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for name, labels, value in metric.samples():
+            if labels:
+                name += '{%s}' % ','.join(f'{key}="{_escape(label)}"'
+                                          for key, label in labels)
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+requests = Counter('url_shortener_requests_total',
+                   'Requests handled, by route, method and status.',
+                   ('route', 'method', 'status'))
+request_duration = Histogram('url_shortener_request_duration_seconds',
+                             'Time to handle a request, by route.',
+                             ('route', 'method'))
+request_db_queries = Histogram('url_shortener_request_db_queries',
+                               'Database queries run by a request, by route.',
+                               ('route', ), (0, 1, 2, 3, 5, 10, 20, 50, 100))
+request_db_duration = Histogram(
+    'url_shortener_request_db_duration_seconds',
+    'Time spent in database queries by a request, by route.', ('route', ))
+cache_lookups = Counter(
+    'url_shortener_cache_lookups_total',
+    'Lookups in the Redis cache, by key family and result.',
+    ('family', 'result'))
+cache_fills = Counter(
+    'url_shortener_cache_fills_total',
+    'Missing or stale cache entries, by key family and outcome (loaded, '
+    'revalidated, stale, waited or timeout).', ('family', 'outcome'))
+unknown_short_urls = Counter(
+    'url_shortener_unknown_short_urls_total',
+    'Lookups of short URLs that do not exist, by what rejected them '
+    '(malformed, filter, cache or database).', ('source', ))
+click_flush_duration = Histogram('url_shortener_click_flush_duration_seconds',
+                                 'Time to apply the buffered clicks.')
+clicks_flushed = Counter('url_shortener_clicks_flushed_total',
+                         'Clicks applied to the database.')
+
+
+def key_family(key):
+    if key.startswith('/urls/'):
+        return 'list'
+    if key.startswith('django.contrib.sessions'):
+        return 'session'
+    if key.endswith(':meta'):
+        return 'url_meta'
+    return 'url'
+
+
+def record_cache_lookup(key, hit):
+    cache_lookups.inc(key_family(key), 'hit' if hit else 'miss')
+
+
+class RedisCacheClient(DefaultClient):
+    """``django_redis`` client counting the hits and misses of ``get``."""
+
+    def get(self, key, default=None, version=None, client=None):
+        value = super().get(key, default, version, client)
+        record_cache_lookup(key, value is not default)
+        return value
+
+
+class QueryTimer:
+    """Database execute wrapper counting and timing the queries."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+def route(request):
+    """Name of the URL pattern that handled ``request``."""
+    match = getattr(request, 'resolver_match', None)
+    if match is not None:
+        return match.view_name
+    return getattr(request, 'metrics_route', 'unmatched')
+
+
+def observe_request(request, response, duration, queries=None):
+    name = route(request)
+    requests.inc(name, request.method, str(response.status_code))
+    request_duration.observe(duration, name, request.method)
+    if queries is not None:
+        request_db_queries.observe(queries.count, name)
+        request_db_duration.observe(queries.duration, name)
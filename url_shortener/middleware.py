@@ -0,0 +1,197 @@
+import asyncio
+import random
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.deprecation import MiddlewareMixin
+
+from . import breaker, clicks, http_cache, metrics, profiling, redirects
+
+REDIRECT_ROUTE = 'url_shortener:url_redirect'
+
+
+def unavailable():
+    """Response to a request that needs the database while it is down."""
+    response = JsonResponse({'error': 'Service unavailable'}, status=503)
+    response['Retry-After'] = max(1, breaker.database.retry_after())
+    return response
+
+
+def _redirect_path_parts():
+    """Text before and after the short URL in the redirect path."""
+    placeholder = 'short_url'
+    path = reverse(REDIRECT_ROUTE, args=[placeholder])
+    prefix, _, suffix = path.rpartition(placeholder)
+    return prefix, suffix
+
+
+@sync_and_async_middleware
+def fast_redirect_middleware(get_response):
+    """
+    Answer redirects before the rest of the middleware and the URL resolver.
+
+    Enabled by ``URL_SHORTENER_FAST_REDIRECT``, it must come first in
+    ``MIDDLEWARE``: a redirect then only looks the short URL up and records
+    the click, without sessions, CSRF, authentication or DRF dispatch. The
+    responses are the same as the redirect view's (see `http_cache`, 404
+    with an ``error`` message, or 503 while the database is unavailable).
+    """
+    if not settings.URL_SHORTENER_FAST_REDIRECT:
+        raise MiddlewareNotUsed
+    prefix, suffix = _redirect_path_parts()
+
+    def short_url_of(request):
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        path = request.path_info
+        if not path.startswith(prefix) or not path.endswith(suffix):
+            return None
+        short_url = path[len(prefix):len(path) - len(suffix)]
+        if not short_url or '/' in short_url:
+            return None
+        request.metrics_route = REDIRECT_ROUTE
+        return short_url
+
+    def not_found():
+        return JsonResponse({'error': 'URL not found'}, status=404)
+
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            short_url = short_url_of(request)
+            if short_url is None:
+                return await get_response(request)
+            try:
+                target = await redirects.aresolve(short_url)
+            except breaker.Unavailable:
+                return unavailable()
+            if target is None:
+                return not_found()
+            await clicks.arecord(short_url)
+            return http_cache.redirect(target)
+
+    else:
+
+        def middleware(request):
+            short_url = short_url_of(request)
+            if short_url is None:
+                return get_response(request)
+            try:
+                target = redirects.resolve(short_url)
+            except breaker.Unavailable:
+                return unavailable()
+            if target is None:
+                return not_found()
+            clicks.record(short_url)
+            return http_cache.redirect(target)
+
+    return middleware
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Record the latency and status of every request in `metrics`.
+
+    Enabled by ``URL_SHORTENER_METRICS``; it comes first in ``MIDDLEWARE`` so
+    that redirects answered by `fast_redirect_middleware` are measured too.
+    The database queries are only counted for requests handled
+    synchronously.
+    """
+    if not settings.URL_SHORTENER_METRICS:
+        raise MiddlewareNotUsed
+
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            metrics.observe_request(request, response,
+                                    time.perf_counter() - start)
+            return response
+
+    else:
+
+        def middleware(request):
+            queries = metrics.QueryTimer()
+            start = time.perf_counter()
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(queries))
+                response = get_response(request)
+            metrics.observe_request(request, response,
+                                    time.perf_counter() - start, queries)
+            return response
+
+    return middleware
+
+
+@sync_and_async_middleware
+def profiling_middleware(get_response):
+    """
+    Profile the SQL queries and cache calls of some requests (see
+    `profiling`).
+
+    Enabled by ``URL_SHORTENER_PROFILE``; it comes right after
+    `metrics_middleware` so that the fast redirects are profiled too.
+    """
+    if not settings.URL_SHORTENER_PROFILE:
+        raise MiddlewareNotUsed
+
+    def wanted(request):
+        mode = request.headers.get(profiling.HEADER)
+        if mode is None and (random.random() >=
+                             settings.URL_SHORTENER_PROFILE_SAMPLE_RATE):
+            return None
+        return mode or ''
+
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            if wanted(request) is None:
+                return await get_response(request)
+            start = time.perf_counter()
+            with profiling.capture() as profile:
+                response = await get_response(request)
+            profiling.write(request, response,
+                            time.perf_counter() - start, profile)
+            return response
+
+    else:
+
+        def middleware(request):
+            mode = wanted(request)
+            if mode is None:
+                return get_response(request)
+            start = time.perf_counter()
+            with profiling.capture(mode == profiling.CPROFILE) as profile:
+                response = get_response(request)
+            profiling.write(request, response,
+                            time.perf_counter() - start, profile)
+            return response
+
+    return middleware
+
+
+class DatabaseBreakerMiddleware(MiddlewareMixin):
+    """
+    Answer with a 503 the requests that fail on the database.
+
+    The views raise `breaker.Unavailable` when they need the database while
+    the breaker is open; the connection errors and timeouts of queries run
+    outside `breaker.CircuitBreaker.guard` count as failures of the breaker
+    as well.
+    """
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, breaker.ERRORS):
+            breaker.database.failure()
+        elif not isinstance(exception, breaker.Unavailable):
+            return None
+        return unavailable()
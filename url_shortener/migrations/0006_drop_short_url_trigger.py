@@ -0,0 +1,37 @@
+import os
+
+from django.db import migrations
+
+path_query = os.path.join(os.path.dirname(__file__), 'queries',
+                          'sql_generator.text')
+with open(path_query, 'r') as f:
+    query = f.read()
+
+
+def run_on_postgresql(sql):
+    # The trigger only exists on PostgreSQL (see 0004_generator)
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute(sql, None)
+
+    return run
+
+
+class Migration(migrations.Migration):
+    """Short URLs are now generated by the application before the insert."""
+
+    dependencies = [
+        ('url_shortener', '0005_alter_url_url'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_on_postgresql("""
+                DROP TRIGGER IF EXISTS update_short_url ON url_shortener_url;
+                DROP FUNCTION IF EXISTS update_short_url();
+                DROP FUNCTION IF EXISTS converter(decimal);
+                DROP FUNCTION IF EXISTS random_string(integer, float8);
+            """),
+            run_on_postgresql(query),
+        )
+    ]
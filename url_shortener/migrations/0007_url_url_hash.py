@@ -0,0 +1,66 @@
+# Generated by Django 4.1.1 on 2026-10-18 04:19
+
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+BATCH_SIZE = 1000
+
+
+def url_digest(url):
+    """
+    Frozen copy of ``url_shortener.models.url_digest`` as of this migration.
+    """
+    parts = urlsplit(url.strip())
+    userinfo, at, host = parts.netloc.rpartition('@')
+    netloc = userinfo + at + host.lower()
+    path = parts.path or '/'
+    normalized = urlunsplit(
+        (parts.scheme.lower(), netloc, path, parts.query, parts.fragment))
+    return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+
+
+def backfill_url_hash(apps, schema_editor):
+    Url = apps.get_model('url_shortener', 'Url')
+    last_id = 0
+    while True:
+        batch = list(
+            Url.objects.filter(id__gt=last_id).order_by('id').only(
+                'id', 'url')[:BATCH_SIZE])
+        if not batch:
+            break
+        for obj in batch:
+            obj.url_hash = url_digest(obj.url)
+        Url.objects.bulk_update(batch, ['url_hash'])
+        last_id = batch[-1].id
+    # URLs shortened more than once before: keep the digest on the oldest
+    # row only, so the unique index can be created.
+    duplicates = Url.objects.values('url_hash').annotate(
+        count=Count('id'), first_id=Min('id')).filter(
+            count__gt=1).order_by()
+    for duplicate in duplicates:
+        Url.objects.filter(url_hash=duplicate['url_hash']).exclude(
+            id=duplicate['first_id']).update(url_hash=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('url_shortener', '0006_drop_short_url_trigger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='url_hash',
+            field=models.BinaryField(max_length=16, null=True),
+        ),
+        migrations.RunPython(backfill_url_hash, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='url',
+            name='url_hash',
+            field=models.BinaryField(max_length=16, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.1 on 2026-10-18 04:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('url_shortener', '0007_url_url_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='url',
+            index=models.Index(fields=['created', 'id'],
+                               name='url_shortener_created_id'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.1.1 on 2026-10-18 04:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('url_shortener', '0008_url_created_id_index'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='url',
+            options={},
+        ),
+        migrations.AddIndex(
+            model_name='url',
+            index=models.Index(fields=['-on_clicks', '-id'],
+                               name='url_shortener_on_clicks_id'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.1.1 on 2026-10-18 04:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('url_shortener', '0009_url_on_clicks_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClickBucket',
+            fields=[
+                ('id',
+                 models.BigAutoField(auto_created=True,
+                                     primary_key=True,
+                                     serialize=False,
+                                     verbose_name='ID')),
+                ('granularity',
+                 models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')],
+                                  max_length=4)),
+                ('start', models.DateTimeField()),
+                ('count', models.IntegerField(default=0)),
+                ('url',
+                 models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                   related_name='click_buckets',
+                                   to='url_shortener.url')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='clickbucket',
+            index=models.Index(fields=['granularity', 'start'],
+                               name='url_shortener_bucket_start'),
+        ),
+        migrations.AddConstraint(
+            model_name='clickbucket',
+            constraint=models.UniqueConstraint(
+                fields=('url', 'granularity', 'start'),
+                name='url_shortener_click_bucket'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.1.1 on 2026-10-18 05:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('url_shortener', '0010_clickbucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='url',
+            index=models.Index(condition=models.Q(
+                ('expires_at__isnull', False)),
+                               fields=['expires_at'],
+                               name='url_shortener_expires_at'),
+        ),
+    ]
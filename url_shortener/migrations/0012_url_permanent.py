@@ -0,0 +1,18 @@
+# Generated by Django 4.1.1 on 2026-10-18 05:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('url_shortener', '0011_url_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='permanent',
+            field=models.BooleanField(default=True),
+        ),
+    ]
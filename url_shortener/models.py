@@ -1,14 +1,311 @@
-from django.db import models
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import (IntegrityError, connections, models, router,
+                       transaction)
+from django.utils import timezone
+
+from . import codes, id_pool, known_codes, sharding
+
+
+def normalize_url(url):
+    """Normalize the parts of ``url`` that do not change what it points to."""
+    parts = urlsplit(url.strip())
+    userinfo, at, host = parts.netloc.rpartition('@')
+    netloc = userinfo + at + host.lower()
+    path = parts.path or '/'
+    return urlunsplit(
+        (parts.scheme.lower(), netloc, path, parts.query, parts.fragment))
+
+
+def url_digest(url):
+    """16 byte digest of the normalized ``url``, used to find duplicates."""
+    return hashlib.blake2b(normalize_url(url).encode(),
+                           digest_size=16).digest()
+
+
+class UrlManager(models.Manager):
+
+    def allocate_ids(self, count, digests=None):
+        """
+        Reserve ``count`` ids from the primary key sequence, through the
+        id pool of the process (see `id_pool`).
+
+        With several shards the ids come from the sequence of the first shard
+        and are moved to the slots of the URL ``digests`` (see `sharding`).
+        Returns ``None`` on databases without sequences; the ids are then only
+        known after the insert.
+        """
+        connection = connections[sharding.sequence_alias(self.db)]
+        if connection.vendor != 'postgresql':
+            if sharding.enabled():
+                raise ImproperlyConfigured(
+                    'The first shard must be a PostgreSQL database')
+            return None
+        ids = id_pool.take(connection.alias, self.model._meta.db_table, count)
+        if sharding.enabled():
+            ids = sharding.slotted_ids(ids, digests)
+        return ids
+
+    def _on(self, shard):
+        return self.using(shard) if shard else self.get_queryset()
+
+    def find(self, short_url):
+        """Return the URL of ``short_url``, read from its shard, or ``None``."""
+        for shard in sharding.shards_for_short_url(short_url):
+            obj = self._on(shard).filter(short_url=short_url).first()
+            if obj:
+                return obj
+        return None
+
+    async def afind(self, short_url):
+        for shard in sharding.shards_for_short_url(short_url):
+            obj = await self._on(shard).filter(short_url=short_url).afirst()
+            if obj:
+                return obj
+        return None
+
+    def insert_new(self, objs):
+        """
+        Insert the ``objs`` whose URL has not been shortened yet.
+
+        The rows are inserted with a single
+        ``INSERT ... ON CONFLICT (url_hash) DO NOTHING RETURNING``, so finding
+        duplicates is an index lookup and concurrent inserts of the same URL
+        cannot both succeed. A URL whose link has expired is shortened again:
+        the expired row is deleted in the same transaction. Returns the
+        inserted objects.
+        """
+        new = {}
+        for obj in objs:
+            obj.url_hash = url_digest(obj.url)
+            obj.created = obj.created or timezone.now()
+            new.setdefault(obj.url_hash, obj)
+        objs = list(new.values())
+        if not objs:
+            return []
+        if sharding.enabled() and self._db is None:
+            created = []
+            for shard, group in sharding.by_digest(objs).items():
+                created += self.db_manager(shard).insert_new(group)
+            return created
+        for _ in range(5):
+            ids = self.allocate_ids(len(objs), [obj.url_hash for obj in objs])
+            if ids is not None:
+                for obj, id in zip(objs, ids):
+                    obj.pk = id
+                    obj.short_url = codes.generate(id)
+            try:
+                with transaction.atomic(using=self.db):
+                    inserted = self._insert_ignoring_duplicates(objs)
+                    replaced = self._delete_expired([
+                        obj.url_hash for obj in objs
+                        if obj.url_hash not in inserted
+                    ])
+                    if replaced:
+                        inserted.update(
+                            self._insert_ignoring_duplicates([
+                                obj for obj in objs if obj.url_hash in replaced
+                            ]))
+                    created = [obj for obj in objs if obj.url_hash in inserted]
+                    if ids is None:
+                        for obj in created:
+                            obj.pk = inserted[obj.url_hash]
+                            obj.short_url = codes.generate(obj.pk)
+                        self.bulk_update(created, ['short_url'])
+                known_codes.added([obj.short_url for obj in created])
+                if replaced:
+                    from . import expiry
+                    expiry.forget(list(replaced.values()))
+                return created
+            except IntegrityError:
+                if ids is None or not self.filter(
+                        short_url__in=[obj.short_url
+                                       for obj in objs]).exists():
+                    raise
+                # A generated code clashed with a code issued by the old
+                # database trigger; retry with other ids.
+        raise IntegrityError('No unused short URL found')
+
+    def _delete_expired(self, digests):
+        """
+        Delete the expired rows of ``digests``, with their click buckets, and
+        return a ``url_hash -> short_url`` map of them.
+        """
+        if not digests:
+            return {}
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        sql = (f'DELETE FROM {qn(self.model._meta.db_table)} '
+               f'WHERE {qn("url_hash")} IN '
+               f'({", ".join(["%s"] * len(digests))}) '
+               f'AND {qn("expires_at")} <= %s '
+               f'RETURNING {qn("id")}, {qn("url_hash")}, {qn("short_url")}')
+        now = self.model._meta.get_field('expires_at').get_db_prep_value(
+            timezone.now(), connection)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [*digests, now])
+            rows = cursor.fetchall()
+        if rows:
+            ClickBucket.objects.using(
+                self.db).filter(url_id__in=[id for id, _, _ in rows]).delete()
+        return {bytes(url_hash): short_url for _, url_hash, short_url in rows}
+
+    def _insert_ignoring_duplicates(self, objs):
+        """Insert ``objs`` and return a ``url_hash -> id`` map of new rows."""
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        fields = [
+            field for field in self.model._meta.concrete_fields
+            if objs[0].pk is not None or field.name not in ('id', 'short_url')
+        ]
+        row = '(%s)' % ', '.join(['%s'] * len(fields))
+        sql = (f'INSERT INTO {qn(self.model._meta.db_table)} '
+               f'({", ".join(qn(field.column) for field in fields)}) '
+               f'VALUES {", ".join([row] * len(objs))} '
+               f'ON CONFLICT ({qn("url_hash")}) DO NOTHING '
+               f'RETURNING {qn("url_hash")}, {qn("id")}')
+        params = [
+            field.get_db_prep_save(getattr(obj, field.attname), connection)
+            for obj in objs for field in fields
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return {bytes(url_hash): id for url_hash, id in cursor.fetchall()}
+
+    def bulk_create(self, objs, **kwargs):
+        """Insert ``objs`` with their short URLs in one statement."""
+        objs = list(objs)
+        for obj in objs:
+            obj.url_hash = obj.url_hash or url_digest(obj.url)
+        if sharding.enabled() and self._db is None:
+            return [
+                obj for shard, group in sharding.by_digest(objs).items()
+                for obj in self.db_manager(shard).bulk_create(group, **kwargs)
+            ]
+        new = [obj for obj in objs if obj.pk is None and not obj.short_url]
+        ids = self.allocate_ids(len(new), [obj.url_hash
+                                           for obj in new]) if new else []
+        if ids is None:
+            objs = super().bulk_create(objs, **kwargs)
+            for obj in new:
+                obj.short_url = codes.generate(obj.pk)
+            self.bulk_update(new, ['short_url'])
+            known_codes.added([obj.short_url for obj in new])
+            return objs
+        for obj, id in zip(new, ids):
+            obj.pk = id
+            obj.short_url = codes.generate(id)
+        try:
+            with transaction.atomic(using=self.db):
+                objs = super().bulk_create(objs, **kwargs)
+            known_codes.added([obj.short_url for obj in new])
+            return objs
+        except IntegrityError:
+            # A generated code clashed with a code issued by the old database
+            # trigger; insert the rows one by one to skip the used codes.
+            for obj in new:
+                obj.pk = obj.short_url = None
+            for obj in objs:
+                obj.save(using=self.db)
+            return objs
 
 
 class Url(models.Model):
     url = models.URLField(max_length=1000)
+    url_hash = models.BinaryField(max_length=16,
+                                  unique=True,
+                                  null=True,
+                                  editable=False)
     short_url = models.CharField(max_length=6, unique=True, null=True)
     on_clicks = models.IntegerField(default=0)
     created = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    # Redirect with a 301, or with a 302 that caches do not keep long
+    permanent = models.BooleanField(default=True)
+
+    objects = UrlManager()
 
     def __str__(self):
         return self.url
 
+    @property
+    def expired(self):
+        return self.expires_at is not None and self.expires_at <= timezone.now(
+        )
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.url_hash is None:
+            self.url_hash = url_digest(self.url)
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        if sharding.enabled():
+            # Querysets create on the default database
+            kwargs['using'] = sharding.shard_for_digest(self.url_hash)
+        if self.short_url:
+            super().save(*args, **kwargs)
+            known_codes.added([self.short_url])
+            return
+        using = kwargs.get('using') or router.db_for_write(Url, instance=self)
+        manager = Url.objects.db_manager(using)
+        kwargs['force_insert'] = True
+        while True:
+            ids = manager.allocate_ids(1, [self.url_hash])
+            if ids is None:
+                super().save(*args, **kwargs)
+                self.short_url = codes.generate(self.pk)
+                manager.filter(pk=self.pk).update(short_url=self.short_url)
+                known_codes.added([self.short_url])
+                return
+            self.pk = ids[0]
+            self.short_url = codes.generate(self.pk)
+            try:
+                with transaction.atomic(using=using):
+                    super().save(*args, **kwargs)
+                known_codes.added([self.short_url])
+                return
+            except IntegrityError:
+                if not manager.filter(short_url=self.short_url).exists():
+                    raise
+                # Code issued by the old database trigger, take the next id
+                self.pk = None
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the list of URLs
+            models.Index(fields=['created', 'id'],
+                         name='url_shortener_created_id'),
+            # Most clicked URLs
+            models.Index(fields=['-on_clicks', '-id'],
+                         name='url_shortener_on_clicks_id'),
+            # Purge of the expired URLs, only the URLs that expire
+            models.Index(fields=['expires_at'],
+                         name='url_shortener_expires_at',
+                         condition=models.Q(expires_at__isnull=False)),
+        ]
+
+
+class ClickBucket(models.Model):
+    """Clicks of a URL during an hour or a day (see `click_stats`)."""
+    HOUR = 'hour'
+    DAY = 'day'
+
+    url = models.ForeignKey(Url,
+                            on_delete=models.CASCADE,
+                            related_name='click_buckets')
+    granularity = models.CharField(max_length=4,
+                                   choices=[(HOUR, 'Hour'), (DAY, 'Day')])
+    start = models.DateTimeField()
+    count = models.IntegerField(default=0)
+
     class Meta:
-        ordering = ('on_clicks', )
+        constraints = [
+            models.UniqueConstraint(fields=['url', 'granularity', 'start'],
+                                    name='url_shortener_click_bucket'),
+        ]
+        indexes = [
+            # Compaction of the old hourly buckets
+            models.Index(fields=['granularity', 'start'],
+                         name='url_shortener_bucket_start'),
+        ]
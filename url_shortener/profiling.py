@@ -0,0 +1,247 @@
+"""
+Per-request breakdown of the SQL queries and cache calls.
+
+`capture` records, while it is active, every SQL query with its duration
+and alias, and every round trip to Redis with its command, key family and
+duration; a pipeline is one round trip. The Redis calls are seen by the
+clients of `RedisClient` and `AsyncRedisClient`, which the cache and
+`async_redis` use; outside of `capture` they only cost a context variable
+lookup. SQL queries are only recorded reliably for code running
+synchronously.
+
+With ``URL_SHORTENER_PROFILE`` set, `middleware.profiling_middleware`
+profiles the requests sent with an ``X-Profile`` header (``X-Profile:
+cprofile`` adds a cProfile summary, for requests handled synchronously) and
+a ``URL_SHORTENER_PROFILE_SAMPLE_RATE`` fraction of the others. The totals
+are sent back in a ``Server-Timing`` header, and the full profile is written
+as a JSON line to the rotating log ``URL_SHORTENER_PROFILE_LOG`` if set.
+
+In the tests, `budget` fails when a block makes more queries or cache calls
+than allowed.
+"""
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import logging.handlers
+import pstats
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from redis.asyncio.client import Pipeline as AsyncPipeline
+from redis.asyncio.client import Redis as AsyncRedis
+from redis.client import Pipeline, Redis
+
+from . import metrics
+
+HEADER = 'X-Profile'
+CPROFILE = 'cprofile'
+# Functions listed in the cProfile summary
+CPROFILE_LINES = 20
+
+LOG_MAX_BYTES = 10 * 2**20
+LOG_BACKUPS = 5
+
+_current = contextvars.ContextVar('profile', default=None)
+# Rotating log handlers, by path
+_handlers = {}
+_handlers_lock = threading.Lock()
+
+
+def key_family(key):
+    """Family of a raw Redis key, for the keys of the cache and our own."""
+    if isinstance(key, bytes):
+        key = key.decode(errors='replace')
+    if not isinstance(key, str):
+        return None
+    if key.startswith(':'):
+        # Made by cache.make_key, ':<version>:<key>'
+        key = key.split(':', 2)[-1]
+    if key.endswith(':loading'):
+        return 'lock'
+    if key.startswith('url_shortener:'):
+        return key.split(':')[1]
+    return metrics.key_family(key)
+
+
+class Profile:
+    """The SQL queries and cache calls of a request."""
+
+    def __init__(self):
+        self.queries = []
+        self.cache_calls = []
+        self.cprofile = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'alias': context['connection'].alias,
+                'ms': (time.perf_counter() - start) * 1000
+            })
+
+    def cache_call(self, commands, start):
+        key = commands[0][1] if len(commands[0]) > 1 else None
+        self.cache_calls.append({
+            'command':
+            ' '.join(str(args[0]) for args in commands),
+            'family':
+            key_family(key),
+            'ms': (time.perf_counter() - start) * 1000
+        })
+
+    def totals(self):
+        return {
+            'sql': len(self.queries),
+            'sql_ms': sum(query['ms'] for query in self.queries),
+            'cache': len(self.cache_calls),
+            'cache_ms': sum(call['ms'] for call in self.cache_calls)
+        }
+
+    def server_timing(self, duration):
+        totals = self.totals()
+        return (f'sql;dur={totals["sql_ms"]:.2f};desc="{totals["sql"]} '
+                f'queries", cache;dur={totals["cache_ms"]:.2f};'
+                f'desc="{totals["cache"]} calls", '
+                f'total;dur={duration * 1000:.2f}')
+
+    def as_dict(self):
+        return {
+            **self.totals(), 'queries': self.queries,
+            'cache_calls': self.cache_calls,
+            'cprofile': self.cprofile
+        }
+
+
+@contextlib.contextmanager
+def capture(cprofile=False):
+    """Record the queries and cache calls of the block in a `Profile`."""
+    profile = Profile()
+    profiler = cProfile.Profile() if cprofile else None
+    token = _current.set(profile)
+    try:
+        with contextlib.ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(profile))
+            if profiler:
+                profiler.enable()
+                stack.callback(profiler.disable)
+            yield profile
+    finally:
+        _current.reset(token)
+        if profiler:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats(
+                'cumulative').print_stats(CPROFILE_LINES)
+            profile.cprofile = out.getvalue()
+
+
+def _log(line):
+    path = settings.URL_SHORTENER_PROFILE_LOG
+    with _handlers_lock:
+        handler = _handlers.get(path)
+        if handler is None:
+            handler = _handlers[path] = logging.handlers.RotatingFileHandler(
+                path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    handler.handle(logging.makeLogRecord({'msg': line}))
+
+
+def write(request, response, duration, profile):
+    """Report ``profile`` in the response, and in the log if set."""
+    response['Server-Timing'] = profile.server_timing(duration)
+    if settings.URL_SHORTENER_PROFILE_LOG:
+        _log(
+            json.dumps({
+                'method': request.method,
+                'path': request.get_full_path(),
+                'status': response.status_code,
+                'ms': duration * 1000,
+                **profile.as_dict()
+            }))
+
+
+@contextlib.contextmanager
+def budget(sql=None, cache=None):
+    """
+    Fail if the block makes more than ``sql`` queries or ``cache`` cache
+    calls; ``None`` does not limit them.
+    """
+    with capture() as profile:
+        yield profile
+    for name, limit, calls in (('SQL queries', sql, profile.queries),
+                               ('cache calls', cache, profile.cache_calls)):
+        if limit is not None and len(calls) > limit:
+            raise AssertionError(
+                f'{len(calls)} {name} made, {limit} allowed:\n' + '\n'.join(
+                    call.get('sql') or call['command'] for call in calls))
+
+
+class RedisClient(Redis):
+    """Redis client recording its calls in the current `Profile`."""
+
+    def execute_command(self, *args, **options):
+        profile = _current.get()
+        if profile is None:
+            return super().execute_command(*args, **options)
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            profile.cache_call([args], start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ProfiledPipeline(self.connection_pool, self.response_callbacks,
+                                transaction, shard_hint)
+
+
+class ProfiledPipeline(Pipeline):
+
+    def execute(self, raise_on_error=True):
+        profile = _current.get()
+        commands = [args for args, _ in self.command_stack]
+        if profile is None or not commands:
+            return super().execute(raise_on_error)
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            profile.cache_call(commands, start)
+
+
+class AsyncRedisClient(AsyncRedis):
+
+    async def execute_command(self, *args, **options):
+        profile = _current.get()
+        if profile is None:
+            return await super().execute_command(*args, **options)
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            profile.cache_call([args], start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AsyncProfiledPipeline(self.connection_pool,
+                                     self.response_callbacks, transaction,
+                                     shard_hint)
+
+
+class AsyncProfiledPipeline(AsyncPipeline):
+
+    async def execute(self, raise_on_error=True):
+        profile = _current.get()
+        commands = [args for args, _ in self.command_stack]
+        if profile is None or not commands:
+            return await super().execute(raise_on_error)
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            profile.cache_call(commands, start)
@@ -0,0 +1,157 @@
+"""
+Resolution of short URLs for the redirect and info views and the fast
+redirect path.
+
+A short URL is looked up in the per-worker cache, then in the Redis cache
+and last in the database, and the caches are filled on the way back.
+Redirects only read the cached URL; the info lookups also read the
+``on_clicks`` and ``created`` cached next to it (see `entries`). Short URLs
+that do not exist are mostly rejected before Redis by `known_codes`.
+Loads from the database go through `single_flight`, so a hot short URL
+missing from Redis is loaded by one request at a time, and read from a
+replica (see `db_router`). Expired links are not found, and are not kept in
+the caches past their expiry. While the database is unavailable, the loads
+raise `breaker.Unavailable` and only cached short URLs are resolved.
+"""
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+from . import (breaker, db_router, entries, known_codes, local_cache,
+               single_flight)
+from .models import Url
+
+
+def _entry(obj):
+    return {
+        'url': obj.url,
+        'expires_at': obj.expires_at,
+        'permanent': obj.permanent,
+        'on_clicks': obj.on_clicks,
+        'created': obj.created
+    }
+
+
+def _target(entry):
+    return entry and entries.Target(entry['url'], entry['expires_at'],
+                                    entry['permanent'])
+
+
+def _meta(entry):
+    return entry and {
+        'on_clicks': entry['on_clicks'],
+        'created': entry['created']
+    }
+
+
+def load(short_url):
+    with breaker.database.guard():
+        obj, alias = db_router.read(lambda: Url.objects.find(short_url))
+        if not obj and alias != DEFAULT_DB_ALIAS:
+            # The URL may not have reached the replica yet
+            obj = Url.objects.find(short_url)
+    if not obj or obj.expired:
+        known_codes.cache_missing(short_url)
+        return None
+    entries.set_many([obj])
+    return _entry(obj)
+
+
+async def aload(short_url):
+    with breaker.database.guard():
+        obj, alias = await db_router.aread(lambda: Url.objects.afind(short_url)
+                                           )
+        if not obj and alias != DEFAULT_DB_ALIAS:
+            obj = await Url.objects.afind(short_url)
+    if not obj or obj.expired:
+        await known_codes.acache_missing(short_url)
+        return None
+    await entries.aset(obj)
+    return _entry(obj)
+
+
+def _live(target):
+    """Return ``target`` if it is the `entries.Target` of a live link."""
+    if target is None or known_codes.is_missing(target):
+        return None
+    if target.expires_at is not None and target.expires_at <= timezone.now():
+        return None
+    return target
+
+
+def target(short_url):
+    """Return the `entries.Target` of ``short_url``, or ``None``."""
+    if not known_codes.might_exist(short_url):
+        return None
+    return _live(
+        single_flight.get_or_load(short_url, lambda: _target(load(short_url)),
+                                  entries.decode_target))
+
+
+async def atarget(short_url):
+    if not known_codes.might_exist(short_url):
+        return None
+
+    async def load_target():
+        return _target(await aload(short_url))
+
+    return _live(await single_flight.aget_or_load(short_url, load_target,
+                                                  entries.decode_target))
+
+
+def details(short_url):
+    """
+    Return the cached ``url``, ``expires_at``, ``permanent``, ``on_clicks``
+    and ``created`` of ``short_url``, or ``None``.
+    """
+    live = target(short_url)
+    if live is None:
+        return None
+    meta = single_flight.get_or_load(entries.meta_key(short_url),
+                                     lambda: _meta(load(short_url)),
+                                     entries.decode_meta)
+    if meta is None:
+        return None
+    return {**live._asdict(), **meta}
+
+
+async def adetails(short_url):
+    live = await atarget(short_url)
+    if live is None:
+        return None
+
+    async def load_meta():
+        return _meta(await aload(short_url))
+
+    meta = await single_flight.aget_or_load(entries.meta_key(short_url),
+                                            load_meta, entries.decode_meta)
+    if meta is None:
+        return None
+    return {**live._asdict(), **meta}
+
+
+def _cache_locally(short_url, live):
+    ttl = None
+    if live.expires_at is not None:
+        ttl = (live.expires_at - timezone.now()).total_seconds()
+    local_cache.set(short_url, live, ttl)
+
+
+def resolve(short_url):
+    """Return the `entries.Target` of ``short_url``, or ``None``."""
+    live = local_cache.get(short_url)
+    if live is None:
+        live = target(short_url)
+        if live is None:
+            return None
+        _cache_locally(short_url, live)
+    return live
+
+
+async def aresolve(short_url):
+    live = local_cache.get(short_url)
+    if live is None:
+        live = await atarget(short_url)
+        if live is None:
+            return None
+        _cache_locally(short_url, live)
+    return live
@@ -1,3 +1,5 @@
+from django.conf import settings
+from django.utils import timezone
 from rest_framework import serializers
 
 from .models import Url
@@ -11,15 +13,21 @@ class UrlSerializer(serializers.ModelSerializer):
     # Set default value for view in api docs
     class Meta:
         model = Url
-        fields = ('url', 'short_url', 'on_clicks', 'created')
+        fields = ('url', 'short_url', 'on_clicks', 'created', 'expires_at',
+                  'permanent')
         read_only_fields = ('short_url', 'on_clicks', 'created')
 
+    def validate_expires_at(self, value):
+        if value is not None and value <= timezone.now():
+            raise serializers.ValidationError('Must be in the future.')
+        return value
+
 
 class UrlSerializerDetail(serializers.ModelSerializer):
 
     class Meta:
         model = Url
-        fields = ('url', 'on_clicks', 'created')
+        fields = ('url', 'on_clicks', 'created', 'expires_at', 'permanent')
 
 
 class UrlSerializerList(serializers.ModelSerializer):
@@ -27,3 +35,10 @@ class UrlSerializerList(serializers.ModelSerializer):
     class Meta:
         model = Url
         fields = ('url', 'short_url', 'created')
+
+
+class UrlBulkSerializer(serializers.Serializer):
+    urls = serializers.ListField(
+        child=serializers.CharField(),
+        allow_empty=False,
+        max_length=settings.URL_SHORTENER_BULK_MAX_SIZE)
@@ -0,0 +1,225 @@
+"""
+Optional sharding of the URLs across database aliases.
+
+``URL_SHORTENER_SHARDS`` lists the aliases holding URLs; with a single one
+(the default) nothing is sharded and queries go through the routers as
+usual. Every short URL falls in one of ``SLOTS`` slots, and the slots are
+spread over the shards with a jump consistent hash, so adding a shard only
+moves the slots that go to it.
+
+A URL has to be found by short URL (redirects, deletes, clicks) and by
+digest (duplicates), so the id of a new URL is chosen with the slot of its
+digest: ``id = n * SLOTS + slot``, with ``n`` taken from the id sequence of
+the first shard. As short URLs are a bijection of ids (see `codes`), the
+slot of a short URL is ``decode(short_url) % SLOTS``, which is the slot of
+its URL's digest. URLs shortened before sharding was enabled keep their
+ids, and can be shortened again if their digest falls on another shard.
+
+Queries on every shard (the list, the export, the leaderboard) run on each
+shard in turn and merge the results. After changing the shards, run
+``manage.py rebalance_shards`` with the previous shards in
+``URL_SHORTENER_PREVIOUS_SHARDS``: until the URLs are moved, short URLs are
+looked for on their old shard as well.
+"""
+import heapq
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from . import codes
+
+SLOTS = 64
+
+
+def shards():
+    return settings.URL_SHORTENER_SHARDS
+
+
+def enabled():
+    return len(shards()) > 1
+
+
+def jump_hash(key, buckets):
+    """Bucket of ``key`` (Lamping and Veach's jump consistent hash)."""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) % 2**64
+        j = int((b + 1) * (1 << 31) / ((key >> 33) + 1))
+    return b
+
+
+def shard_of_slot(slot, aliases=None):
+    aliases = aliases or shards()
+    return aliases[jump_hash(slot, len(aliases))]
+
+
+def slot_of_short_url(short_url):
+    try:
+        return codes.get_generator().decode(short_url) % SLOTS
+    except ValueError:
+        # Not a short URL that could have been issued
+        return 0
+
+
+def slot_of_digest(digest):
+    return int.from_bytes(bytes(digest)[:8], 'big') % SLOTS
+
+
+def slotted_ids(ids, digests):
+    """Move the sequence values ``ids`` to the slots of ``digests``."""
+    return [
+        id * SLOTS + slot_of_digest(digest)
+        for id, digest in zip(ids, digests)
+    ]
+
+
+def sequence_alias(using):
+    """Alias whose sequence gives the ids of new URLs stored on ``using``."""
+    return shards()[0] if enabled() else using
+
+
+def all_shards():
+    """Aliases to run a query on every shard with; ``None`` is the router."""
+    return shards() if enabled() else [None]
+
+
+def merge(queryset, key, reverse=False, chunk_size=None):
+    """
+    Run ``queryset``, ordered by ``key``, on every shard and merge the rows.
+
+    With a ``chunk_size`` the rows are streamed from each shard.
+    """
+    querysets = [queryset.using(shard)
+                 for shard in shards()] if enabled() else [queryset]
+    if chunk_size:
+        querysets = [
+            queryset.iterator(chunk_size=chunk_size) for queryset in querysets
+        ]
+    return heapq.merge(*querysets, key=key, reverse=reverse)
+
+
+def shards_for_short_url(short_url):
+    """Aliases to look ``short_url`` up on, the first one being its shard."""
+    if not enabled():
+        return [None]
+    slot = slot_of_short_url(short_url)
+    aliases = [shard_of_slot(slot)]
+    if settings.URL_SHORTENER_PREVIOUS_SHARDS:
+        previous = shard_of_slot(slot, settings.URL_SHORTENER_PREVIOUS_SHARDS)
+        if previous not in aliases:
+            aliases.append(previous)
+    return aliases
+
+
+def shard_for_digest(digest):
+    if not enabled():
+        return None
+    return shard_of_slot(slot_of_digest(digest))
+
+
+def by_short_url(short_urls):
+    """Map the aliases to look ``short_urls`` up on to their short URLs."""
+    groups = defaultdict(list)
+    for short_url in short_urls:
+        for alias in shards_for_short_url(short_url):
+            groups[alias].append(short_url)
+    return groups
+
+
+def by_digest(objs):
+    """Map the shards of the ``objs`` (with a ``url_hash``) to the objs."""
+    groups = defaultdict(list)
+    for obj in objs:
+        groups[shard_for_digest(obj.url_hash)].append(obj)
+    return groups
+
+
+class Conflict(Exception):
+    """URLs that cannot be moved to their shard."""
+
+    def __init__(self, short_urls):
+        super().__init__(f'{len(short_urls)} URLs not moved, another URL '
+                         f'holds their id: {", ".join(short_urls)}')
+        self.short_urls = short_urls
+
+
+def _move(objs, source, target):
+    """
+    Move the URLs ``objs`` and their clicks, and return the short URLs of
+    the ones left on ``source`` because another URL holds their id there.
+
+    A URL shortened again on its new shard is moved without its
+    ``url_hash``, which stays on the row already there, as for the URLs
+    shortened more than once before the digest.
+    """
+    from .models import ClickBucket, Url
+    with transaction.atomic(using=target), transaction.atomic(using=source):
+        short_urls = {obj.pk: obj.short_url for obj in objs}
+        digests = [obj.url_hash for obj in objs if obj.url_hash]
+        shortened_again = {
+            bytes(url_hash)
+            for url_hash in Url.objects.using(target).filter(
+                url_hash__in=digests).exclude(
+                    pk__in=short_urls).values_list('url_hash', flat=True)
+        }
+        for obj in objs:
+            if obj.url_hash and bytes(obj.url_hash) in shortened_again:
+                obj.url_hash = None
+        # Rows already copied by an interrupted run are skipped. The rows are
+        # copied as they are, without the digests added by UrlManager.
+        Url.objects.using(target).bulk_create(objs, ignore_conflicts=True)
+        moved = {
+            pk
+            for pk, short_url in Url.objects.using(target).filter(
+                pk__in=short_urls).values_list('pk', 'short_url')
+            if short_urls[pk] == short_url
+        }
+        buckets = list(ClickBucket.objects.using(source).filter(url__in=moved))
+        for bucket in buckets:
+            bucket.pk = None
+        ClickBucket.objects.using(target).bulk_create(buckets,
+                                                      ignore_conflicts=True)
+        Url.objects.using(source).filter(pk__in=moved).delete()
+    return [short_urls[pk] for pk in short_urls if pk not in moved]
+
+
+def rebalance(batch_size=1000, dry_run=False, progress=None):
+    """
+    Move the URLs stored off their shard, and return the number of URLs
+    moved (or to move, with ``dry_run``).
+
+    ``progress`` is called with the number of URLs moved after each batch.
+    Raises `Conflict` at the end if some URLs could not be moved: they are
+    only found on their previous shard, which must stay in
+    ``URL_SHORTENER_PREVIOUS_SHARDS`` while any are left.
+    """
+    from .models import Url
+    moved = 0
+    left = []
+    for alias in dict.fromkeys(shards() +
+                               settings.URL_SHORTENER_PREVIOUS_SHARDS):
+        last = 0
+        while True:
+            batch = list(
+                Url.objects.using(alias).filter(
+                    pk__gt=last,
+                    short_url__isnull=False).order_by('pk')[:batch_size])
+            if not batch:
+                break
+            last = batch[-1].pk
+            groups = defaultdict(list)
+            for obj in batch:
+                shard = shard_of_slot(slot_of_short_url(obj.short_url))
+                if shard != alias:
+                    groups[shard].append(obj)
+            for shard, objs in groups.items():
+                not_moved = [] if dry_run else _move(objs, alias, shard)
+                moved += len(objs) - len(not_moved)
+                left += not_moved
+            if progress:
+                progress(moved)
+    if left:
+        raise Conflict(left)
+    return moved
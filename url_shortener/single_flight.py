@@ -0,0 +1,120 @@
+"""
+Single-flight loading of cache entries, with stale-while-revalidate.
+
+When a hot entry is missing, only the request that takes a short Redis lock
+on its key loads it from the database; the others poll the cache for up to
+``URL_SHORTENER_CACHE_LOCK_WAIT`` seconds and load it themselves only if it
+has not shown up by then.
+
+Entries are not left to expire while hot: the last
+``URL_SHORTENER_CACHE_STALE_TTL`` seconds of an entry's lifetime are a stale
+period, read from the remaining TTL in the same round trip as the value.
+The first request reading a stale entry takes the lock and reloads it; the
+others keep being served the stale entry meanwhile. A stale entry is also
+served when the database is unavailable (see `breaker`).
+
+Loaders load the value, cache it and return it, or return ``None`` when
+there is nothing to cache. Negative entries (see `known_codes`) just expire.
+Values are read in the ``django_redis`` format unless a ``decode`` function
+is given (see `entries`).
+"""
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from . import async_redis, breaker, known_codes, metrics
+
+# Longest a load can hold the lock, in milliseconds
+LOCK_TIMEOUT = 10000
+POLL_INTERVAL = 0.005
+
+
+def _lock_key(key):
+    return f'{cache.make_key(key)}:loading'
+
+
+def _decode(key, decode, value, ttl):
+    metrics.record_cache_lookup(key, value is not None)
+    if value is None:
+        return None, False
+    value = decode(value)
+    stale = (value != known_codes.MISSING
+             and 0 <= ttl < settings.URL_SHORTENER_CACHE_STALE_TTL * 1000)
+    return value, stale
+
+
+def _fill(key, outcome):
+    metrics.cache_fills.inc(metrics.key_family(key), outcome)
+
+
+def get_or_load(key, load, decode=None):
+    """
+    Return the value cached under ``key``, calling ``load`` to reload it.
+    """
+    decode = decode or cache.client.decode
+    client = get_redis_connection('default')
+    pipe = client.pipeline(transaction=False)
+    pipe.get(cache.make_key(key))
+    pipe.pttl(cache.make_key(key))
+    value, stale = _decode(key, decode, *pipe.execute())
+    if value is not None and not stale:
+        return value
+    if client.set(_lock_key(key), 1, nx=True, px=LOCK_TIMEOUT):
+        _fill(key, 'revalidated' if stale else 'loaded')
+        try:
+            return load()
+        except breaker.Unavailable:
+            if not stale:
+                raise
+            return value
+        finally:
+            client.delete(_lock_key(key))
+    if stale:
+        _fill(key, 'stale')
+        return value
+    deadline = time.monotonic() + settings.URL_SHORTENER_CACHE_LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        value = client.get(cache.make_key(key))
+        if value is not None:
+            _fill(key, 'waited')
+            return decode(value)
+    _fill(key, 'timeout')
+    return load()
+
+
+async def aget_or_load(key, load, decode=None):
+    """Like `get_or_load`, with a coroutine function ``load``."""
+    decode = decode or cache.client.decode
+    client = async_redis.get_client()
+    pipe = client.pipeline(transaction=False)
+    pipe.get(cache.make_key(key))
+    pipe.pttl(cache.make_key(key))
+    value, stale = _decode(key, decode, *await pipe.execute())
+    if value is not None and not stale:
+        return value
+    if await client.set(_lock_key(key), 1, nx=True, px=LOCK_TIMEOUT):
+        _fill(key, 'revalidated' if stale else 'loaded')
+        try:
+            return await load()
+        except breaker.Unavailable:
+            if not stale:
+                raise
+            return value
+        finally:
+            await client.delete(_lock_key(key))
+    if stale:
+        _fill(key, 'stale')
+        return value
+    deadline = time.monotonic() + settings.URL_SHORTENER_CACHE_LOCK_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(POLL_INTERVAL)
+        value = await client.get(cache.make_key(key))
+        if value is not None:
+            _fill(key, 'waited')
+            return decode(value)
+    _fill(key, 'timeout')
+    return await load()
@@ -1,9 +1,67 @@
+import csv
+import io
+import json
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections
+from django.db.models import Sum
+from django.test import (AsyncRequestFactory, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django_redis import get_redis_connection
+from redis import ConnectionPool
 from rest_framework import status
 from rest_framework.test import APITestCase
 
+from . import (async_views, breaker, click_stats, clicks, codes, create_queue,
+               db_router, entries, id_pool, importer, known_codes, leaderboard,
+               listing, local_cache, metrics, profiling, sharding,
+               single_flight, warmup)
+from .models import ClickBucket, Url, normalize_url, url_digest
+
+
+class RedisTestMixin:
+    """Run the tests on the Redis database ``TEST_REDIS_URL``, emptied."""
+
+    @classmethod
+    def setUpClass(cls):
+        test_caches = override_settings(
+            CACHES={
+                'default': {
+                    **settings.CACHES['default'], 'LOCATION':
+                    settings.TEST_REDIS_URL
+                }
+            })
+        test_caches.enable()
+        cls.addClassCleanup(test_caches.disable)
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
+        client = get_redis_connection()
+        used = client.connection_pool.connection_kwargs
+        test_db = ConnectionPool.from_url(
+            settings.TEST_REDIS_URL).connection_kwargs
+        if any(
+                used.get(key) != test_db.get(key)
+                for key in ('host', 'port', 'db')):
+            raise ImproperlyConfigured(
+                'The tests must run on the Redis database TEST_REDIS_URL')
+        client.flushdb()
+        local_cache.targets.clear()
 
-class WelcomeTest(APITestCase):
+
+class WelcomeTest(RedisTestMixin, APITestCase):
 
     def test_welcome(self):
         response = self.client.get('/')
@@ -12,7 +70,8 @@ class WelcomeTest(APITestCase):
                          {'message': 'Welcome to the URL shortener API'})
 
 
-class UrlShortenerTest(APITestCase):
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0)
+class UrlShortenerTest(RedisTestMixin, APITestCase):
 
     def test_shorten_url(self):
         response = self.client.post('/url_shortener/',
@@ -23,7 +82,7 @@ class UrlShortenerTest(APITestCase):
         self.assertEqual(len(response.data['short_url']), 6)
         # test cache
         self.assertEqual(
-            cache.get(response.data['short_url'])["url"],
+            entries.get(response.data['short_url'])['url'],
             'https://www.google.com/')
 
     def test_shorten_invalid_url(self):
@@ -55,7 +114,7 @@ class UrlShortenerTest(APITestCase):
         self.assertEqual(response.data[0]['url'], 'https://www.google.com/')
         self.assertEqual(len(response.data[0]['short_url']), 6)
         # test cache
-        self.assertEqual(cache.get('/urls/'), response.data)
+        self.assertEqual(cache.get('/urls/')['data'], response.data)
 
     def test_info(self):
         response = self.client.post('/url_shortener/',
@@ -68,7 +127,7 @@ class UrlShortenerTest(APITestCase):
         self.assertEqual(response.data['url'], 'https://www.google.com/')
         self.assertEqual(response.data['on_clicks'], 0)
         # test cache
-        _cache = cache.get(short_url)
+        _cache = entries.get(short_url)
         self.assertEqual(_cache['url'], 'https://www.google.com/')
         self.assertEqual(_cache['on_clicks'], 0)
 
@@ -104,11 +163,1523 @@ class UrlShortenerTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['url'], 'https://www.google.com/')
         self.assertEqual(response.data['on_clicks'], 1)
-        # test cache
-        _cache = cache.get(short_url)
+        # test cache (the click is still buffered)
+        _cache = entries.get(short_url)
         self.assertEqual(_cache['url'], 'https://www.google.com/')
-        self.assertEqual(_cache['on_clicks'], 1)
+        self.assertEqual(_cache['on_clicks'], 0)
+        self.assertEqual(clicks.pending(short_url), 1)
 
     def test_invalid_url(self):
         response = self.client.get('/url/invalid_url/')
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class CodeGeneratorTest(TestCase):
+
+    def test_bijective(self):
+        generator = codes.FeistelCodeGenerator(key='key', length=2)
+        generated = {generator.generate(i) for i in range(generator.space)}
+        self.assertEqual(len(generated), 62**2)
+        for i in (0, 1, 1000, generator.space - 1):
+            self.assertEqual(generator.decode(generator.generate(i)), i)
+
+    def test_codes(self):
+        generator = codes.FeistelCodeGenerator(key='key')
+        first, second = generator.generate(1), generator.generate(2)
+        self.assertEqual(len(first), 6)
+        self.assertNotEqual(first[:5], second[:5])
+        self.assertNotEqual(
+            codes.FeistelCodeGenerator(key='other').generate(1), first)
+        with self.assertRaises(ValueError):
+            generator.generate(62**6)
+
+    def test_created_in_one_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            obj = Url.objects.create(url='https://www.google.com/')
+        self.assertEqual(obj.short_url, codes.generate(obj.pk))
+        self.assertEqual(Url.objects.get(pk=obj.pk).short_url, obj.short_url)
+        self.assertFalse(
+            any(query['sql'].startswith('UPDATE')
+                for query in queries.captured_queries))
+
+    def test_skips_codes_of_old_trigger(self):
+        next_id = Url.objects.allocate_ids(1)[0] + 1
+        Url.objects.create(pk=10**9,
+                           url='https://www.python.org/',
+                           short_url=codes.generate(next_id))
+        obj = Url.objects.create(url='https://www.google.com/')
+        self.assertEqual(obj.pk, next_id + 1)
+        self.assertEqual(obj.short_url, codes.generate(next_id + 1))
+
+
+@override_settings(URL_SHORTENER_ID_BLOCK_SIZE=10)
+class IdPoolTest(RedisTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        id_pool._pools.clear()
+
+    def nextval_queries(self, queries):
+        return [
+            query for query in queries.captured_queries
+            if 'nextval' in query['sql']
+        ]
+
+    def test_creates_take_ids_from_memory(self):
+        with CaptureQueriesContext(connection) as queries:
+            objs = [
+                Url.objects.create(url=f'https://example.com/{i}')
+                for i in range(5)
+            ]
+        self.assertEqual(len(self.nextval_queries(queries)), 1)
+        self.assertEqual([obj.pk for obj in objs],
+                         list(range(objs[0].pk, objs[0].pk + 5)))
+
+    def test_refills_when_low(self):
+        pool = id_pool.IdPool('default', Url._meta.db_table)
+        self.assertEqual(len(pool.take(9)), 9)
+        for thread in threading.enumerate():
+            if thread.name == 'id-pool':
+                thread.join()
+        self.assertEqual(len(pool), 11)
+
+    def test_large_reservations_skip_pool(self):
+        self.assertEqual(len(Url.objects.allocate_ids(10)), 10)
+        self.assertEqual(id_pool._pools, {})
+
+
+class UrlDigestTest(RedisTestMixin, APITestCase):
+
+    def test_normalize_url(self):
+        self.assertEqual(normalize_url(' HTTPS://User@WWW.Google.COM'),
+                         'https://User@www.google.com/')
+        self.assertEqual(url_digest('https://www.google.com/'),
+                         url_digest('HTTPS://WWW.GOOGLE.COM'))
+        self.assertNotEqual(url_digest('https://www.google.com/a'),
+                            url_digest('https://www.google.com/A'))
+        self.assertEqual(len(url_digest('https://www.google.com/')), 16)
+
+    def test_duplicate_is_one_insert(self):
+        Url.objects.create(url='https://www.google.com/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/url_shortener/',
+                                        {'url': 'HTTPS://WWW.GOOGLE.COM'},
+                                        format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {'error': 'URL already shortened'})
+        statements = [
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith(('INSERT', 'SELECT "'))
+        ]
+        self.assertEqual(len(statements), 1)
+        self.assertIn('ON CONFLICT', statements[0])
+        self.assertEqual(Url.objects.count(), 1)
+
+    def test_insert_new(self):
+        first, duplicate = Url.objects.insert_new([
+            Url(url='https://www.google.com/'),
+            Url(url='https://www.python.org/')
+        ]), Url.objects.insert_new([
+            Url(url='https://www.google.com'),
+            Url(url='https://www.djangoproject.com/')
+        ])
+        self.assertEqual(len(first), 2)
+        self.assertEqual([obj.url for obj in duplicate],
+                         ['https://www.djangoproject.com/'])
+        obj = Url.objects.get(pk=duplicate[0].pk)
+        self.assertEqual(obj.short_url, codes.generate(obj.pk))
+        self.assertEqual(bytes(obj.url_hash),
+                         url_digest('https://www.djangoproject.com/'))
+
+
+class UrlShortenerBulkTest(RedisTestMixin, APITestCase):
+
+    def test_bulk_shorten(self):
+        response = self.client.post('/url_shortener/',
+                                    {'url': 'https://www.google.com/'},
+                                    format='json')
+        existing = response.data['short_url']
+        urls = [
+            'https://www.google.com/', 'https://www.python.org/',
+            'invalid_url', 'https://www.djangoproject.com/'
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/url_shortener/bulk/', {'urls': urls},
+                                        format='json')
+        inserts = [
+            query for query in queries.captured_queries
+            if query['sql'].startswith('INSERT')
+        ]
+        self.assertEqual(len(inserts), 1)
+        self.assertFalse(
+            any(query['sql'].startswith('UPDATE')
+                for query in queries.captured_queries))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['status'] for item in response.data],
+                         ['exists', 'created', 'invalid', 'created'])
+        self.assertEqual(response.data[0]['short_url'], existing)
+        for item in (response.data[1], response.data[3]):
+            self.assertEqual(len(item['short_url']), 6)
+            self.assertEqual(
+                entries.get(item['short_url'])['url'], item['url'])
+        self.assertEqual(Url.objects.count(), 3)
+
+    def test_bulk_shorten_too_long(self):
+        too_long = 'https://www.google.com/' + 'a' * 1000
+        response = self.client.post(
+            '/url_shortener/bulk/',
+            {'urls': [too_long, 'https://www.python.org/']},
+            format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['status'] for item in response.data],
+                         ['invalid', 'created'])
+        self.assertEqual(Url.objects.count(), 1)
+
+    def test_bulk_shorten_empty(self):
+        response = self.client.post('/url_shortener/bulk/', {'urls': []},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class UrlListTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.urls = [
+            Url.objects.create(url=f'https://www.google.com/{i}')
+            for i in range(5)
+        ]
+
+    def next_path(self, response):
+        link = response.headers.get('Link')
+        if link:
+            url = urlsplit(link[1:link.index('>')])
+            return f'{url.path}?{url.query}'
+
+    def get_pages(self, path):
+        pages = []
+        while path:
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append([item['short_url'] for item in response.data])
+            path = self.next_path(response)
+        return pages
+
+    def test_pages(self):
+        short_urls = [obj.short_url for obj in reversed(self.urls)]
+        self.assertEqual(self.get_pages('/urls/?page_size=2'),
+                         [short_urls[:2], short_urls[2:4], short_urls[4:]])
+        self.assertEqual(self.get_pages('/urls/'), [short_urls])
+
+    def test_same_created(self):
+        Url.objects.update(created=self.urls[0].created)
+        short_urls = [obj.short_url for obj in reversed(self.urls)]
+        self.assertEqual(sum(self.get_pages('/urls/?page_size=2'), []),
+                         short_urls)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/urls/?cursor=invalid')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stream(self):
+        response = self.client.get('/urls/?page_size=2&stream=1')
+        self.assertTrue(response.streaming)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(data, self.client.get('/urls/?page_size=2').data)
+        self.assertIn('rel="next"', response.headers['Link'])
+
+    def test_invalidation(self):
+        first = '/urls/?page_size=2'
+        second = self.next_path(self.client.get(first))
+        third = self.next_path(self.client.get(second))
+        self.client.get(third)
+
+        self.client.post('/url_shortener/', {'url': 'https://www.python.org/'},
+                         format='json')
+        self.assertIsNone(cache.get(first))
+        self.assertIsNotNone(cache.get(second))
+        self.assertIsNotNone(cache.get(third))
+
+        # The second page holds the third and fourth newest URLs
+        self.client.delete(f'/info/{self.urls[1].short_url}/')
+        self.assertIsNone(cache.get(second))
+        self.assertIsNotNone(cache.get(third))
+
+
+class UrlExportTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.old = Url.objects.create(url='https://www.google.com/',
+                                      on_clicks=3)
+        Url.objects.filter(pk=self.old.pk).update(
+            created=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        self.new = Url.objects.create(url='https://www.python.org/')
+
+    def test_ndjson(self):
+        response = self.client.get('/urls/export/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([row['short_url'] for row in rows],
+                         [self.old.short_url, self.new.short_url])
+        self.assertEqual(rows[0]['on_clicks'], 3)
+        self.assertEqual(rows[0]['created'], '2020-01-01T00:00:00Z')
+
+    def test_csv_filters(self):
+        response = self.client.get(
+            '/urls/export/?format=csv&created_to=2021-01-01')
+        rows = list(
+            csv.reader(b''.join(
+                response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], ['url', 'short_url', 'on_clicks', 'created'])
+        self.assertEqual([row[1] for row in rows[1:]], [self.old.short_url])
+        response = self.client.get('/urls/export/?min_clicks=4')
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+    def test_invalid_parameters(self):
+        for query in ('format=xml', 'created_from=yesterday', 'min_clicks=-1'):
+            response = self.client.get(f'/urls/export/?{query}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_urls_command(self):
+        out = io.StringIO()
+        call_command('export_urls', '--created-from', '2021-01-01', stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([row['short_url'] for row in rows],
+                         [self.new.short_url])
+
+
+class UrlImportTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.existing = Url.objects.create(url='https://www.google.com/')
+
+    def test_csv(self):
+        data = io.StringIO(
+            'url,short_url,on_clicks,created\n'
+            'https://www.google.com/,abc,1,2020-01-01T00:00:00Z\n'
+            'https://www.python.org/,def,5,2020-01-01T00:00:00Z\n'
+            'https://www.python.org/,ghi,0,\n'
+            'not a url,jkl,0,\n'
+            '"https://example.com/?a=1,2",mno,,\n')
+        url_importer = importer.Importer(chunk_size=2)
+        self.assertEqual(url_importer.run(importer.read_csv(data)), 2)
+        self.assertEqual(
+            (url_importer.read, url_importer.duplicates, url_importer.invalid),
+            (5, 2, 1))
+        python = Url.objects.get(url='https://www.python.org/')
+        self.assertEqual(python.on_clicks, 5)
+        self.assertEqual(python.created,
+                         datetime(2020, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(python.short_url, codes.generate(python.pk))
+        self.assertTrue(
+            Url.objects.filter(url='https://example.com/?a=1,2').exists())
+        self.assertTrue(known_codes.known.might_exist(python.short_url))
+        self.assertEqual(leaderboard.top(1)[0]['short_url'], python.short_url)
+
+    def test_expired_duplicate(self):
+        Url.objects.filter(pk=self.existing.pk).update(
+            expires_at=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        data = io.StringIO('{"url": "https://www.google.com/"}\n')
+        url_importer = importer.Importer()
+        self.assertEqual(url_importer.run(importer.read_ndjson(data)), 1)
+        self.assertEqual(url_importer.duplicates, 0)
+        self.assertFalse(Url.objects.filter(pk=self.existing.pk).exists())
+        google = Url.objects.get(url='https://www.google.com/')
+        self.assertIsNone(google.expires_at)
+        self.assertNotEqual(google.short_url, self.existing.short_url)
+
+    def test_ndjson_warm_cache(self):
+        data = io.StringIO('{"url": "https://www.python.org/"}\n\n'
+                           '{"url": "https://www.google.com/"}\n')
+        url_importer = importer.Importer(warm_cache=True)
+        self.assertEqual(url_importer.run(importer.read_ndjson(data)), 1)
+        python = Url.objects.get(url='https://www.python.org/')
+        self.assertEqual(entries.get(python.short_url)['url'], python.url)
+        self.assertIsNone(entries.get(self.existing.short_url))
+
+    def test_import_urls_command(self):
+        out = io.StringIO()
+        call_command('export_urls', stdout=out)
+        Url.objects.all().delete()
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson') as file:
+            file.write(out.getvalue() + 'not json\n')
+            file.flush()
+            with self.assertRaises(CommandError):
+                call_command('import_urls',
+                             file.name,
+                             '--chunk-size',
+                             '1',
+                             stdout=io.StringIO())
+        # Chunks loaded before the error are kept
+        self.assertTrue(Url.objects.filter(url=self.existing.url).exists())
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as file:
+            file.write('url\nhttps://www.google.com/\nftp:/broken\n')
+            file.flush()
+            out = io.StringIO()
+            call_command('import_urls', file.name, stdout=out)
+        self.assertIn('0 imported, 1 already shortened, 1 invalid',
+                      out.getvalue())
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0)
+class AsyncViewsTest(RedisTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.obj = Url.objects.create(url='https://www.google.com/')
+        self.factory = AsyncRequestFactory()
+
+    async def test_redirect(self):
+        short_url = self.obj.short_url
+        response = await async_views.redirect(
+            self.factory.get(f'/url/{short_url}/'), short_url)
+        self.assertEqual(response.status_code,
+                         status.HTTP_301_MOVED_PERMANENTLY)
+        self.assertEqual(response.url, 'https://www.google.com/')
+        # Filled the cache shared with the sync views
+        cache_entry = await sync_to_async(entries.get)(short_url)
+        self.assertEqual(cache_entry['url'], 'https://www.google.com/')
+        local_cache.targets.clear()
+        response = await async_views.redirect(
+            self.factory.get(f'/url/{short_url}/'), short_url)
+        self.assertEqual(response.url, 'https://www.google.com/')
+        self.assertEqual(await clicks.apending(short_url), 2)
+
+    async def test_redirect_not_found(self):
+        response = await async_views.redirect(
+            self.factory.get('/url/invalid_url/'), 'invalid_url')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_info(self):
+        short_url = self.obj.short_url
+        await sync_to_async(cache.delete)(short_url)
+        await clicks.arecord(short_url)
+        response = await async_views.info(
+            self.factory.get(f'/info/{short_url}/'), short_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content)
+        self.assertEqual(data['url'], 'https://www.google.com/')
+        self.assertEqual(data['on_clicks'], 1)
+        self.assertTrue(data['created'].endswith('Z'))
+        response = await async_views.info(self.factory.get('/info/invalid/'),
+                                          'invalid')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_info_delete(self):
+        short_url = self.obj.short_url
+        response = await async_views.info(
+            self.factory.delete(f'/info/{short_url}/'), short_url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(await
+                         Url.objects.filter(short_url=short_url).aexists())
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0,
+                   URL_SHORTENER_FAST_REDIRECT=True)
+class FastRedirectTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.obj = Url.objects.create(url='https://www.google.com/')
+        self.path = f'/url/{self.obj.short_url}/'
+
+    def test_redirect(self):
+        response = self.client.get(self.path)
+        self.assertEqual(response.status_code,
+                         status.HTTP_301_MOVED_PERMANENTLY)
+        self.assertEqual(response.url, 'https://www.google.com/')
+        self.assertEqual(clicks.pending(self.obj.short_url), 1)
+        # Answered before the session middleware
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+
+    def test_redirect_not_found(self):
+        response = self.client.get('/url/invalid/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.json(), {'error': 'URL not found'})
+
+    def test_other_requests(self):
+        response = self.client.post(self.path)
+        self.assertEqual(response.status_code,
+                         status.HTTP_405_METHOD_NOT_ALLOWED)
+        response = self.client.get(f'/info/{self.obj.short_url}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(hasattr(response.wsgi_request, 'session'))
+
+    @override_settings(URL_SHORTENER_FAST_REDIRECT=False)
+    def test_disabled(self):
+        response = self.client.get(self.path)
+        self.assertEqual(response.status_code,
+                         status.HTTP_301_MOVED_PERMANENTLY)
+        self.assertTrue(hasattr(response.wsgi_request, 'session'))
+
+    async def test_async_redirect(self):
+        response = await self.async_client.get(self.path)
+        self.assertEqual(response.status_code,
+                         status.HTTP_301_MOVED_PERMANENTLY)
+        self.assertEqual(response.url, 'https://www.google.com/')
+        self.assertFalse(hasattr(response.asgi_request, 'session'))
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0)
+class MetricsTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.obj = Url.objects.create(url='https://www.google.com/')
+        cache.delete(self.obj.short_url)
+
+    def sample(self, name):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for line in response.content.decode().splitlines():
+            if line.startswith(name + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        return 0
+
+    def test_requests(self):
+        route = (
+            'url_shortener_requests_total{route="url_shortener:url_redirect"'
+            ',method="GET",status="301"}')
+        misses = 'url_shortener_cache_lookups_total{family="url",result="miss"}'
+        hits = 'url_shortener_cache_lookups_total{family="url",result="hit"}'
+        queries = ('url_shortener_request_db_queries_count'
+                   '{route="url_shortener:info"}')
+        before = [self.sample(name) for name in (route, misses, hits, queries)]
+        self.client.get(f'/url/{self.obj.short_url}/')
+        local_cache.targets.clear()
+        self.client.get(f'/url/{self.obj.short_url}/')
+        self.client.get(f'/info/{self.obj.short_url}/')
+        after = [self.sample(name) for name in (route, misses, hits, queries)]
+        self.assertEqual([b - a for a, b in zip(before, after)], [2, 1, 2, 1])
+
+    def test_click_flush(self):
+        self.client.get(f'/url/{self.obj.short_url}/')
+        self.assertEqual(self.sample('url_shortener_click_pending_urls'), 1)
+        flushed = self.sample('url_shortener_clicks_flushed_total')
+        clicks.flush()
+        self.assertEqual(self.sample('url_shortener_click_pending_urls'), 0)
+        self.assertEqual(self.sample('url_shortener_clicks_flushed_total'),
+                         flushed + 1)
+        self.assertLess(self.sample('url_shortener_click_flush_lag_seconds'),
+                        5)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('route', ),
+                                      (0.1, 1))
+        metrics.registry.remove(histogram)
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.5, 'a')
+        histogram.observe(0.1, 'a')
+        self.assertEqual(list(histogram.samples()), [
+            ('test_seconds_bucket', (('route', 'a'), ('le', 0.1)), 2),
+            ('test_seconds_bucket', (('route', 'a'), ('le', 1)), 3),
+            ('test_seconds_bucket', (('route', 'a'), ('le', '+Inf')), 3),
+            ('test_seconds_sum', (('route', 'a'), ), 0.65),
+            ('test_seconds_count', (('route', 'a'), ), 3),
+        ])
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0)
+class KnownCodesTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        # A filter built now, without the background thread
+        bloom = known_codes.known.filter
+        self.addCleanup(setattr, known_codes.known, 'filter', bloom)
+        known_codes.known.filter = known_codes.BloomFilter(1000, 0.001)
+        self.obj = Url.objects.create(url='https://www.google.com/')
+
+    def test_unknown_short_url(self):
+        with self.assertNumQueries(0):
+            response = self.client.get('/url/zzzzzz/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIsNone(cache.get('zzzzzz'))
+        with self.assertNumQueries(0):
+            response = self.client.get('/info/zzzzzz/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get('/url/toolong1/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_new_short_url(self):
+        response = self.client.get(f'/url/{self.obj.short_url}/')
+        self.assertEqual(response.status_code,
+                         status.HTTP_301_MOVED_PERMANENTLY)
+        Url.objects.create(url='https://www.example.com/', short_url='yyyyyy')
+        response = self.client.get('/url/yyyyyy/')
+        self.assertEqual(response.status_code,
+                         status.HTTP_301_MOVED_PERMANENTLY)
+
+    @override_settings(URL_SHORTENER_BLOOM_FILTER=False)
+    def test_negative_cache(self):
+        response = self.client.get('/url/zzzzzz/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(cache.get('zzzzzz'), known_codes.MISSING)
+        with self.assertNumQueries(0):
+            response = self.client.get('/info/zzzzzz/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        # Dropped when the short URL is issued
+        Url.objects.create(url='https://www.example.com/', short_url='zzzzzz')
+        response = self.client.get('/url/zzzzzz/')
+        self.assertEqual(response.status_code,
+                         status.HTTP_301_MOVED_PERMANENTLY)
+
+    def test_delete(self):
+        short_url = self.obj.short_url
+        self.client.delete(f'/info/{short_url}/')
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/url/{short_url}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(cache.get(short_url), known_codes.MISSING)
+
+    def test_bloom_filter(self):
+        bloom = known_codes.BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(codes.generate(i))
+        self.assertTrue(all(codes.generate(i) in bloom for i in range(1000)))
+        false_positives = sum(
+            codes.generate(i) in bloom for i in range(1000, 11000))
+        self.assertLess(false_positives, 200)
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0)
+class LeaderboardTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.objs = [
+            Url.objects.create(url=f'https://www.example.com/{i}')
+            for i in range(3)
+        ]
+        for obj, count in zip(self.objs, (2, 3, 1)):
+            for _ in range(count):
+                clicks.record(obj.short_url)
+        clicks.flush()
+
+    def test_top(self):
+        response = self.client.get('/urls/top/?n=2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), [
+            {
+                'url': 'https://www.example.com/1',
+                'short_url': self.objs[1].short_url,
+                'on_clicks': 3
+            },
+            {
+                'url': 'https://www.example.com/0',
+                'short_url': self.objs[0].short_url,
+                'on_clicks': 2
+            },
+        ])
+        for _ in range(3):
+            clicks.record(self.objs[2].short_url)
+        clicks.flush()
+        response = self.client.get('/urls/top/?n=1')
+        self.assertEqual(response.json()[0]['short_url'],
+                         self.objs[2].short_url)
+        response = self.client.get('/urls/top/?n=x')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(URL_SHORTENER_TOP_SIZE=2)
+    def test_delete(self):
+        clicks.record(self.objs[0].short_url)
+        clicks.flush()
+        self.assertEqual(get_redis_connection().zcard(leaderboard.TOP_KEY), 2)
+        self.client.delete(f'/info/{self.objs[1].short_url}/')
+        # The third URL is read back from the database
+        response = self.client.get('/urls/top/?n=2')
+        self.assertEqual([entry['short_url'] for entry in response.json()],
+                         [self.objs[0].short_url, self.objs[2].short_url])
+
+    def test_rebuild(self):
+        Url.objects.filter(pk=self.objs[2].pk).update(on_clicks=10)
+        call_command('rebuild_leaderboard', stdout=io.StringIO())
+        with self.assertNumQueries(0):
+            response = self.client.get('/urls/top/?n=3')
+        self.assertEqual([entry['on_clicks'] for entry in response.json()],
+                         [10, 3, 2])
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0)
+class ClickStatsTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.obj = Url.objects.create(url='https://www.google.com/')
+        self.path = f'/info/{self.obj.short_url}/stats/'
+
+    def test_hourly(self):
+        for _ in range(3):
+            self.client.get(f'/url/{self.obj.short_url}/')
+        clicks.flush()
+        bucket = ClickBucket.objects.get(url=self.obj)
+        self.assertEqual(bucket.granularity, ClickBucket.HOUR)
+        self.assertEqual(bucket.count, 3)
+        self.assertEqual(bucket.start.minute, 0)
+        response = self.client.get(self.path)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json()['buckets'],
+            [{
+                'start': bucket.start.isoformat().replace('+00:00', 'Z'),
+                'clicks': 3
+            }])
+
+    def test_compact(self):
+        day = datetime.now(timezone.utc).replace(
+            hour=0, minute=0, second=0, microsecond=0) - timedelta(days=40)
+        recent = datetime.now(timezone.utc).replace(
+            minute=0, second=0, microsecond=0) - timedelta(hours=1)
+        ClickBucket.objects.bulk_create([
+            ClickBucket(url=self.obj,
+                        granularity=ClickBucket.HOUR,
+                        start=day + timedelta(hours=1),
+                        count=2),
+            ClickBucket(url=self.obj,
+                        granularity=ClickBucket.HOUR,
+                        start=day + timedelta(hours=5),
+                        count=3),
+            ClickBucket(url=self.obj,
+                        granularity=ClickBucket.DAY,
+                        start=day,
+                        count=1),
+            ClickBucket(url=self.obj,
+                        granularity=ClickBucket.HOUR,
+                        start=recent,
+                        count=4),
+        ])
+        call_command('compact_click_stats', stdout=io.StringIO())
+        self.assertEqual(
+            sorted(
+                ClickBucket.objects.values_list('granularity', 'start',
+                                                'count')),
+            [(ClickBucket.DAY, day, 6), (ClickBucket.HOUR, recent, 4)])
+        response = self.client.get(
+            self.path, {
+                'granularity': 'day',
+                'from': (day - timedelta(days=1)).date().isoformat()
+            })
+        self.assertEqual(
+            [bucket['clicks'] for bucket in response.json()['buckets']],
+            [6, 4])
+
+    def test_invalid(self):
+        response = self.client.get(self.path, {'granularity': 'week'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(self.path, {'from': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get('/info/zzzzzz/stats/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class WarmupTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.objs = [
+            Url.objects.create(url=f'https://example.com/{clicks}',
+                               on_clicks=clicks) for clicks in (5, 9, 0, 7)
+        ]
+        cache.clear()
+
+    def test_warm_by_clicks(self):
+        self.objs[3].url = 'https://example.com/kept'
+        entries.set_many([self.objs[3]])
+        self.assertEqual(warmup.warm(2, batch_size=1), 1)
+        self.assertEqual(entries.get(self.objs[1].short_url)['on_clicks'], 9)
+        self.assertEqual(
+            entries.get(self.objs[3].short_url)['url'],
+            'https://example.com/kept')
+        self.assertIsNone(entries.get(self.objs[0].short_url))
+
+    def test_warm_by_recent_clicks(self):
+        hour = datetime.now(timezone.utc).replace(minute=0,
+                                                  second=0,
+                                                  microsecond=0)
+        click_stats.add([(self.objs[2].pk, ClickBucket.HOUR, hour, 3),
+                         (self.objs[0].pk, ClickBucket.HOUR,
+                          hour - timedelta(days=2), 10)])
+        out = io.StringIO()
+        call_command('warm_cache',
+                     '--by',
+                     'recent',
+                     '--count',
+                     '5',
+                     stdout=out)
+        self.assertEqual(out.getvalue(), 'Cached 1 URLs.\n')
+        self.assertIsNotNone(entries.get(self.objs[2].short_url))
+        self.assertIsNone(entries.get(self.objs[0].short_url))
+
+    @override_settings(URL_SHORTENER_WARM_CACHE_ON_STARTUP=10)
+    def test_on_startup_runs_once(self):
+        with mock.patch.object(warmup, '_warm_on_startup') as warm:
+            warmup.on_startup()
+            warmup.on_startup()
+            for thread in threading.enumerate():
+                if thread.name == 'cache-warmup':
+                    thread.join()
+        warm.assert_called_once_with(10)
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0,
+                   URL_SHORTENER_BLOOM_FILTER=False)
+class CacheEntriesTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.obj = Url.objects.create(url='https://www.google.com/')
+
+    def test_compact_values(self):
+        long_url = 'https://example.com/' + 'a' * 500
+        self.assertLess(len(entries.encode_target(long_url)), 100)
+        self.assertEqual(
+            entries.decode_target(entries.encode_target(long_url)),
+            entries.Target(long_url, None, True))
+        self.assertEqual(entries.encode_target(self.obj.url),
+                         self.obj.url.encode())
+        meta = entries.encode_meta(self.obj.on_clicks, self.obj.created)
+        self.assertEqual(len(meta), 16)
+        self.assertEqual(entries.decode_meta(meta), {
+            'on_clicks': 0,
+            'created': self.obj.created
+        })
+
+    def test_flush_keeps_redirect_target(self):
+        short_url = self.obj.short_url
+        self.client.get(f'/url/{short_url}/')
+        clicks.flush()
+        self.assertIsNone(entries.get(short_url))
+        local_cache.targets.clear()
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/url/{short_url}/')
+        self.assertEqual(response.url, self.obj.url)
+        response = self.client.get(f'/info/{short_url}/')
+        self.assertEqual(response.data['on_clicks'], 2)
+
+    def test_legacy_entries(self):
+        short_url = self.obj.short_url
+        cache.set(
+            short_url, {
+                'url': 'https://www.python.org/',
+                'on_clicks': 3,
+                'created': self.obj.created
+            })
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/url/{short_url}/')
+        self.assertEqual(response.url, 'https://www.python.org/')
+        out = io.StringIO()
+        call_command('migrate_cache_entries', stdout=out)
+        self.assertEqual(out.getvalue(), 'Migrated 1 cache entries.\n')
+        self.assertEqual(
+            get_redis_connection('default').get(cache.make_key(short_url)),
+            b'https://www.python.org/')
+        self.assertEqual(entries.get(short_url)['on_clicks'], 3)
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0,
+                   URL_SHORTENER_BLOOM_FILTER=False)
+class ExpiryTest(RedisTestMixin, APITestCase):
+
+    def test_create_with_expiry(self):
+        response = self.client.post('/url_shortener/', {
+            'url': 'https://www.google.com/',
+            'expires_at': '2020-01-01T00:00:00Z'
+        },
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+        response = self.client.post('/url_shortener/', {
+            'url': 'https://www.google.com/',
+            'expires_at': expires_at.isoformat()
+        },
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        short_url = response.data['short_url']
+        self.assertEqual(entries.get(short_url)['expires_at'], expires_at)
+        # The cache entries expire with the link
+        ttl = get_redis_connection('default').pttl(cache.make_key(short_url))
+        self.assertTrue(0 < ttl <= 30000)
+        response = self.client.get(f'/info/{short_url}/')
+        self.assertEqual(response.data['expires_at'], expires_at)
+
+    def test_expired_link_is_not_found(self):
+        obj = Url.objects.create(url='https://www.google.com/',
+                                 expires_at=datetime.now(timezone.utc) +
+                                 timedelta(hours=1))
+        self.assertEqual(
+            self.client.get(f'/url/{obj.short_url}/').status_code,
+            status.HTTP_301_MOVED_PERMANENTLY)
+        # Cached before the link was cut short
+        Url.objects.filter(pk=obj.pk).update(
+            expires_at=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        get_redis_connection('default').set(
+            cache.make_key(obj.short_url),
+            entries.encode_target(obj.url,
+                                  datetime(2020, 1, 1, tzinfo=timezone.utc)))
+        local_cache.targets.clear()
+        for path in (f'/url/{obj.short_url}/', f'/info/{obj.short_url}/'):
+            self.assertEqual(
+                self.client.get(path).status_code, status.HTTP_404_NOT_FOUND)
+        cache.delete(obj.short_url)
+        self.assertEqual(
+            self.client.get(f'/url/{obj.short_url}/').status_code,
+            status.HTTP_404_NOT_FOUND)
+
+    def test_shorten_expired_url_again(self):
+        past = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        expired = Url.objects.create(url='https://www.google.com/',
+                                     expires_at=past)
+        response = self.client.post('/url_shortener/',
+                                    {'url': 'https://www.google.com/'},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        short_url = response.data['short_url']
+        self.assertNotEqual(short_url, expired.short_url)
+        self.assertFalse(Url.objects.filter(pk=expired.pk).exists())
+        self.assertEqual(
+            self.client.get(f'/url/{short_url}/').status_code,
+            status.HTTP_301_MOVED_PERMANENTLY)
+
+    def test_bulk_shorten_expired_url_again(self):
+        past = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        expired = Url.objects.create(url='https://www.google.com/',
+                                     expires_at=past)
+        live = Url.objects.create(url='https://example.com/')
+        response = self.client.post(
+            '/url_shortener/bulk/',
+            {'urls': ['https://www.google.com/', 'https://example.com/']},
+            format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        created, exists = response.data
+        self.assertEqual(created['status'], 'created')
+        self.assertNotEqual(created['short_url'], expired.short_url)
+        self.assertEqual(
+            self.client.get(f'/url/{created["short_url"]}/').status_code,
+            status.HTTP_301_MOVED_PERMANENTLY)
+        self.assertEqual(exists['status'], 'exists')
+        self.assertEqual(exists['short_url'], live.short_url)
+
+    def test_purge_expired(self):
+        past = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        expired = [
+            Url.objects.create(url=f'https://example.com/{i}',
+                               expires_at=past,
+                               on_clicks=1) for i in range(3)
+        ]
+        live = Url.objects.create(url='https://www.google.com/',
+                                  expires_at=datetime.now(timezone.utc) +
+                                  timedelta(hours=1))
+        kept = Url.objects.create(url='https://www.python.org/')
+        leaderboard.rebuild()
+        out = io.StringIO()
+        call_command('purge_expired', '--batch-size', '2', stdout=out)
+        self.assertEqual(out.getvalue(), 'Deleted 3 expired links.\n')
+        self.assertEqual(set(Url.objects.all()), {live, kept})
+        self.assertEqual(leaderboard.top(5), [])
+        self.assertIsNone(entries.get(expired[0].short_url))
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0,
+                   URL_SHORTENER_BLOOM_FILTER=False,
+                   URL_SHORTENER_REDIRECT_MAX_AGE=3600,
+                   URL_SHORTENER_TEMPORARY_REDIRECT_MAX_AGE=60)
+class HttpCacheTest(RedisTestMixin, APITestCase):
+
+    def test_permanent_redirect(self):
+        obj = Url.objects.create(url='https://www.google.com/')
+        response = self.client.get(f'/url/{obj.short_url}/')
+        self.assertEqual(response.status_code,
+                         status.HTTP_301_MOVED_PERMANENTLY)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+        obj = Url.objects.create(url='https://www.python.org/',
+                                 expires_at=datetime.now(timezone.utc) +
+                                 timedelta(seconds=30))
+        response = self.client.get(f'/url/{obj.short_url}/')
+        max_age = int(response['Cache-Control'].split('=')[1])
+        self.assertTrue(0 < max_age <= 30)
+
+    def test_temporary_redirect(self):
+        response = self.client.post('/url_shortener/', {
+            'url': 'https://www.google.com/',
+            'permanent': False
+        },
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        short_url = response.data['short_url']
+        self.assertEqual(entries.get(short_url)['permanent'], False)
+        for _ in range(2):
+            response = self.client.get(f'/url/{short_url}/')
+            self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+            self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        clicks.flush()
+        self.assertEqual(Url.objects.get(short_url=short_url).on_clicks, 2)
+        response = self.client.get(f'/info/{short_url}/')
+        self.assertEqual(response.data['permanent'], False)
+
+    def test_conditional_reads(self):
+        obj = Url.objects.create(url='https://www.google.com/')
+        etags = {}
+        for path in (f'/info/{obj.short_url}/', '/urls/'):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            etags[path] = response['ETag']
+            response = self.client.get(path, HTTP_IF_NONE_MATCH=etags[path])
+            self.assertEqual(response.status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response.content, b'')
+        # The count changes with the clicks
+        self.client.get(f'/url/{obj.short_url}/')
+        response = self.client.get(
+            f'/info/{obj.short_url}/',
+            HTTP_IF_NONE_MATCH=etags[f'/info/{obj.short_url}/'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get('/urls/')
+        response = self.client.get(
+            '/urls/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0,
+                   URL_SHORTENER_BLOOM_FILTER=False,
+                   URL_SHORTENER_BREAKER_FAILURES=2,
+                   URL_SHORTENER_BREAKER_RESET_AFTER=60,
+                   URL_SHORTENER_CREATE_QUEUE_INTERVAL=3600)
+class DegradedModeTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        breaker.database.reset()
+        self.addCleanup(breaker.database.reset)
+
+    def open_breaker(self):
+        for _ in range(2):
+            breaker.database.failure()
+
+    def test_breaker(self):
+        for _ in range(2):
+            self.assertFalse(breaker.database.is_open())
+            with self.assertRaises(breaker.Unavailable):
+                with breaker.database.guard():
+                    raise OperationalError('timeout')
+        self.assertTrue(breaker.database.is_open())
+        with self.assertRaises(breaker.Unavailable):
+            with breaker.database.guard():
+                self.fail('Ran while open')
+        with override_settings(URL_SHORTENER_BREAKER_RESET_AFTER=0):
+            with breaker.database.guard():
+                pass
+        self.assertTrue(breaker.database.is_closed())
+        # Errors of unguarded queries are counted too
+        with mock.patch.object(leaderboard,
+                               'top',
+                               side_effect=OperationalError('timeout')):
+            for _ in range(2):
+                response = self.client.get('/urls/top/')
+                self.assertEqual(response.status_code,
+                                 status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertTrue(breaker.database.is_open())
+        self.assertEqual(response['Retry-After'], '60')
+
+    def test_no_statement_timeout(self):
+
+        def statement_timeout():
+            with connection.cursor() as cursor:
+                cursor.execute('SHOW statement_timeout')
+                return cursor.fetchone()[0]
+
+        timeout = statement_timeout()
+        self.assertNotEqual(timeout, '0')
+        with breaker.no_statement_timeout():
+            self.assertEqual(statement_timeout(), '0')
+        self.assertEqual(statement_timeout(), timeout)
+
+    def test_reads_from_cache(self):
+        cached = Url.objects.create(url='https://www.google.com/')
+        self.client.get(f'/url/{cached.short_url}/')
+        missing = Url.objects.create(url='https://www.python.org/')
+        entries.delete([missing.short_url])
+        local_cache.targets.clear()
+        self.open_breaker()
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/url/{cached.short_url}/')
+            self.assertEqual(response.status_code,
+                             status.HTTP_301_MOVED_PERMANENTLY)
+            response = self.client.get(f'/info/{cached.short_url}/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['on_clicks'], 2)
+            self.assertEqual(response['Warning'], '110 - "Response is Stale"')
+            for path in (f'/url/{missing.short_url}/', '/urls/'):
+                self.assertEqual(
+                    self.client.get(path).status_code,
+                    status.HTTP_503_SERVICE_UNAVAILABLE)
+        breaker.database.reset()
+        clicks.flush()
+        self.assertEqual(Url.objects.get(pk=cached.pk).on_clicks, 2)
+
+    def test_queued_creates(self):
+        self.open_breaker()
+        response = self.client.post('/url_shortener/',
+                                    {'url': 'https://www.google.com/'},
+                                    format='json')
+        self.assertEqual(response.status_code,
+                         status.HTTP_503_SERVICE_UNAVAILABLE)
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/creates.jsonl'
+            with override_settings(URL_SHORTENER_CREATE_QUEUE=path):
+                for url in ('https://www.google.com/',
+                            'https://www.python.org/'):
+                    response = self.client.post('/url_shortener/', {
+                        'url': url,
+                        'permanent': False
+                    },
+                                                format='json')
+                    self.assertEqual(response.status_code,
+                                     status.HTTP_202_ACCEPTED)
+                    self.assertEqual(response.data, {
+                        'url': url,
+                        'status': 'queued'
+                    })
+                self.assertFalse(Url.objects.exists())
+                breaker.database.reset()
+                Url.objects.create(url='https://www.python.org/')
+                out = io.StringIO()
+                call_command('replay_creates', stdout=out)
+                self.assertEqual(out.getvalue(), 'Created 1 queued URLs.\n')
+                obj = Url.objects.get(url='https://www.google.com/')
+                self.assertFalse(obj.permanent)
+                self.assertEqual(entries.get(obj.short_url)['url'], obj.url)
+                self.assertEqual(create_queue.replay(), 0)
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0,
+                   URL_SHORTENER_BLOOM_FILTER=False)
+class ProfilingTest(RedisTestMixin, APITestCase):
+
+    def test_budgets(self):
+        # Fills the id pool
+        Url.objects.create(url='https://www.python.org/')
+        # The insert and its savepoint; the caches are written in 3 pipelines
+        with profiling.budget(sql=3, cache=3):
+            response = self.client.post('/url_shortener/',
+                                        {'url': 'https://www.google.com/'},
+                                        format='json')
+        short_url = response.data['short_url']
+        with profiling.budget(sql=0, cache=2):
+            self.client.get(f'/url/{short_url}/')
+        with profiling.budget(sql=0, cache=1):
+            self.client.get(f'/url/{short_url}/')
+        with profiling.budget(sql=0, cache=3):
+            self.client.get(f'/info/{short_url}/')
+        self.client.get('/urls/')
+        with profiling.budget(sql=0, cache=1) as profile:
+            self.client.get('/urls/')
+        self.assertEqual(profile.cache_calls[0]['command'], 'GET PTTL')
+        self.assertEqual(profile.cache_calls[0]['family'], 'list')
+        with self.assertRaisesRegex(AssertionError,
+                                    '1 SQL queries made, 0 allowed'):
+            with profiling.budget(sql=0):
+                Url.objects.count()
+
+    def test_middleware(self):
+        obj = Url.objects.create(url='https://www.google.com/')
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/profile.log'
+            with override_settings(URL_SHORTENER_PROFILE=True,
+                                   URL_SHORTENER_PROFILE_LOG=path):
+                self.client.handler.load_middleware()
+                response = self.client.get(f'/info/{obj.short_url}/')
+                self.assertNotIn('Server-Timing', response)
+                response = self.client.get(f'/info/{obj.short_url}/',
+                                           HTTP_X_PROFILE='cprofile')
+                self.assertRegex(
+                    response['Server-Timing'],
+                    r'^sql;dur=[\d.]+;desc="0 queries", '
+                    r'cache;dur=[\d.]+;desc="3 calls", '
+                    r'total;dur=[\d.]+$')
+            with open(path) as f:
+                [line] = f
+        profile = json.loads(line)
+        self.assertEqual(profile['path'], f'/info/{obj.short_url}/')
+        self.assertEqual([call['family'] for call in profile['cache_calls']],
+                         ['url', 'url_meta', 'clicks'])
+        self.assertIn('cumulative', profile['cprofile'])
+
+
+class SingleFlightTest(RedisTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loads = 0
+
+    def load(self, value='loaded', delay=0):
+
+        def load():
+            self.loads += 1
+            time.sleep(delay)
+            cache.set('key', value)
+            return value
+
+        return load
+
+    def test_concurrent_misses_load_once(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                single_flight.get_or_load('key', self.load(delay=0.05))))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['loaded'] * 8)
+        self.assertEqual(self.loads, 1)
+
+    def test_stale_entry_is_revalidated_once(self):
+        cache.set('key', 'stale', timeout=10)
+        get_redis_connection('default').set(single_flight._lock_key('key'), 1)
+        self.assertEqual(single_flight.get_or_load('key', self.load()),
+                         'stale')
+        self.assertEqual(self.loads, 0)
+        get_redis_connection('default').delete(single_flight._lock_key('key'))
+        self.assertEqual(single_flight.get_or_load('key', self.load()),
+                         'loaded')
+        self.assertEqual(single_flight.get_or_load('key', self.load('again')),
+                         'loaded')
+        self.assertEqual(self.loads, 1)
+
+    @override_settings(URL_SHORTENER_CACHE_LOCK_WAIT=0.01)
+    def test_load_after_waiting(self):
+        get_redis_connection('default').set(single_flight._lock_key('key'), 1)
+        self.assertEqual(single_flight.get_or_load('key', self.load()),
+                         'loaded')
+        self.assertEqual(self.loads, 1)
+
+
+@override_settings(URL_SHORTENER_READ_REPLICAS=['replica'])
+class ReplicaRouterTest(RedisTestMixin, TransactionTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Another connection to the test database stands in for a replica
+        connections.settings['replica'] = dict(
+            connections['default'].settings_dict)
+        connections.settings['broken'] = dict(
+            connections['default'].settings_dict, PORT=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in ('replica', 'broken'):
+            connections[alias].close()
+            del connections.settings[alias]
+
+    def setUp(self):
+        super().setUp()
+        db_router._down.clear()
+        self.obj = Url.objects.create(url='https://www.google.com/')
+
+    def test_reads_go_to_replica(self):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            self.assertEqual(
+                self.client.get(f'/url/{self.obj.short_url}/').status_code,
+                status.HTTP_301_MOVED_PERMANENTLY)
+            self.assertEqual(
+                self.client.get(f'/info/{self.obj.short_url}/').status_code,
+                status.HTTP_200_OK)
+            self.assertEqual(
+                self.client.get('/urls/').status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 2)
+
+    def test_writes_stay_on_primary(self):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = self.client.post('/url_shortener/',
+                                        {'url': 'https://www.python.org/'})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.client.delete(f'/info/{self.obj.short_url}/')
+        self.assertEqual(len(queries), 0)
+
+    @override_settings(URL_SHORTENER_READ_REPLICAS=['replica', 'broken'])
+    def test_failed_replica_is_skipped(self):
+        with self.assertLogs('url_shortener.db_router', 'WARNING'):
+            self.assertEqual([db_router.pick() for _ in range(4)],
+                             ['replica'] * 4)
+        self.assertIn('broken', db_router._down)
+        with override_settings(URL_SHORTENER_READ_REPLICAS=['broken']):
+            with db_router.replica_reads() as alias:
+                self.assertEqual(alias, 'default')
+                self.assertEqual(Url.objects.get().pk, self.obj.pk)
+
+    def test_replica_failing_mid_query(self):
+
+        def fail(execute, sql, params, many, context):
+            raise OperationalError('terminating connection')
+
+        breaker.database.reset()
+        self.addCleanup(breaker.database.reset)
+        with connections['replica'].execute_wrapper(fail):
+            with self.assertLogs('url_shortener.db_router', 'WARNING'):
+                self.assertEqual(
+                    self.client.get(f'/url/{self.obj.short_url}/').status_code,
+                    status.HTTP_301_MOVED_PERMANENTLY)
+                self.assertIn('replica', db_router._down)
+                db_router._down.clear()
+                self.assertEqual(
+                    self.client.get('/urls/').status_code, status.HTTP_200_OK)
+        self.assertIn('replica', db_router._down)
+        self.assertEqual(breaker.database._failures, 0)
+
+
+@override_settings(URL_SHORTENER_SHARDS=['default', 'shard'],
+                   URL_SHORTENER_CLICK_FLUSH_INTERVAL=0)
+class ShardingTest(RedisTestMixin, TransactionTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        settings_dict = connections['default'].settings_dict
+        cls.shard_name = f'{settings_dict["NAME"]}_shard'
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP DATABASE IF EXISTS {cls.shard_name}')
+            cursor.execute(f'CREATE DATABASE {cls.shard_name}')
+        connections.settings['shard'] = dict(settings_dict,
+                                             NAME=cls.shard_name)
+        call_command('migrate', database='shard', verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['shard'].close()
+        del connections.settings['shard']
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP DATABASE {cls.shard_name}')
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        Url.objects.using('shard').all().delete()
+        self.urls = [
+            Url.objects.create(url=f'https://www.google.com/{i}')
+            for i in range(8)
+        ]
+
+    def shard_of(self, obj):
+        return Url.objects.using('shard').filter(pk=obj.pk).exists()
+
+    def test_urls_are_spread(self):
+        on_shard = [self.shard_of(obj) for obj in self.urls]
+        self.assertTrue(any(on_shard))
+        self.assertFalse(all(on_shard))
+        self.assertEqual(
+            Url.objects.count() + Url.objects.using('shard').count(), 8)
+        for obj, shard in zip(self.urls, on_shard):
+            self.assertEqual(sharding.shards_for_short_url(obj.short_url),
+                             ['shard' if shard else 'default'])
+
+    def test_lookups(self):
+        obj = next(obj for obj in self.urls if self.shard_of(obj))
+        response = self.client.get(f'/url/{obj.short_url}/')
+        self.assertEqual(response.status_code,
+                         status.HTTP_301_MOVED_PERMANENTLY)
+        self.assertEqual(response.url, obj.url)
+        response = self.client.get(f'/info/{obj.short_url}/')
+        self.assertEqual(response.data['url'], obj.url)
+        response = self.client.post('/url_shortener/', {'url': obj.url})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.delete(f'/info/{obj.short_url}/')
+        self.assertFalse(self.shard_of(obj))
+
+    def test_list_merges_shards(self):
+        response = self.client.get('/urls/')
+        self.assertEqual([item['short_url'] for item in response.data],
+                         [obj.short_url for obj in reversed(self.urls)])
+        response = self.client.get('/urls/?page_size=3&stream=1')
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([item['short_url'] for item in data],
+                         [obj.short_url for obj in reversed(self.urls)][:3])
+
+    def test_clicks_go_to_shard(self):
+        clicks.apply({obj.short_url: 2 for obj in self.urls})
+        self.assertEqual(
+            sum(Url.objects.values_list('on_clicks', flat=True)) + sum(
+                Url.objects.using('shard').values_list('on_clicks',
+                                                       flat=True)), 16)
+
+    def test_rebalance(self):
+        # Move the URLs of both shards to the old shard
+        Url.objects.using('shard').all().delete()
+        Url.objects.all().delete()
+        with override_settings(URL_SHORTENER_SHARDS=['default']):
+            Url.objects.bulk_create(self.urls)
+            legacy = Url.objects.create(url='https://www.python.org/')
+        with override_settings(URL_SHORTENER_PREVIOUS_SHARDS=['default']):
+            self.assertEqual(Url.objects.find(self.urls[0].short_url),
+                             self.urls[0])
+            out = io.StringIO()
+            call_command('rebalance_shards', '--dry-run', stdout=out)
+            to_move = int(out.getvalue().split()[0])
+            self.assertGreater(to_move, 0)
+            self.assertEqual(Url.objects.using('shard').count(), 0)
+            call_command('rebalance_shards', stdout=out)
+        self.assertEqual(Url.objects.using('shard').count(), to_move)
+        for obj in self.urls + [legacy]:
+            self.assertEqual(Url.objects.find(obj.short_url), obj)
+
+    def test_delete_after_rebalance(self):
+        with override_settings(URL_SHORTENER_SHARDS=['default']):
+            legacy = [
+                Url.objects.create(url=f'https://www.python.org/{i}')
+                for i in range(20)
+            ]
+        with override_settings(URL_SHORTENER_PREVIOUS_SHARDS=['default']):
+            call_command('rebalance_shards', stdout=io.StringIO())
+        # Stored on the shard of its short URL, not of its digest
+        obj = next(obj for obj in legacy if sharding.shard_for_digest(
+            obj.url_hash) != sharding.shards_for_short_url(obj.short_url)[0])
+        shard = sharding.shards_for_short_url(obj.short_url)[0]
+        response = self.client.delete(f'/info/{obj.short_url}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Url.objects.using(shard).filter(pk=obj.pk).exists())
+        self.assertIsNone(Url.objects.find(obj.short_url))
+
+    def test_rebalance_conflicts(self):
+        Url.objects.using('shard').all().delete()
+        Url.objects.all().delete()
+        with override_settings(URL_SHORTENER_SHARDS=['default']):
+            Url.objects.bulk_create(self.urls)
+        shortened_again, taken = [
+            obj for obj in self.urls if sharding.shard_of_slot(
+                sharding.slot_of_short_url(obj.short_url)) == 'shard'
+        ][:2]
+        Url.objects.db_manager('shard').insert_new(
+            [Url(url=shortened_again.url)])
+        Url.objects.db_manager('shard').bulk_create(
+            [Url(pk=taken.pk, short_url='zzzzzz', url='https://example.com/')])
+        with override_settings(URL_SHORTENER_PREVIOUS_SHARDS=['default']):
+            with self.assertRaisesRegex(CommandError, taken.short_url):
+                call_command('rebalance_shards', stdout=io.StringIO())
+            self.assertEqual(Url.objects.find(taken.short_url), taken)
+        moved = Url.objects.using('shard').get(pk=shortened_again.pk)
+        self.assertEqual(moved.short_url, shortened_again.short_url)
+        self.assertIsNone(moved.url_hash)
+        self.assertTrue(Url.objects.filter(pk=taken.pk).exists())
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0)
+class ClickBufferTest(RedisTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        response = self.client.post('/url_shortener/',
+                                    {'url': 'https://www.google.com/'},
+                                    format='json')
+        self.short_url = response.data['short_url']
+
+    def test_redirect_is_buffered(self):
+        for _ in range(3):
+            response = self.client.get(f'/url/{self.short_url}/')
+            self.assertEqual(response.status_code,
+                             status.HTTP_301_MOVED_PERMANENTLY)
+        self.assertEqual(
+            Url.objects.get(short_url=self.short_url).on_clicks, 0)
+        self.assertEqual(clicks.pending(self.short_url), 3)
+        self.assertEqual(clicks.flush(), 1)
+        self.assertEqual(
+            Url.objects.get(short_url=self.short_url).on_clicks, 3)
+        self.assertEqual(clicks.pending(self.short_url), 0)
+
+    def test_flush_is_additive(self):
+        Url.objects.filter(short_url=self.short_url).update(on_clicks=5)
+        clicks.record(self.short_url)
+        clicks.record(self.short_url)
+        clicks.flush()
+        self.assertEqual(
+            Url.objects.get(short_url=self.short_url).on_clicks, 7)
+
+    def test_flush_after_commit_failure(self):
+        for _ in range(3):
+            self.client.get(f'/url/{self.short_url}/')
+        with mock.patch.object(leaderboard,
+                               'update',
+                               side_effect=OperationalError('timeout')):
+            self.assertEqual(clicks.flush(), 1)
+        self.assertEqual(clicks.flush(), 0)
+        obj = Url.objects.get(short_url=self.short_url)
+        self.assertEqual(obj.on_clicks, 3)
+        self.assertEqual(
+            ClickBucket.objects.filter(url=obj).aggregate(
+                total=Sum('count'))['total'], 3)
+
+    def test_flush_clicks_command(self):
+        self.client.get(f'/url/{self.short_url}/')
+        call_command('flush_clicks', stdout=io.StringIO())
+        self.assertEqual(
+            Url.objects.get(short_url=self.short_url).on_clicks, 1)
+
+
+@override_settings(URL_SHORTENER_CLICK_FLUSH_INTERVAL=0)
+class LocalCacheTest(RedisTestMixin, APITestCase):
+
+    def test_lru_eviction(self):
+        lru = local_cache.LocalCache(max_size=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.stats()['evictions'], 1)
+        self.assertEqual(lru.stats()['hits'], 2)
+        self.assertEqual(lru.stats()['misses'], 1)
+
+    def test_ttl(self):
+        lru = local_cache.LocalCache(max_size=2, ttl=-1)
+        lru.set('a', 1)
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(lru.stats()['size'], 0)
+
+    def test_redirect_hit_skips_redis_and_database(self):
+        local_cache.targets.clear()
+        response = self.client.post('/url_shortener/',
+                                    {'url': 'https://www.google.com/'},
+                                    format='json')
+        short_url = response.data['short_url']
+        self.client.get(f'/url/{short_url}/')
+        cache.delete(short_url)
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/url/{short_url}/')
+        self.assertEqual(response.url, 'https://www.google.com/')
+        self.assertIsNone(entries.get(short_url))
+
+    def test_delete_invalidates(self):
+        response = self.client.post('/url_shortener/',
+                                    {'url': 'https://www.google.com/'},
+                                    format='json')
+        short_url = response.data['short_url']
+        self.client.get(f'/url/{short_url}/')
+        self.assertIsNotNone(local_cache.targets.get(short_url))
+        self.client.delete(f'/info/{short_url}/')
+        self.assertIsNone(local_cache.targets.get(short_url))
+        response = self.client.get(f'/url/{short_url}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_invalidation_from_other_worker(self):
+        local_cache.get('abc123')
+        local_cache.set('abc123', 'https://www.google.com/')
+        for _ in range(50):
+            get_redis_connection().publish(local_cache.INVALIDATION_CHANNEL,
+                                           'abc123')
+            if local_cache.targets.get('abc123') is None:
+                break
+            time.sleep(0.05)
+        self.assertIsNone(local_cache.targets.get('abc123'))
+
+    def test_stats_endpoint(self):
+        response = self.client.get('/stats/local_cache/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data),
+                         {'size', 'max_size', 'hits', 'misses', 'evictions'})
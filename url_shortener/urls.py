@@ -1,16 +1,34 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
 
 app_name = 'url_shortener'
 
+if settings.URL_SHORTENER_ASYNC_VIEWS:
+    info_view = async_views.info
+    redirect_view = async_views.redirect
+else:
+    info_view = views.UrlDetailView.as_view()
+    redirect_view = views.UrlRedirectView.as_view()
+
 urlpatterns = [
     path('', views.WelcomeView.as_view(), name='welcome'),
     path('url_shortener/',
          views.UrlShortenerCreateView.as_view(),
          name='url_shortener'),
+    path('url_shortener/bulk/',
+         views.UrlShortenerBulkCreateView.as_view(),
+         name='url_shortener_bulk'),
     path('urls/', views.UrlListView.as_view(), name='urls'),
-    path('info/<str:short_url>/', views.UrlDetailView.as_view(), name='info'),
-    path('url/<str:short_url>/',
-         views.UrlRedirectView.as_view(),
-         name='url_redirect'),
-]
\ No newline at end of file
+    path('urls/top/', views.UrlTopView.as_view(), name='urls_top'),
+    path('urls/export/', views.UrlExportView.as_view(), name='urls_export'),
+    path('info/<str:short_url>/', info_view, name='info'),
+    path('info/<str:short_url>/stats/',
+         views.UrlStatsView.as_view(),
+         name='info_stats'),
+    path('url/<str:short_url>/', redirect_view, name='url_redirect'),
+    path('stats/local_cache/',
+         views.LocalCacheStatsView.as_view(),
+         name='local_cache_stats'),
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
+]
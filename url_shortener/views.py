@@ -1,17 +1,21 @@
-from threading import Thread
-
-from django.core.cache import cache
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
-from django.http import HttpResponsePermanentRedirect
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
 from django.utils.decorators import method_decorator
+from django.views import View
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import generics
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from . import serializers
-from .models import Url
+from . import (breaker, click_stats, clicks, create_queue, db_router, entries,
+               export, http_cache, known_codes, leaderboard, listing,
+               local_cache, metrics, redirects, serializers, sharding,
+               single_flight)
+from .models import ClickBucket, Url, url_digest
 
 
 class WelcomeView(generics.GenericAPIView):
@@ -46,10 +50,10 @@ class WelcomeView(generics.GenericAPIView):
                                                    'https://www.google.com',
                                                    'short_url':
                                                    'random string',
-                                                   'on_clicks':
-                                                   0,
+                                                   'on_clicks': 0,
                                                    'created':
-                                                   '2020-05-17T19:01:41.000Z'
+                                                   '2020-05-17T19:01:41.000Z',
+                                                   'expires_at': None
                                                }
                                            }),
                           400:
@@ -67,29 +71,37 @@ class UrlShortenerCreateView(generics.CreateAPIView):
     
     Note
     ----
-    The algorithm used to generate the shortened URL is seeded with the last URL's ID. This means that if the last URL's ID is 0, the algorithm will start from 0. If the last URL's ID is 1, the algorithm will start from 1. This is to ensure that the shortened URLs are unique.(The output of the algorithm is a string of characters chosen randomly from the set of characters in `ascii_letters + digits` and the length of the string is equal to the `max_length` of the `short_url` field in the `Url` model.)
-    The use of seed was to prevent the replication of random generator loop. For example, if the loop method was used, it would be necessary to check our database for the existence of the generated string. This would be a costly operation. The use of seed ensures that the algorithm will not repeat itself.
-    All the steps above are done in the database(you can see the SQL query in the `url_shortener/migrations/queries/sql_generator.text` file). This is to ensure that the database is not locked for a long time.
+    The shortened URL is generated from the ID of the new URL before it is inserted, so the URL is created with a single `INSERT` (see `url_shortener/codes.py`).
+    The ID is permuted with a keyed Feistel network and written in base 62 (`ascii_letters + digits`) with the length of the `short_url` field in the `Url` model. The permutation is a bijection, so two IDs can never give the same shortened URL, and consecutive IDs give unrelated shortened URLs.
+    While the database is unavailable, creates are answered with a 503, or queued and answered with a 202 without `short_url` if `URL_SHORTENER_CREATE_QUEUE` is set (see `url_shortener/create_queue.py`).
     """
     serializer_class = serializers.UrlSerializer
 
     def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            with breaker.database.guard():
+                created = Url.objects.insert_new(
+                    [Url(**serializer.validated_data)])
+        except breaker.Unavailable:
+            if not create_queue.enabled():
+                raise
+            create_queue.put(serializer.validated_data)
+            return Response(
+                {
+                    'url': serializer.validated_data['url'],
+                    'status': 'queued'
+                },
+                status=202)
         # Check if the URL has already been shortened
-        if Url.objects.filter(url=request.data['url']).exists():
+        if not created:
             return Response({'error': 'URL already shortened'}, status=400)
-        super().create(request, *args, **kwargs)
-        response = Url.objects.filter(url=request.data['url']).values()[0]
-        del response['id']
-        cache.set(
-            response['short_url'], {
-                'url': response['url'],
-                'on_clicks': response['on_clicks'],
-                'created': response['created']
-            })
-        # Delete the cache urls
-        if cache.has_key('/urls/'):
-            cache.delete('/urls/')
-        return Response(response, status=201)
+        obj = serializer.instance = created[0]
+        entries.set_many([obj])
+        # Delete the cached first pages of urls
+        listing.invalidate_first_pages()
+        return Response(serializer.data, status=201)
 
     def post(self, request, *args, **kwargs):
         # Validate the URL
@@ -101,6 +113,104 @@ class UrlShortenerCreateView(generics.CreateAPIView):
         return super().post(request, *args, **kwargs)
 
 
+@method_decorator(name='post',
+                  decorator=swagger_auto_schema(
+                      operation_summary="Get shortened URLs in bulk",
+                      operation_id="url_shortener_bulk_get_short_urls",
+                      request_body=serializers.UrlBulkSerializer,
+                      responses={
+                          200:
+                          openapi.Response(description="Per URL status",
+                                           examples={
+                                               'application/json': [{
+                                                   'url':
+                                                   'https://www.google.com',
+                                                   'status':
+                                                   'created',
+                                                   'short_url':
+                                                   'random string'
+                                               }, {
+                                                   'url':
+                                                   'invalid_url',
+                                                   'status':
+                                                   'invalid',
+                                                   'error':
+                                                   'Invalid URL'
+                                               }]
+                                           }),
+                      }))
+class UrlShortenerBulkCreateView(generics.GenericAPIView):
+    """
+    Shorten a list of URLs in one request.
+
+    Note
+    ----
+    All new URLs are inserted with a single multi-row statement and cached with one pipelined `set_many`. For each URL the response reports its `status`: `created`, `exists` (the URL was already shortened, its existing short URL is returned) or `invalid`.
+    """
+    serializer_class = serializers.UrlBulkSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        urls = serializer.validated_data['urls']
+
+        validator = URLValidator()
+        max_length = Url._meta.get_field('url').max_length
+        digests = {}
+        for url in dict.fromkeys(urls):
+            try:
+                validator(url)
+            except ValidationError:
+                continue
+            if len(url) > max_length:
+                continue
+            digests[url] = url_digest(url)
+
+        new = {}
+        for url, digest in digests.items():
+            new.setdefault(digest, Url(url=url))
+        with breaker.database.guard():
+            created = {
+                obj.url_hash: obj
+                for obj in Url.objects.insert_new(new.values())
+            }
+            skipped = [
+                obj for digest, obj in new.items() if digest not in created
+            ]
+            existing = {}
+            for shard, objs in sharding.by_digest(skipped).items():
+                for obj in Url.objects.using(shard).filter(
+                        url_hash__in=[obj.url_hash for obj in objs]).only(
+                            'url', 'url_hash', 'short_url'):
+                    existing[bytes(obj.url_hash)] = obj
+        if created:
+            entries.set_many(created.values())
+            listing.invalidate_first_pages()
+
+        results = []
+        for url in urls:
+            digest = digests.get(url)
+            if digest in created and created[digest].url == url:
+                status = 'created'
+                obj = created[digest]
+            elif digest in created or digest in existing:
+                status = 'exists'
+                obj = created.get(digest) or existing[digest]
+            else:
+                results.append({
+                    'url': url,
+                    'status': 'invalid',
+                    'error': 'Invalid URL'
+                })
+                continue
+            results.append({
+                'url': url,
+                'status': status,
+                'short_url': obj.short_url
+            })
+        return Response(results)
+
+
 @method_decorator(name='get',
                   decorator=swagger_auto_schema(
                       operation_summary="Get list of URLs",
@@ -127,19 +237,120 @@ class UrlListView(generics.ListAPIView):
     
     Note
     ----
-    The list is ordered by the number of times the shortened URL has been clicked.
+    The list is ordered by creation date, newest first, and split in pages of `page_size` URLs (see `url_shortener/listing.py`). The link to the next page is sent in the `Link` header; it carries a `cursor` that points just after the last URL of the page, so every page is read with an index range scan.
+    Pages are cached one by one. Creating a URL only invalidates the first pages and deleting a URL only invalidates the pages it was on.
+    Pass `stream=1` to stream a large page instead of building it in memory (such pages are not cached).
+    Pages are read from a read replica when `URL_SHORTENER_READ_REPLICAS` lists some (see `url_shortener/db_router.py`).
+    Cached pages carry an `ETag` and a `Last-Modified` header, and a conditional request for an unchanged page gets a 304 (see `url_shortener/http_cache.py`).
     """
     # queryset with fields url, short_url, created
     queryset = Url.objects.all()
     serializer_class = serializers.UrlSerializerList
+    pagination_class = listing.KeysetPagination
+
+    def get(self, request):
+        if request.query_params.get('stream'):
+            # The rows are read after the view returns
+            with db_router.replica_reads() as alias:
+                return self.paginator.get_streaming_response(
+                    self.get_queryset().using(alias), request,
+                    self.get_serializer_class().Meta.fields)
+        key = request.get_full_path()
+
+        def load():
+            with breaker.database.guard():
+                response, _ = db_router.read(
+                    lambda: super(UrlListView, self).get(request))
+            page = {
+                'data': response.data,
+                'headers': self.paginator.get_headers(),
+                'etag': http_cache.etag(response.data),
+                'last_modified': int(timezone.now().timestamp())
+            }
+            listing.cache_page(
+                key, page, self.paginator.oldest,
+                self.paginator.cursor_query_param not in request.query_params)
+            return page
+
+        page = single_flight.get_or_load(key, load)
+        # Pages cached by older versions have no validators
+        etag = page.get('etag') or http_cache.etag(page['data'])
+        last_modified = page.get('last_modified')
+        response = http_cache.not_modified(request, etag, last_modified)
+        if response is None:
+            response = Response(page['data'], headers=page['headers'])
+        return http_cache.add_validators(response, etag, last_modified,
+                                         settings.URL_SHORTENER_LIST_MAX_AGE)
+
+
+@method_decorator(name='get',
+                  decorator=swagger_auto_schema(
+                      operation_summary="Get the most clicked URLs",
+                      operation_id="url_shortener_top",
+                      manual_parameters=[
+                          openapi.Parameter(
+                              'n',
+                              openapi.IN_QUERY,
+                              description="Number of URLs (default 10)",
+                              type=openapi.TYPE_INTEGER)
+                      ],
+                      responses={
+                          200:
+                          openapi.Response(description="Most clicked URLs",
+                                           examples={
+                                               'application/json': [{
+                                                   'url':
+                                                   'https://www.google.com',
+                                                   'short_url':
+                                                   'random string',
+                                                   'on_clicks':
+                                                   42,
+                                               }]
+                                           }),
+                      }))
+class UrlTopView(APIView):
+    """
+    Get the `n` most clicked URLs, most clicked first.
+
+    Note
+    ----
+    The URLs are read from a Redis sorted set updated each time the buffered clicks are flushed (see `url_shortener/leaderboard.py`), so the counts do not include the clicks of the last few seconds and `n` is at most `URL_SHORTENER_TOP_SIZE`.
+    """
 
     def get(self, request):
-        _cache = cache.get("/urls/")
-        if _cache:
-            return Response(_cache)
-        response = super().get(request)
+        try:
+            n = int(request.query_params.get('n', 10))
+        except ValueError:
+            return Response({'error': 'Invalid n'}, status=400)
+        n = min(max(n, 1), settings.URL_SHORTENER_TOP_SIZE)
+        return Response(leaderboard.top(n))
+
+
+class UrlExportView(View):
+    """
+    Export all shortened URLs as NDJSON (default) or CSV.
 
-        cache.set("/urls/", response.data)
+    Query parameters: `format` (`ndjson` or `csv`), `created_from` (inclusive) and `created_to` (exclusive) dates, and `min_clicks`. The rows are streamed as they are read from the database.
+    """
+
+    def get(self, request):
+        fmt = request.GET.get('format', 'ndjson')
+        if fmt not in export.FORMATS:
+            return JsonResponse({'error': 'Invalid format'}, status=400)
+        try:
+            created_from = export.parse_bound(request.GET.get('created_from'))
+            created_to = export.parse_bound(request.GET.get('created_to'))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        min_clicks = request.GET.get('min_clicks')
+        if min_clicks is not None and not min_clicks.isdigit():
+            return JsonResponse({'error': 'Invalid min_clicks'}, status=400)
+        render, content_type = export.FORMATS[fmt]
+        rows = export.rows(created_from, created_to, min_clicks
+                           and int(min_clicks))
+        response = StreamingHttpResponse(render(rows),
+                                         content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="urls.{fmt}"'
         return response
 
 
@@ -157,7 +368,9 @@ class UrlListView(generics.ListAPIView):
                                      'url': 'https://www.google.com',
                                      'short_url': 'random string',
                                      'on_clicks': 0,
-                                     'created': '2020-05-17T19:01:41.000Z'
+                                     'created': '2020-05-17T19:01:41.000Z',
+                                     'expires_at': None,
+                                     'permanent': True
                                  }
                              }),
             404:
@@ -188,7 +401,7 @@ class UrlDetailView(generics.RetrieveDestroyAPIView):
     Get/Delete details of a shortened URL.
     
     get:
-    Returns the details of a shortened URL.
+    Returns the details of a shortened URL. The response carries an `ETag`, and a request with a matching `If-None-Match` gets a 304. While the database is unavailable, the details of the cached URLs are still returned, with a `Warning: 110 - "Response is Stale"` header.
     
     delete:
     Deletes a shortened URL.
@@ -197,33 +410,126 @@ class UrlDetailView(generics.RetrieveDestroyAPIView):
     serializer_class = serializers.UrlSerializerDetail
 
     def get(self, request, *args, **kwargs):
-        _cache = cache.get(self.kwargs['short_url'])
-        if _cache:
-            return Response(_cache)
-        obj = Url.objects.filter(short_url=self.kwargs['short_url']).first()
-        if obj:
-            result = {
-                'url': obj.url,
-                'on_clicks': obj.on_clicks,
-                'created': obj.created
-            }
-            cache.set(self.kwargs['short_url'], result)
-            return Response(result)
-        else:
+        result = redirects.details(self.kwargs['short_url'])
+        if result is None:
             return Response({'message': 'URL not found'}, status=404)
+        # The cached count only includes the clicks flushed to the database
+        result = dict(result)
+        result['on_clicks'] += clicks.pending(self.kwargs['short_url'])
+        if not breaker.database.is_closed():
+            return http_cache.stale(Response(result))
+        etag = http_cache.etag(result)
+        response = http_cache.not_modified(request, etag)
+        if response is None:
+            response = Response(result)
+        return http_cache.add_validators(
+            response, etag, max_age=settings.URL_SHORTENER_INFO_MAX_AGE)
 
     def delete(self, request, *args, **kwargs):
-        if cache.has_key(self.kwargs['short_url']):
-            cache.delete(self.kwargs['short_url'])
-        if cache.has_key('/urls/'):
-            cache.delete('/urls/')
+        with breaker.database.guard():
+            local_cache.invalidate(self.kwargs['short_url'])
+            entries.delete([self.kwargs['short_url']])
 
-        obj = Url.objects.filter(short_url=self.kwargs['short_url'])
-        if obj:
-            obj.delete()
-            return Response({'message': 'URL deleted successfully.'},
-                            status=204)
-        return Response({'message': 'URL not found'}, status=404)
+            obj = Url.objects.find(self.kwargs['short_url'])
+            if obj:
+                position = (obj.created, obj.id)
+                obj.delete()
+                # The short URL stays in the Bloom filters
+                known_codes.cache_missing(self.kwargs['short_url'])
+                leaderboard.remove(self.kwargs['short_url'])
+                listing.invalidate_pages_with(*position)
+                return Response({'message': 'URL deleted successfully.'},
+                                status=204)
+            return Response({'message': 'URL not found'}, status=404)
+
+
+@method_decorator(
+    name='get',
+    decorator=swagger_auto_schema(
+        operation_summary="Get the clicks of a shortened URL over time",
+        operation_id="url_shortener_stats",
+        manual_parameters=[
+            openapi.Parameter('granularity',
+                              openapi.IN_QUERY,
+                              description="`hour` (default) or `day`",
+                              type=openapi.TYPE_STRING),
+            openapi.Parameter('from',
+                              openapi.IN_QUERY,
+                              description="Start date or datetime (inclusive)",
+                              type=openapi.TYPE_STRING),
+            openapi.Parameter('to',
+                              openapi.IN_QUERY,
+                              description="End date or datetime (exclusive)",
+                              type=openapi.TYPE_STRING),
+        ],
+        responses={
+            200:
+            openapi.Response(description="Clicks per hour or day",
+                             examples={
+                                 'application/json': {
+                                     'short_url':
+                                     'random string',
+                                     'granularity':
+                                     'hour',
+                                     'from':
+                                     '2020-05-17T00:00:00Z',
+                                     'to':
+                                     '2020-05-18T00:00:00Z',
+                                     'buckets': [{
+                                         'start': '2020-05-17T19:00:00Z',
+                                         'clicks': 3
+                                     }]
+                                 }
+                             }),
+            404:
+            openapi.Response(
+                description="Not found",
+                examples={'application/json': {
+                    'message': 'URL not found'
+                }}),
+        }))
+class UrlStatsView(APIView):
+    """
+    Clicks of a shortened URL per hour or per day
+
+    Query parameters: `granularity` (`hour` or `day`), `from` (inclusive) and `to` (exclusive) dates or datetimes. By default the stats cover the last day by hour or the last 30 days by day.
+
+    Note
+    ----
+    The clicks are counted per hour in Redis and added to pre-aggregated buckets each time the buffered clicks are flushed (see `url_shortener/click_stats.py`), so the last few seconds of clicks are not included yet. Hourly buckets older than `URL_SHORTENER_HOURLY_CLICKS_RETENTION_DAYS` are compacted into daily ones by `manage.py compact_click_stats`; only days are available for that period.
+    """
+
+    def get(self, request, short_url):
+        granularity = request.query_params.get('granularity', ClickBucket.HOUR)
+        if granularity not in click_stats.DEFAULT_RANGES:
+            return Response({'error': 'Invalid granularity'}, status=400)
+        try:
+            start = export.parse_bound(request.query_params.get('from'))
+            end = export.parse_bound(request.query_params.get('to'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        end = end or timezone.now()
+        start = start or end - click_stats.DEFAULT_RANGES[granularity]
+        obj = None
+        if known_codes.might_exist(short_url):
+            obj = Url.objects.find(short_url)
+        if obj is None:
+            return Response({'message': 'URL not found'}, status=404)
+        return Response({
+            'short_url':
+            short_url,
+            'granularity':
+            granularity,
+            'from':
+            start,
+            'to':
+            end,
+            'buckets': [{
+                'start': bucket_start,
+                'clicks': clicks
+            } for bucket_start, clicks in click_stats.buckets(
+                obj, granularity, start, end)],
+        })
 
 
 @method_decorator(
@@ -237,6 +543,9 @@ class UrlDetailView(generics.RetrieveDestroyAPIView):
             None,
             301:
             openapi.Response(description="Redirect to original URL", ),
+            302:
+            openapi.Response(
+                description="Redirect to original URL (not permanent)", ),
             404:
             openapi.Response(
                 description="Not found",
@@ -245,33 +554,35 @@ class UrlDetailView(generics.RetrieveDestroyAPIView):
                 }}),
         }))
 class UrlRedirectView(APIView):
-    """Redirect to the original URL"""
+    """
+    Redirect to the original URL
 
-    def update_on_clicks(self, short_url):
-        url = Url.objects.filter(short_url=short_url).first()
-        if url:
-            url.on_clicks += 1
-            url.save()
+    Note
+    ----
+    Clicks are buffered in Redis and applied to the database in bulk (see `url_shortener/clicks.py`), so a redirect never writes to the database.
+    Resolved URLs are also kept in a small per-worker cache (see `url_shortener/local_cache.py`), so a hot redirect does not read the Redis cache either.
+    While the database is unavailable, cached URLs are still redirected to and their clicks are kept in Redis; the others get a 503 (see `url_shortener/breaker.py`).
+    Links are redirected with a 301 that browsers and CDNs may keep `URL_SHORTENER_REDIRECT_MAX_AGE` seconds, or with a 302 kept `URL_SHORTENER_TEMPORARY_REDIRECT_MAX_AGE` seconds if they were created with `permanent` false (see `url_shortener/http_cache.py`). Clicks answered by those caches are not counted.
+    """
 
     def get(self, request, short_url):
-        _cache = cache.get(short_url)
-        if _cache:
-            url = _cache['url']
-            _cache['on_clicks'] += 1
-            cache.set(short_url, _cache)
-            thread = Thread(target=self.update_on_clicks, args=(short_url, ))
-            thread.start()
-        else:
-            obj = Url.objects.filter(short_url=short_url).first()
-            if obj:
-                url = obj.url
-                obj.on_clicks += 1
-                obj.save()
-                cache.set(short_url, {
-                    'url': url,
-                    'on_clicks': obj.on_clicks,
-                    'created': obj.created
-                })
-            else:
-                return Response({'error': 'URL not found'}, status=404)
-        return HttpResponsePermanentRedirect(url)
+        target = redirects.resolve(short_url)
+        if target is None:
+            return Response({'error': 'URL not found'}, status=404)
+        clicks.record(short_url)
+        return http_cache.redirect(target)
+
+
+class LocalCacheStatsView(APIView):
+    """Hit, miss and eviction counters of this worker's local URL cache."""
+
+    def get(self, request):
+        return Response(local_cache.targets.stats())
+
+
+class MetricsView(View):
+    """Metrics of this worker in the Prometheus text format."""
+
+    def get(self, request):
+        return HttpResponse(metrics.render(),
+                            content_type=metrics.CONTENT_TYPE)
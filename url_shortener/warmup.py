@@ -0,0 +1,111 @@
+"""
+Preloading of the most visited short URLs into the Redis cache.
+
+After a deploy or a Redis flush every short URL is cold and its first
+redirect goes to the database. `warm` reads the ``n`` hottest URLs, by total
+clicks or by clicks over the last hours (from the click buckets), and writes
+their cache entries in pipelined batches, at most ``rate`` URLs per second.
+Entries are written with ``SET NX``, so entries cached by redirects in the
+meantime are kept.
+
+With ``URL_SHORTENER_WARM_CACHE_ON_STARTUP`` set, `on_startup` (called by
+``config/wsgi.py`` and ``config/asgi.py``) warms the cache in a background
+thread of the first worker to start.
+"""
+import itertools
+import logging
+import threading
+import time
+from datetime import timedelta
+from operator import itemgetter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db.models import Q, Sum
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from . import entries, sharding
+from .models import ClickBucket, Url
+
+logger = logging.getLogger(__name__)
+
+CLICKS = 'clicks'
+RECENT = 'recent'
+# Held while a worker warms the cache, so the other workers do not
+STARTUP_LOCK_KEY = 'url_shortener:warmup'
+STARTUP_LOCK_TIMEOUT = 600
+
+
+def hottest(n, by=CLICKS, hours=24):
+    """
+    Iterate over ``(short_url, url, on_clicks, created, expires_at,
+    permanent)`` of the hottest URLs not expired.
+    """
+    fields = ('short_url', 'url', 'on_clicks', 'created', 'expires_at',
+              'permanent', 'id')
+    now = timezone.now()
+    live = Url.objects.filter(
+        Q(expires_at__isnull=True) | Q(expires_at__gt=now))
+    if by == RECENT:
+        queryset = live.filter(
+            click_buckets__granularity=ClickBucket.HOUR,
+            click_buckets__start__gte=now - timedelta(hours=hours)).annotate(
+                recent_clicks=Sum('click_buckets__count')).order_by(
+                    '-recent_clicks',
+                    '-id').values_list(*fields, 'recent_clicks')
+        key = itemgetter(7, 6)
+    else:
+        queryset = live.filter(on_clicks__gt=0).order_by(
+            '-on_clicks', '-id').values_list(*fields)
+        key = itemgetter(2, 6)
+    rows = sharding.merge(queryset[:n], key, reverse=True)
+    return (row[:6] for row in itertools.islice(rows, n))
+
+
+def warm(n, by=CLICKS, hours=24, batch_size=1000, rate=None, progress=None):
+    """
+    Cache the ``n`` hottest URLs and return the number of entries written.
+
+    ``progress`` is called with the number of URLs read after each batch.
+    """
+    client = get_redis_connection('default')
+    rows = hottest(n, by, hours)
+    started = time.monotonic()
+    read = written = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return written
+        pipe = client.pipeline(transaction=False)
+        for row in batch:
+            entries.write(pipe, *row, nx=True)
+        # Two writes per URL, counted by the first
+        written += sum(1 for result in pipe.execute()[::2] if result)
+        read += len(batch)
+        if progress:
+            progress(read)
+        if rate:
+            delay = started + read / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def _warm_on_startup(n):
+    try:
+        written = warm(n, rate=settings.URL_SHORTENER_WARM_CACHE_RATE)
+        logger.info('Warmed the cache with %d URLs', written)
+    except Exception:
+        logger.exception('Warming the cache failed')
+    finally:
+        close_old_connections()
+
+
+def on_startup():
+    n = settings.URL_SHORTENER_WARM_CACHE_ON_STARTUP
+    if n and cache.add(STARTUP_LOCK_KEY, 1, STARTUP_LOCK_TIMEOUT):
+        threading.Thread(target=_warm_on_startup,
+                         args=(n, ),
+                         name='cache-warmup',
+                         daemon=True).start()